@@ -0,0 +1,193 @@
+# FILE: _build_artifacts/python/book_metrics.py
+"""
+Metrics for the order pipeline's Lambdas, shipped in the shared layer
+(generate_pdf, which is a container image, carries its own copy).
+
+`metrics_handler` wraps a lambda_handler; inside it `put`, `count` and `timer`
+buffer values, which are flushed once when the invocation ends as CloudWatch
+Embedded Metric Format lines on stdout. CloudWatch Logs turns those into metrics,
+so recording costs no API calls. Every metric has a `stage` dimension, and a
+`stage`+`tier` one when the book's tier is known (its word count, as in the
+usage ledger). When METRICS_DIR is set each value is also appended there as a
+line of NDJSON, for offline analysis (the offline harness sets it).
+
+Every invocation records its `duration` and `errors`; `instrument` adds the
+retries each boto3 client made. Retries of the upstreams (OpenAI, AstrologyAPI,
+Lulu) are counted by resilience.
+
+Metrics never fail an invocation: if they cannot be flushed, that is printed
+and the handler's result stands.
+"""
+import functools
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AstrologyBookPipeline')
+METRICS_DIR = os.environ.get('METRICS_DIR')
+# EMF takes at most this many values per metric in one line.
+MAX_VALUES_PER_METRIC = 100
+
+# The invocation whose values are being buffered.
+_invocation = ContextVar('book_metrics_invocation', default=None)
+
+
+def put(name, value, unit='None', tier=None):
+    """Buffers a value of `name` for this invocation. `tier` overrides the invocation's, for one book of a batch."""
+    invocation = _invocation.get()
+    if invocation is None or value is None:
+        return
+    tier = tier if tier is not None else invocation["tier"]
+    invocation["values"].append((name, value, unit, tier, time.time()))
+
+
+def count(name, value=1, tier=None):
+    put(name, value, 'Count', tier)
+
+
+@contextmanager
+def timer(name, tier=None):
+    """Puts the enclosed block's duration in milliseconds, whether or not it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        put(name, round((time.perf_counter() - started) * 1000, 3), 'Milliseconds', tier)
+
+
+def set_tier(tier):
+    """The tier of the book this invocation is for, from now on."""
+    invocation = _invocation.get()
+    if invocation is not None:
+        invocation["tier"] = tier
+
+
+def _after_call(parsed, **kwargs):
+    retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts')
+    if retries:
+        count('aws_retries', retries)
+
+
+def instrument(*clients):
+    """Counts the retries each boto3 client makes (a resource's is `resource.meta.client`)."""
+    for client in clients:
+        client.meta.events.register('after-call', _after_call, unique_id='book_metrics.after_call')
+    return clients[0] if len(clients) == 1 else clients
+
+
+def pending():
+    """The values buffered so far in this invocation."""
+    invocation = _invocation.get()
+    return list(invocation["values"]) if invocation else []
+
+
+def reset():
+    """Forgets the values buffered so far. A forked child calls this so it reports only its own."""
+    invocation = _invocation.get()
+    if invocation:
+        invocation["values"] = []
+
+
+def adopt(values):
+    """Adds values a forked child buffered and sent back."""
+    invocation = _invocation.get()
+    if invocation and values:
+        invocation["values"].extend(tuple(value) for value in values)
+
+
+def emf_documents(invocation):
+    """The invocation's values as EMF documents, one per tier (dimension values differ) and chunk of values."""
+    by_tier = defaultdict(lambda: defaultdict(list))
+    units = {}
+    for name, value, unit, tier, _ in invocation["values"]:
+        by_tier[tier][name].append(value)
+        units[name] = unit
+    documents = []
+    for tier, metrics in by_tier.items():
+        dimensions = [["stage"], ["stage", "tier"]] if tier is not None else [["stage"]]
+        chunks = max(-(-len(values) // MAX_VALUES_PER_METRIC) for values in metrics.values())
+        for chunk in range(chunks):
+            values = {name: values[chunk * MAX_VALUES_PER_METRIC:(chunk + 1) * MAX_VALUES_PER_METRIC] for name, values in metrics.items()}
+            values = {name: chunk_values for name, chunk_values in values.items() if chunk_values}
+            document = {
+                "_aws": {
+                    "Timestamp": int(invocation["started"] * 1000),
+                    "CloudWatchMetrics": [{
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": dimensions,
+                        "Metrics": [{"Name": name, "Unit": units[name]} for name in values],
+                    }],
+                },
+                "stage": invocation["stage"],
+                # Not dimensions: searchable in Logs Insights without multiplying metric cost.
+                "function": invocation["function"],
+                "request_id": invocation["request_id"],
+                "order_id": invocation["order_id"],
+                **({"tier": str(tier)} if tier is not None else {}),
+                **{name: chunk_values if len(chunk_values) > 1 else chunk_values[0] for name, chunk_values in values.items()},
+            }
+            documents.append(document)
+    return documents
+
+
+def _write_local(invocation):
+    lines = [json.dumps({
+        "timestamp": timestamp, "stage": invocation["stage"], "tier": None if tier is None else str(tier),
+        "name": name, "value": value, "unit": unit, "function": invocation["function"],
+        "request_id": invocation["request_id"], "order_id": invocation["order_id"],
+    }) + "\n" for name, value, unit, tier, timestamp in invocation["values"]]
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    # One append per flush, so concurrent invocations do not interleave their lines.
+    fd = os.open(os.path.join(METRICS_DIR, f"{invocation['stage']}.ndjson"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, "".join(lines).encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def flush(invocation):
+    for document in emf_documents(invocation):
+        print(json.dumps(document, default=str))
+    if METRICS_DIR:
+        _write_local(invocation)
+
+
+def metrics_handler(stage):
+    """Decorates a lambda_handler so each invocation's metrics are buffered and flushed once at its end."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not METRICS_ENABLED:
+                return handler(event, context)
+            payload = event.get('Payload', event) if isinstance(event, dict) else {}
+            payload = payload if isinstance(payload, dict) else {}
+            invocation = {
+                "stage": stage,
+                "function": getattr(context, 'function_name', stage),
+                "request_id": getattr(context, 'aws_request_id', None),
+                "order_id": payload.get('order_id'),
+                "tier": None,
+                "started": time.time(),
+                "values": [],
+            }
+            token = _invocation.set(invocation)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = handler(event, context)
+                failed = False
+                return result
+            finally:
+                put('duration', round((time.perf_counter() - started) * 1000, 3), 'Milliseconds')
+                count('errors', int(failed))
+                _invocation.reset(token)
+                try:
+                    flush(invocation)
+                except Exception as e:
+                    print(f"WARNING: could not flush metrics for {stage}: {e}")
+        return wrapper
+    return decorate
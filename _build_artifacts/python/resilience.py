@@ -0,0 +1,380 @@
+# FILE: _build_artifacts/python/resilience.py
+"""
+Retries and circuit breakers for the pipeline's upstreams (AstrologyAPI, OpenAI,
+Lulu), shipped in the shared layer.
+
+`upstream(name).call(fn, *args)` (or `await ....call_async(...)`) runs `fn` and
+retries it when it fails in a way worth retrying: a connection error or timeout,
+or a 408/425/429/5xx response. The waits use decorrelated jitter and are never
+shorter than the response's Retry-After. Each upstream has a retry budget. Within
+any RETRY_BUDGET_WINDOW_SECONDS, its retries may not exceed RETRY_BUDGET_RATIO of
+its calls plus RETRY_BUDGET_MINIMUM. An upstream that is struggling therefore
+sees little extra load from us.
+
+Each upstream also has a circuit breaker. After BREAKER_FAILURE_THRESHOLD
+consecutive retryable failures it opens, and calls fail at once for
+BREAKER_COOL_DOWN_SECONDS. After that a single probe call is let through; if it
+succeeds the breaker closes.
+
+If the attempts or the budget are spent, the breaker is open, or Retry-After asks
+for longer than the upstream's max delay, the call raises UpstreamUnavailable. The
+state machine retries that error on a long, jittered interval, so a book waits for
+the upstream rather than failing.
+
+Budgets and breakers live in the container, so each warm container learns an
+outage for itself. Settings can be overridden per upstream, e.g.
+RETRY_OPENAI_CHAT_MAX_ATTEMPTS or BREAKER_LULU_COOL_DOWN_SECONDS.
+
+`hedge(name).call(fn, *args)` hedges an idempotent coroutine against tail
+latency. If `fn` is still running after the HEDGE_PERCENTILE of the latencies
+seen so far for `name`, it is started a second time. Whichever finishes first
+wins, and the other is cancelled. Hedges are capped by a budget like the retry
+budget: HEDGE_BUDGET_RATIO of the calls, plus HEDGE_BUDGET_MINIMUM, per
+HEDGE_BUDGET_WINDOW_SECONDS. No call is hedged until HEDGE_MIN_SAMPLES latencies
+have been seen.
+
+Metrics (see book_metrics) per upstream: `<name>_retries`, `<name>_breaker_opened`
+and `<name>_breaker_rejected`; per hedge: `<name>_hedges` and `<name>_hedge_wins`.
+OpenAI's 429s are also reported to capacity_ledger.
+"""
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import book_metrics
+import capacity_ledger
+
+# Multiplies our own waits and cool-downs (Retry-After is taken as given); the offline
+# harness shrinks them along with its fakes' latencies.
+RESILIENCE_TIME_SCALE = float(os.environ.get('RESILIENCE_TIME_SCALE', '1.0'))
+
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Statuses that mean the request was not acted on, so even a non-idempotent call may be repeated.
+NOT_PROCESSED_STATUSES = {429, 503}
+# Exception class names (anywhere in the MRO) of openai, httpx and requests errors that are worth retrying.
+RETRYABLE_ERRORS = {
+    'APIConnectionError', 'APITimeoutError', 'ConnectionError', 'Timeout', 'TimeoutException',
+    'TransportError', 'ChunkedEncodingError', 'RemoteProtocolError',
+}
+# Errors raised before the request reached the upstream.
+NOT_SENT_ERRORS = {'ConnectTimeout', 'ConnectError'}
+
+
+class UpstreamUnavailable(Exception):
+    """The upstream cannot take this call now. The state machine retries it later instead of failing the book."""
+
+
+def _setting(name, upstream_name, default):
+    key = upstream_name.upper().replace('.', '_')
+    return float(os.environ.get(f"{name.replace('*', key)}", os.environ.get(name.replace('*_', ''), default)))
+
+
+def _error_names(exc):
+    return {cls.__name__ for cls in type(exc).__mro__}
+
+
+def status_of(exc):
+    """The HTTP status of an openai or requests error, if it had a response."""
+    status = getattr(exc, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return status
+
+
+def retry_after(exc):
+    """The wait, in seconds, an error response asked for in Retry-After(-ms), or None."""
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retryable(exc, idempotent=True):
+    status = status_of(exc)
+    names = _error_names(exc)
+    if not idempotent:
+        return status in NOT_PROCESSED_STATUSES or bool(names & NOT_SENT_ERRORS)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return bool(names & (RETRYABLE_ERRORS | NOT_SENT_ERRORS))
+
+
+class RetryBudget:
+    """Allows retries up to `ratio` of the calls, plus `minimum`, in a sliding window."""
+
+    def __init__(self, ratio, minimum, window_seconds):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window_seconds = window_seconds
+        self.calls = deque()
+        self.retries = deque()
+        self.lock = threading.Lock()
+
+    def _trim(self, now):
+        for events in (self.calls, self.retries):
+            while events and events[0] < now - self.window_seconds:
+                events.popleft()
+
+    def record_call(self):
+        with self.lock:
+            self.calls.append(time.monotonic())
+
+    def try_spend(self):
+        """Takes one retry from the budget, or returns False if there is none left."""
+        with self.lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self.retries) >= self.minimum + self.ratio * len(self.calls):
+                return False
+            self.retries.append(now)
+            return True
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures; lets one probe through every `cool_down_seconds`."""
+
+    def __init__(self, failure_threshold, cool_down_seconds):
+        self.failure_threshold = failure_threshold
+        self.cool_down_seconds = cool_down_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.probing or time.monotonic() - self.opened_at < self.cool_down_seconds:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        """The state a call is let through in ('half_open' makes it the probe), or None while the breaker is open."""
+        with self.lock:
+            state = self.state
+            if state == 'half_open':
+                self.probing = True
+            return None if state == 'open' else state
+
+    def abandon_probe(self):
+        """The probe ended without an answer (it was cancelled); the next call probes instead."""
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        """Counts a failure; returns True if it opened (or re-opened) the breaker."""
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.probing = False
+                return True
+            return False
+
+
+class Upstream:
+    """Retry policy, retry budget and circuit breaker for one upstream."""
+
+    def __init__(self, name):
+        self.name = name
+        self.metric = name.replace('.', '_')
+        self.max_attempts = int(_setting('RETRY_*_MAX_ATTEMPTS', name, '4'))
+        self.base_delay = _setting('RETRY_*_BASE_DELAY_SECONDS', name, '0.5') * RESILIENCE_TIME_SCALE
+        self.max_delay = _setting('RETRY_*_MAX_DELAY_SECONDS', name, '20') * RESILIENCE_TIME_SCALE
+        self.budget = RetryBudget(
+            ratio=_setting('RETRY_*_BUDGET_RATIO', name, '0.2'),
+            minimum=_setting('RETRY_*_BUDGET_MINIMUM', name, '10'),
+            window_seconds=_setting('RETRY_*_BUDGET_WINDOW_SECONDS', name, '60'),
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(_setting('BREAKER_*_FAILURE_THRESHOLD', name, '5')),
+            cool_down_seconds=_setting('BREAKER_*_COOL_DOWN_SECONDS', name, '30') * RESILIENCE_TIME_SCALE,
+        )
+
+    def _admit(self):
+        """Lets a call through, or raises while the breaker is open; returns whether the call is the breaker's probe."""
+        state = self.breaker.allow()
+        if state is None:
+            book_metrics.count(f"{self.metric}_breaker_rejected")
+            raise UpstreamUnavailable(f"{self.name} circuit breaker is open; failing fast")
+        self.budget.record_call()
+        return state == 'half_open'
+
+    def _record_failure(self, exc):
+        if self.breaker.record_failure():
+            book_metrics.count(f"{self.metric}_breaker_opened")
+            print(f"WARNING: {self.name} circuit breaker opened after {self.breaker.failures} consecutive failures: {exc}")
+
+    def _next_delay(self, exc, attempt, previous_delay, idempotent, probe=False):
+        """
+        How long to wait before retrying after `exc`; raises if the call should not be retried.
+        `probe` says the call was the breaker's half-open probe.
+        """
+        status = status_of(exc)
+        if status is not None and 400 <= status < 500 and status != 429:
+            # The upstream answered; it is the request that is wrong.
+            self.breaker.record_success()
+        elif status is not None or _error_names(exc) & (RETRYABLE_ERRORS | NOT_SENT_ERRORS):
+            # A 429, a 5xx or no answer at all: the upstream is struggling, whether or not this call may be retried.
+            self._record_failure(exc)
+        elif probe:
+            # Something else went wrong (a malformed response, a bug); it says nothing about the upstream,
+            # but the probe is over, so the next call probes instead.
+            self.breaker.abandon_probe()
+        if not retryable(exc, idempotent):
+            raise exc
+        if status == 429 and self.name.startswith('openai'):
+            # Out of quota: tell start_execution to start new books more slowly.
+            capacity_ledger.report_throttled()
+        if attempt >= self.max_attempts:
+            raise UpstreamUnavailable(f"{self.name} still failing after {attempt} attempts: {exc}") from exc
+        wanted = retry_after(exc)
+        if wanted is not None and wanted > self.max_delay:
+            raise UpstreamUnavailable(f"{self.name} asked us to wait {wanted:.0f}s: {exc}") from exc
+        if not self.budget.try_spend():
+            raise UpstreamUnavailable(f"{self.name} retry budget exhausted: {exc}") from exc
+        # Decorrelated jitter: each wait is drawn from [base, 3 x the previous one], capped.
+        delay = min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3)))
+        if wanted is not None:
+            delay = max(delay, wanted)
+        book_metrics.count(f"{self.metric}_retries")
+        print(f"Retrying {self.name} in {delay:.2f}s (attempt {attempt + 1} of {self.max_attempts}): {exc}")
+        return delay
+
+    def call(self, fn, *args, idempotent=True, **kwargs):
+        """Calls `fn(*args, **kwargs)` under this upstream's policy. Pass idempotent=False for calls that must not run twice."""
+        delay = self.base_delay
+        for attempt in range(1, self.max_attempts + 1):
+            probe = self._admit()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(e, attempt, delay, idempotent, probe)
+                time.sleep(delay)
+                continue
+            except BaseException:
+                if probe:
+                    self.breaker.abandon_probe()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, fn, *args, idempotent=True, **kwargs):
+        """`call` for a coroutine function."""
+        delay = self.base_delay
+        for attempt in range(1, self.max_attempts + 1):
+            probe = self._admit()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(e, attempt, delay, idempotent, probe)
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # A hedge's losing leg is cancelled on purpose; it must not keep the breaker's probe.
+                if probe:
+                    self.breaker.abandon_probe()
+                raise
+            self.breaker.record_success()
+            return result
+
+
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def upstream(name):
+    """The container-wide policy for `name` (e.g. "openai.chat", "astrologyapi", "lulu")."""
+    with _upstreams_lock:
+        if name not in _upstreams:
+            _upstreams[name] = Upstream(name)
+        return _upstreams[name]
+
+
+class Hedge:
+    """Latencies seen for one kind of call, and the budget for hedging it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.metric = name.replace('.', '_')
+        self.percentile = _setting('HEDGE_*_PERCENTILE', name, '95')
+        self.min_samples = int(_setting('HEDGE_*_MIN_SAMPLES', name, '20'))
+        self.latencies = deque(maxlen=int(_setting('HEDGE_*_SAMPLES', name, '200')))
+        self.budget = RetryBudget(
+            ratio=_setting('HEDGE_*_BUDGET_RATIO', name, '0.05'),
+            minimum=_setting('HEDGE_*_BUDGET_MINIMUM', name, '1'),
+            window_seconds=_setting('HEDGE_*_BUDGET_WINDOW_SECONDS', name, '60'),
+        )
+
+    def delay(self):
+        """How long a call may run before it is hedged, or None while too few latencies have been seen."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(self.percentile / 100 * len(ordered)) - 1))]
+
+    async def call(self, fn, *args, on_hedge=None, **kwargs):
+        """Awaits `fn(*args, **kwargs)`, starting it a second time if it is slow. `on_hedge()` is called when it is."""
+        self.budget.record_call()
+        delay = self.delay()
+        started = time.monotonic()
+        primary = asyncio.ensure_future(fn(*args, **kwargs))
+        tasks = {primary: started}
+        try:
+            if delay is not None:
+                await asyncio.wait({primary}, timeout=delay)
+                if not primary.done() and self.budget.try_spend():
+                    book_metrics.count(f"{self.metric}_hedges")
+                    print(f"Hedging {self.name}: still running after {delay:.2f}s (p{self.percentile:g})")
+                    if on_hedge:
+                        on_hedge()
+                    tasks[asyncio.ensure_future(fn(*args, **kwargs))] = time.monotonic()
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latencies.append(time.monotonic() - tasks[task])
+                        if task is not primary:
+                            book_metrics.count(f"{self.metric}_hedge_wins")
+                        return task.result()
+            # Every request failed; the primary's error is the one to report.
+            return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # A loser's error is expected; do not let asyncio log it as never retrieved.
+
+
+_hedges = {}
+
+
+def hedge(name):
+    """The container-wide hedging state for `name` (e.g. "openai.chat.chapter")."""
+    with _upstreams_lock:
+        if name not in _hedges:
+            _hedges[name] = Hedge(name)
+        return _hedges[name]
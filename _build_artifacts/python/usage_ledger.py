@@ -0,0 +1,193 @@
+# FILE: _build_artifacts/python/usage_ledger.py
+"""
+OpenAI usage ledger for the order pipeline's Lambdas, shipped in the shared layer.
+
+Every OpenAI call is made inside `call(stage, model, ...)`, which records one entry:
+prompt and completion tokens (from `response.usage`) or the number of images, the
+call's duration, and who it was for: order, line item, tier, stage and chapter.
+`ledgered_handler` collects an invocation's entries and writes them as one JSON
+document next to the book's artifacts, s3://USAGE_BUCKET/usage/<order_id>/, or
+under USAGE_DIR when that is set. `summarize` turns any number of those documents
+into per-tier aggregates; offline/usage_report.py prints them.
+
+A book's tier is the word count ordered for it ("15k", "30k" or "50k"), which
+order_ingestion reads from the line item and every stage gets in its payload.
+Entries without one take the tier of the book they were for when aggregated.
+
+The ledger never fails an invocation: if it cannot be written, that is printed
+and the handler's result stands.
+"""
+import functools
+import json
+import os
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+USAGE_BUCKET = os.environ.get('USAGE_BUCKET')
+USAGE_PREFIX = os.environ.get('USAGE_PREFIX', 'usage')
+# Written here instead of S3 when set (the offline harness sets it).
+USAGE_DIR = os.environ.get('USAGE_DIR')
+
+# USD per 1K tokens, and per image by size. Only used to estimate cost when
+# summarising; override with OPENAI_PRICES (the same shape, as JSON).
+PRICES = {
+    "gpt-4-1106-preview": {"prompt": 0.01, "completion": 0.03},
+    "gpt-4-turbo-preview": {"prompt": 0.01, "completion": 0.03},
+    "dall-e-3": {"1024x1024": 0.04, "1024x1792": 0.08, "1792x1024": 0.08},
+}
+PRICES.update(json.loads(os.environ.get('OPENAI_PRICES', '{}')))
+
+# The invocation's entries, and who the calls made now are for.
+_ledger = ContextVar('usage_ledger_entries', default=None)
+_attribution = ContextVar('usage_ledger_attribution', default={})
+
+_upload_client = None
+
+
+@contextmanager
+def attribute(**fields):
+    """Attributes the calls made in the enclosed block to these fields (order_id, line_item_id, tier, chapter, ...)."""
+    token = _attribution.set({**_attribution.get(), **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _attribution.reset(token)
+
+
+def tokens(response):
+    """The token counts of a chat completion, for `entry.update(...)`."""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return {}
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+
+@contextmanager
+def call(stage, model, **fields):
+    """
+    Records the OpenAI call made in the enclosed block. Yields the entry, so the
+    caller can add what the response reports: `entry.update(tokens(response))` for a
+    chat completion, `entry["images"] = len(response.data)` for an image. A call that
+    raises is recorded with its error. Outside a ledgered invocation it does nothing.
+    """
+    entries = _ledger.get()
+    if entries is None:
+        yield {}
+        return
+    entry = {
+        **_attribution.get(), "stage": stage, "model": model, **fields,
+        "prompt_tokens": 0, "completion_tokens": 0, "images": 0,
+        "at": datetime.now(timezone.utc).isoformat(),
+    }
+    started = time.perf_counter()
+    try:
+        yield entry
+    except BaseException as e:
+        entry["error"] = type(e).__name__
+        raise
+    finally:
+        entry["seconds"] = round(time.perf_counter() - started, 3)
+        entries.append(entry)
+
+
+def _write(document):
+    global _upload_client
+    key = f"{USAGE_PREFIX}/{document['order_id'] or 'unknown'}/{document['started_at']}-{document['stage']}-{document['request_id']}.json"
+    body = json.dumps(document, default=str)
+    if USAGE_DIR:
+        path = os.path.join(USAGE_DIR, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(body)
+        return path
+    if not USAGE_BUCKET:
+        return None
+    if _upload_client is None:
+        import boto3
+        _upload_client = boto3.client('s3')
+    _upload_client.put_object(Bucket=USAGE_BUCKET, Key=key, Body=body, ContentType='application/json')
+    return f"s3://{USAGE_BUCKET}/{key}"
+
+
+def ledgered_handler(stage):
+    """Decorates a lambda_handler so the OpenAI calls of each invocation are written to the ledger."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            payload = event.get('Payload', event) if isinstance(event, dict) else {}
+            payload = payload if isinstance(payload, dict) else {}
+            entries = []
+            entries_token = _ledger.set(entries)
+            attribution_token = _attribution.set({
+                key: payload[key] for key in ('order_id', 'line_item_id', 'tier') if payload.get(key) is not None
+            })
+            started_at = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+            try:
+                return handler(event, context)
+            finally:
+                _attribution.reset(attribution_token)
+                _ledger.reset(entries_token)
+                if entries:
+                    document = {
+                        "stage": stage,
+                        "request_id": getattr(context, 'aws_request_id', None) or uuid.uuid4().hex,
+                        "order_id": payload.get('order_id') or entries[0].get('order_id'),
+                        "started_at": started_at,
+                        "entries": entries,
+                    }
+                    try:
+                        location = _write(document)
+                        if location:
+                            print(f"Usage: {len(entries)} OpenAI call(s) from {stage} written to {location}")
+                    except Exception as e:
+                        print(f"WARNING: could not write the usage ledger for {stage}: {e}")
+        return wrapper
+    return decorate
+
+
+def cost(entry):
+    """The estimated USD cost of one entry, or 0.0 for a model missing from PRICES."""
+    prices = PRICES.get(entry.get("model"), {})
+    if entry.get("images"):
+        return entry["images"] * prices.get(entry.get("size"), 0.0)
+    return (entry.get("prompt_tokens", 0) * prices.get("prompt", 0.0) + entry.get("completion_tokens", 0) * prices.get("completion", 0.0)) / 1000
+
+
+def summarize(entries):
+    """
+    Per-tier aggregates of ledger entries: the number of books, and per stage the
+    calls, errors, tokens, images and estimated cost, in total and per book.
+    """
+    books = defaultdict(list)
+    for entry in entries:
+        books[(entry.get("order_id"), entry.get("line_item_id"))].append(entry)
+    tiers = {}
+    for book_entries in books.values():
+        tier = next((str(entry["tier"]) for entry in book_entries if entry.get("tier") is not None), "unknown")
+        summary = tiers.setdefault(tier, {"books": 0, "stages": {}, "total": {}})
+        summary["books"] += 1
+        for entry in book_entries:
+            for totals in (summary["stages"].setdefault(entry["stage"], {}), summary["total"]):
+                for field, value in (("calls", 1), ("errors", 1 if entry.get("error") else 0), ("prompt_tokens", entry.get("prompt_tokens", 0)),
+                                     ("completion_tokens", entry.get("completion_tokens", 0)), ("images", entry.get("images", 0)), ("cost", cost(entry))):
+                    totals[field] = totals.get(field, 0) + value
+    for summary in tiers.values():
+        for totals in list(summary["stages"].values()) + [summary["total"]]:
+            totals["cost"] = round(totals["cost"], 4)
+            totals["per_book"] = {field: round(totals[field] / summary["books"], 4 if field == "cost" else 1)
+                                  for field in ("calls", "prompt_tokens", "completion_tokens", "images", "cost")}
+    return tiers
+
+
+def print_summary(tiers):
+    for tier, summary in sorted(tiers.items()):
+        print(f"\nTier {tier}: {summary['books']} book(s), ${summary['total']['cost']:.2f} (${summary['total']['per_book']['cost']:.4f} per book)")
+        print(f"  {'stage':<14} {'calls':>7} {'errors':>7} {'prompt/book':>12} {'compl./book':>12} {'images/book':>12} {'$/book':>9}")
+        for stage, totals in sorted(summary["stages"].items(), key=lambda item: -item[1]["cost"]):
+            per_book = totals["per_book"]
+            print(f"  {stage:<14} {totals['calls']:>7} {totals['errors']:>7} {per_book['prompt_tokens']:>12} "
+                  f"{per_book['completion_tokens']:>12} {per_book['images']:>12} {per_book['cost']:>9.4f}")
@@ -0,0 +1,146 @@
+# app/artifact_store.py
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# Total bytes of generated PDFs and images kept on disk before the oldest are evicted.
+ARTIFACT_BUDGET_BYTES = int(os.getenv("ARTIFACT_BUDGET_BYTES", str(5 * 1024 ** 3)))
+# Artifacts nobody has downloaded for this long are evicted even when under budget.
+ARTIFACT_MAX_AGE_SECONDS = float(os.getenv("ARTIFACT_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access);
+"""
+
+
+def _file_etag(path: str) -> str:
+    """A strong ETag: the content hash, so it only changes when the bytes do."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+class ArtifactStore:
+    """
+    Tracks the PDFs and images the generator writes to disk and keeps them
+    within a byte budget, evicting the least recently used (and anything
+    past its maximum age) first.
+
+    The index lives in the job database so eviction can see which files are
+    still referenced by queued or running jobs; those are never evicted.
+    """
+
+    def __init__(self, db_path: str, budget_bytes: int = ARTIFACT_BUDGET_BYTES,
+                 max_age_seconds: float = ARTIFACT_MAX_AGE_SECONDS):
+        self.db_path = db_path
+        self.budget_bytes = budget_bytes
+        self.max_age_seconds = max_age_seconds
+        # Built at import time, possibly before the job store has created the directory.
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout=30000")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def register(self, path: str, kind: str) -> dict:
+        """Indexes a freshly written file and makes room for it if the budget is exceeded."""
+        path = os.path.abspath(path)
+        now = time.time()
+        record = {"path": path, "kind": kind, "size": os.path.getsize(path), "etag": _file_etag(path),
+                  "created_at": now, "last_access": now}
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO artifacts (path, kind, size, etag, created_at, last_access) "
+                "VALUES (:path, :kind, :size, :etag, :created_at, :last_access)",
+                record,
+            )
+        self.evict()
+        return record
+
+    def lookup(self, path: str, kind: str) -> Optional[dict]:
+        """
+        Returns the index entry for a file and marks it as recently used.
+        Files written before the store existed are indexed on first access.
+        """
+        path = os.path.abspath(path)
+        if not os.path.isfile(path):
+            self.forget(path)
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM artifacts WHERE path = ?", (path,)).fetchone()
+            if row is not None and row["size"] == os.path.getsize(path):
+                conn.execute("UPDATE artifacts SET last_access = ? WHERE path = ?", (time.time(), path))
+                return dict(row)
+        return self.register(path, kind)
+
+    def forget(self, path: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM artifacts WHERE path = ?", (os.path.abspath(path),))
+
+    def _protected_paths(self, conn) -> set:
+        # Artifacts recorded against jobs that are still queued or running (see JobStore).
+        try:
+            rows = conn.execute(
+                "SELECT a.path FROM job_artifacts AS a JOIN jobs AS j ON j.id = a.job_id "
+                "WHERE j.status IN ('queued', 'running')"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return set()
+        return {os.path.abspath(row["path"]) for row in rows}
+
+    def usage(self) -> dict:
+        with self._connect() as conn:
+            row = conn.execute("SELECT COUNT(*) AS count, COALESCE(SUM(size), 0) AS bytes FROM artifacts").fetchone()
+        return {"count": row["count"], "bytes": row["bytes"], "budget_bytes": self.budget_bytes}
+
+    def evict(self) -> list:
+        """
+        Deletes expired artifacts, then least recently used ones until the total
+        fits the budget. Returns the paths that were removed.
+        """
+        now = time.time()
+        evicted = []
+        with self._connect() as conn:
+            protected = self._protected_paths(conn)
+            rows = conn.execute("SELECT path, size, last_access FROM artifacts ORDER BY last_access").fetchall()
+            total = sum(row["size"] for row in rows)
+            for row in rows:
+                expired = now - row["last_access"] > self.max_age_seconds
+                if not expired and total <= self.budget_bytes:
+                    break
+                if row["path"] in protected:
+                    continue
+                try:
+                    os.remove(row["path"])
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Could not evict artifact {row['path']}: {e}")
+                    continue
+                conn.execute("DELETE FROM artifacts WHERE path = ?", (row["path"],))
+                total -= row["size"]
+                evicted.append(row["path"])
+        if evicted:
+            print(f"Evicted {len(evicted)} artifact(s); {total} bytes remain of a {self.budget_bytes} byte budget.")
+        return evicted
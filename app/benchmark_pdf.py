@@ -0,0 +1,212 @@
+# app/benchmark_pdf.py
+"""
+Benchmarks `save_book_as_pdf` on deterministic synthetic books.
+
+    python -m app.benchmark_pdf                                  # every case, compared to the baseline
+    python -m app.benchmark_pdf --tiers 50k --images on          # a subset
+    python -m app.benchmark_pdf --save-baseline                  # record the current results as the baseline
+
+Cases cover the 15k/30k/50k tiers, with and without chapter images and debug
+pages. Each case runs in a fresh process, so its peak RSS is its own, and
+records the wall time of each pass, peak RSS, page count and PDF size. The
+report is written as JSON and compared with the baseline; any regression past
+the thresholds below is printed and the command exits with status 1.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timezone
+
+from app.synthetic_books import BOOK_TIERS, make_book, write_sample_image
+
+BENCHMARK_DIR = os.getenv("BENCHMARK_DIR", "benchmarks")
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "render_baseline.json")
+SAMPLE_IMAGE_PATH = os.path.abspath(os.path.join("generated_jobs", "benchmark", "sample_image.png"))
+DEFAULT_TITLE = "The Architecture of You"
+
+# How far a case may move past the baseline before it counts as a regression.
+MAX_TIME_REGRESSION = float(os.getenv("BENCH_MAX_TIME_REGRESSION", "0.20"))
+MAX_RSS_REGRESSION = float(os.getenv("BENCH_MAX_RSS_REGRESSION", "0.15"))
+MAX_SIZE_REGRESSION = float(os.getenv("BENCH_MAX_SIZE_REGRESSION", "0.10"))
+# Wall times below this are too noisy to compare as ratios.
+MIN_COMPARABLE_SECONDS = 1.0
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _run_case(conn, case: dict):
+    """Entry point of a benchmark process: renders one synthetic book and reports what it measured."""
+    try:
+        # A fresh hyphenation memo per case, so no case benefits from the ones before it.
+        memo_dir = tempfile.mkdtemp(prefix="bench-memo-")
+        os.environ["HYPHENATION_MEMO_PATH"] = os.path.join(memo_dir, "hyphenation.json")
+        from app.book_pdf_exporter import save_book_as_pdf, warm_up
+
+        started = time.perf_counter()
+        warm_up()
+        result = {"warm_up_seconds": round(time.perf_counter() - started, 3), "rss_after_warm_up_mb": _peak_rss_mb()}
+        book_data = make_book(case["words"], image_path=SAMPLE_IMAGE_PATH if case["images"] else None, debug_pages=case["debug_pages"])
+
+        def on_event(event: str, data: dict):
+            if event == "render_pass_done":
+                result[f"pass{data['render_pass']}_seconds"] = data["seconds"]
+                result[f"peak_rss_after_pass{data['render_pass']}_mb"] = _peak_rss_mb()
+                if data["render_pass"] == 1:
+                    result["pages"] = data["pages"]
+            elif event == "pdf_ready":
+                result["pdf_bytes"] = data["bytes"]
+
+        started = time.perf_counter()
+        path = save_book_as_pdf(DEFAULT_TITLE, book_data, f"benchmark-{case['name']}.pdf", on_event=on_event)
+        result["total_seconds"] = round(time.perf_counter() - started, 3)
+        result["peak_rss_mb"] = _peak_rss_mb()
+        os.remove(path)
+        shutil.rmtree(memo_dir, ignore_errors=True)
+        conn.send(("done", result))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def run_case(case: dict) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    reader, writer = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_case, args=(writer, case), name=f"bench-{case['name']}")
+    process.start()
+    writer.close()
+    try:
+        message = reader.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError(f"Benchmark process for {case['name']} died (exit code {process.exitcode})")
+    process.join()
+    if message[0] == "error":
+        print(message[2])
+        raise RuntimeError(message[1])
+    return message[1]
+
+
+def build_cases(tiers: list, images: list, debug_pages: list) -> list:
+    cases = []
+    for tier, with_images, with_debug in itertools.product(tiers, images, debug_pages):
+        name = f"{tier}-{'images' if with_images else 'text'}-{'debug' if with_debug else 'nodebug'}"
+        cases.append({"name": name, "tier": tier, "words": BOOK_TIERS[tier], "images": with_images, "debug_pages": with_debug})
+    return cases
+
+
+def summarise(runs: list) -> dict:
+    """Median of each measurement over the repeats; page counts must not vary at all."""
+    summary = {}
+    for key in runs[0]:
+        values = [run[key] for run in runs if key in run]
+        summary[key] = values[0] if key == "pages" else round(statistics.median(values), 3)
+    if len({run.get("pages") for run in runs}) > 1:
+        summary["pages_varied"] = sorted({run.get("pages") for run in runs})
+    return summary
+
+
+def compare(report: dict, baseline: dict) -> list:
+    """Regressions of `report` against `baseline`, as human-readable lines."""
+    regressions = []
+    for name, result in report["cases"].items():
+        base = baseline.get("cases", {}).get(name)
+        if not base:
+            continue
+        if result.get("pages") != base.get("pages"):
+            regressions.append(f"{name}: page count changed from {base.get('pages')} to {result.get('pages')}")
+        if "pages_varied" in result:
+            regressions.append(f"{name}: page count varied between runs: {result['pages_varied']}")
+        checks = [(key, MAX_TIME_REGRESSION) for key in ("pass1_seconds", "pass2_seconds", "total_seconds")]
+        checks += [("peak_rss_mb", MAX_RSS_REGRESSION), ("pdf_bytes", MAX_SIZE_REGRESSION)]
+        for key, allowed in checks:
+            if key not in result or not base.get(key):
+                continue
+            if key.endswith("_seconds") and base[key] < MIN_COMPARABLE_SECONDS:
+                continue
+            change = result[key] / base[key] - 1
+            if change > allowed:
+                regressions.append(f"{name}: {key} {base[key]} -> {result[key]} (+{change:.0%}, allowed +{allowed:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tiers", nargs="+", default=list(BOOK_TIERS), choices=list(BOOK_TIERS))
+    parser.add_argument("--images", choices=["on", "off", "both"], default="both")
+    parser.add_argument("--debug-pages", choices=["on", "off", "both"], default="both")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case; the median is reported")
+    parser.add_argument("--out", default=os.path.join(BENCHMARK_DIR, "render_report.json"))
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="write this run's results to --baseline")
+    args = parser.parse_args()
+
+    def variants(choice: str) -> list:
+        return {"on": [True], "off": [False], "both": [False, True]}[choice]
+
+    cases = build_cases(args.tiers, variants(args.images), variants(args.debug_pages))
+    if any(case["images"] for case in cases):
+        write_sample_image(SAMPLE_IMAGE_PATH)
+
+    try:
+        import weasyprint
+        weasyprint_version = weasyprint.__version__
+    except Exception:
+        weasyprint_version = None
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "weasyprint": weasyprint_version,
+        "machine": {"platform": platform.platform(), "cpus": os.cpu_count()},
+        "cases": {},
+    }
+
+    print(f"{'case':<24} {'pass 1 s':>9} {'pass 2 s':>9} {'total s':>8} {'peak MB':>8} {'pages':>6} {'PDF MB':>7}")
+    for case in cases:
+        result = summarise([run_case(case) for _ in range(args.repeat)])
+        report["cases"][case["name"]] = result
+        print(f"{case['name']:<24} {result.get('pass1_seconds', 0):>9.2f} {result.get('pass2_seconds', 0):>9.2f} "
+              f"{result['total_seconds']:>8.2f} {result['peak_rss_mb']:>8.0f} {result.get('pages', 0):>6} "
+              f"{result.get('pdf_bytes', 0) / 1024 ** 2:>7.1f}")
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {args.out}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one.")
+        return
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline)
+    if regressions:
+        print(f"\nRENDER REGRESSIONS against {args.baseline}:")
+        for line in regressions:
+            print(f"  - {line}")
+        sys.exit(1)
+    print(f"No regressions against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
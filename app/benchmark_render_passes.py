@@ -0,0 +1,122 @@
+# app/benchmark_render_passes.py
+"""
+Measures how much of a book's layout time the hyphenation memo and the pass 2
+reuse of pass 1's body pages save.
+
+    python -m app.benchmark_render_passes                 # synthetic 30k and 50k books
+    python -m app.benchmark_render_passes --tiers 15k 30k 50k --out bench.json
+
+For each book this times, in one process:
+  - pass 1 with pyphen's caches empty (a fresh worker or Lambda container),
+  - pass 1 again with the memo warm (a re-render of the same book),
+  - pass 2 as it used to be, laying out the whole book again,
+  - pass 2 as it is now, laying out only the front matter.
+Writing the PDF is the same either way and is not timed.
+"""
+import argparse
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pyphen
+from weasyprint import HTML
+
+from app.book_pdf_exporter import BASE_URL, BOOK_LANGUAGE, BOOK_TEMPLATE, front_matter_page_count, get_stylesheet, toc_entries, warm_up
+from app.synthetic_books import BOOK_TIERS, make_book
+
+DEFAULT_TITLE = "The Architecture of You"
+
+
+@contextmanager
+def _lookup_timer(totals: dict):
+    """Adds the time spent in pyphen's dictionary lookups to totals["lookup_seconds"]."""
+    positions = pyphen.HyphDict.positions
+
+    def timed(self, word):
+        started = time.perf_counter()
+        try:
+            return positions(self, word)
+        finally:
+            totals["lookup_seconds"] += time.perf_counter() - started
+            totals["lookups"] += 1
+
+    pyphen.HyphDict.positions = timed
+    try:
+        yield totals
+    finally:
+        pyphen.HyphDict.positions = positions
+
+
+def _layout(context: dict):
+    css, font_config = get_stylesheet()
+    started = time.perf_counter()
+    doc = HTML(string=BOOK_TEMPLATE.render(context), base_url=BASE_URL).render(stylesheets=[css], font_config=font_config)
+    return doc, time.perf_counter() - started
+
+
+def _timed_layout(context: dict):
+    with _lookup_timer({"lookup_seconds": 0.0, "lookups": 0}) as totals:
+        doc, seconds = _layout(context)
+    return doc, {"seconds": round(seconds, 3), "lookup_seconds": round(totals["lookup_seconds"], 3), "lookups": totals["lookups"]}
+
+
+def bench_book(title: str, book_data: dict) -> dict:
+    entries = toc_entries(book_data)
+    context = {"page_map": None, "toc_entries": entries, **book_data, "book_title": title, "book_language": BOOK_LANGUAGE,
+               "print_date": datetime.now().strftime("%B %d, %Y")}
+
+    for hd in pyphen.hdcache.values():
+        hd.cache.clear()
+    doc, cold = _timed_layout(context)
+    doc, warm = _timed_layout(context)
+
+    page_map = {entry["href"]: 1 for entry in entries}
+    final_context = {**context, "page_map": page_map}
+    _, full_pass2 = _timed_layout(final_context)
+    front, front_pass2 = _timed_layout({**final_context, "front_matter_only": True})
+    reusable = len(front.pages) == front_matter_page_count(doc)
+
+    before = cold["seconds"] + full_pass2["seconds"]
+    after_cold = cold["seconds"] + front_pass2["seconds"]
+    after_warm = warm["seconds"] + front_pass2["seconds"]
+    return {
+        "pages": len(doc.pages),
+        "pass1_cold": cold,
+        "pass1_warm": warm,
+        "pass2_full": full_pass2,
+        "pass2_front_matter": front_pass2,
+        "front_matter_reused": reusable,
+        "layout_seconds_before": round(before, 3),
+        "layout_seconds_after": round(after_cold, 3),
+        "layout_seconds_after_warm_memo": round(after_warm, 3),
+        "share_removed": round(1 - after_cold / before, 3) if before else 0.0,
+        "share_removed_warm_memo": round(1 - after_warm / before, 3) if before else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tiers", nargs="+", default=["30k", "50k"], choices=list(BOOK_TIERS))
+    parser.add_argument("--out", help="also write the results here as JSON")
+    args = parser.parse_args()
+
+    warm_up()
+    results = {}
+    print(f"{'tier':<5} {'pages':>5} {'before s':>9} {'after s':>8} {'removed':>8} {'warm memo':>10} {'lookups s':>10}")
+    for tier in args.tiers:
+        result = bench_book(DEFAULT_TITLE, make_book(BOOK_TIERS[tier]))
+        results[tier] = result
+        print(f"{tier:<5} {result['pages']:>5} {result['layout_seconds_before']:>9.2f} {result['layout_seconds_after']:>8.2f} "
+              f"{result['share_removed']:>8.1%} {result['share_removed_warm_memo']:>10.1%} "
+              f"{result['pass1_cold']['lookup_seconds']:>5.2f}->{result['pass1_warm']['lookup_seconds']:.2f}")
+        if not result["front_matter_reused"]:
+            print(f"WARNING: the {tier} book's front matter changed length in pass 2, so it would be rendered in full.")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
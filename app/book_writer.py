@@ -1,11 +1,10 @@
 # app/book_writer.py 
-from openai import AsyncOpenAI 
 import os
 import asyncio
 import json
 import random
 import string
-import httpx
+from typing import Callable, Optional
 from app.prompt_builder import (
     build_book_structure_prompt,
     build_prologue_prompt,
@@ -13,11 +12,12 @@ from app.prompt_builder import (
     build_summarization_prompt,
     build_safe_image_prompt_generation_prompt
 )
+from app.http_clients import get_openai_client, get_image_download_client
+from app import usage_ledger
 from dotenv import load_dotenv
 
 load_dotenv()
 
-openai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 MODEL_TEXT = "gpt-4-1106-preview"
 MODEL_IMAGE = "dall-e-3"
 # We no longer use WORDS_PER_SECTION_TARGET as the chapter sizes are now dynamic
@@ -29,24 +29,27 @@ async def generate_chapter_image(chapter_summary: str) -> str:
     print(f"  - Generating image based on summary: '{chapter_summary[:80]}...'")
     safe_prompt_request = build_safe_image_prompt_generation_prompt(chapter_summary)
     try:
-        sanitized_prompt_response = await openai.chat.completions.create(
-            model=MODEL_TEXT, messages=[{"role": "user", "content": safe_prompt_request}], 
-            temperature=0.7, max_tokens=300
-        )
+        with usage_ledger.call("image_prompt", MODEL_TEXT, prompt_chars=len(safe_prompt_request)) as usage:
+            sanitized_prompt_response = await get_openai_client().chat.completions.create(
+                model=MODEL_TEXT, messages=[{"role": "user", "content": safe_prompt_request}], 
+                temperature=0.7, max_tokens=300
+            )
+            usage.update(usage_ledger.tokens(sanitized_prompt_response))
         image_prompt = sanitized_prompt_response.choices[0].message.content.strip().strip('"')
         print(f"    - Sanitized DALL-E Prompt: {image_prompt}")
-        response = await openai.images.generate(
-            model=MODEL_IMAGE, prompt=image_prompt, size="1024x1792", quality="standard", n=1
-        )
+        with usage_ledger.call("image", MODEL_IMAGE, size="1024x1792", prompt_chars=len(image_prompt)) as usage:
+            response = await get_openai_client().images.generate(
+                model=MODEL_IMAGE, prompt=image_prompt, size="1024x1792", quality="standard", n=1
+            )
+            usage["images"] = len(response.data)
         image_url = response.data[0].url
         output_dir = "generated_images"
         os.makedirs(output_dir, exist_ok=True)
         image_filename = f"{''.join(random.choices(string.ascii_letters + string.digits, k=12))}.png"
         output_path = os.path.join(output_dir, image_filename)
-        async with httpx.AsyncClient() as client:
-            image_response = await client.get(image_url)
-            image_response.raise_for_status()
-            with open(output_path, "wb") as f: f.write(image_response.content)
+        image_response = await get_image_download_client().get(image_url)
+        image_response.raise_for_status()
+        with open(output_path, "wb") as f: f.write(image_response.content)
         print(f"  - Chapter image saved to: {output_path}")
         return output_path
     except Exception as e:
@@ -56,10 +59,12 @@ async def generate_chapter_image(chapter_summary: str) -> str:
 async def summarize_section(text: str) -> str:
     summary_prompt = build_summarization_prompt(text)
     try:
-        response = await openai.chat.completions.create(
-            model=MODEL_TEXT, messages=[{"role": "user", "content": summary_prompt}],
-            temperature=0.2, max_tokens=200
-        )
+        with usage_ledger.call("summary", MODEL_TEXT, prompt_chars=len(summary_prompt)) as usage:
+            response = await get_openai_client().chat.completions.create(
+                model=MODEL_TEXT, messages=[{"role": "user", "content": summary_prompt}],
+                temperature=0.2, max_tokens=200
+            )
+            usage.update(usage_ledger.tokens(response))
         return response.choices[0].message.content.strip()
     except Exception:
         return text[:300] + "..."
@@ -70,17 +75,30 @@ async def generate_content_block(prompt: str) -> str: # Simplified to just take
     print(f"  - Generating content block...")
     # This function is now simpler. The complex logic is in the prompt itself.
     # For very large word counts per chapter, you might re-introduce the sectioning logic here.
-    response = await openai.chat.completions.create(
-        model=MODEL_TEXT, messages=[{"role": "user", "content": prompt}], temperature=0.75
-    )
+    with usage_ledger.call("chapter", MODEL_TEXT, prompt_chars=len(prompt)) as usage:
+        response = await get_openai_client().chat.completions.create(
+            model=MODEL_TEXT, messages=[{"role": "user", "content": prompt}], temperature=0.75
+        )
+        usage.update(usage_ledger.tokens(response))
     return response.choices[0].message.content.strip()
 
 
-async def generate_astrology_book(natal_chart_json: dict, target_word_count: int):
+def _emit(on_event: Optional[Callable[[str, dict], None]], event: str, **data):
+    """Forwards a progress event to the caller, if it asked for them."""
+    if on_event:
+        on_event(event, data)
+
+
+async def generate_astrology_book(natal_chart_json: dict, target_word_count: int, on_event: Optional[Callable[[str, dict], None]] = None, resume_state: Optional[dict] = None):
     """
     Generates a thematically structured book by first analyzing the chart for core
     dynamics, then writing chapters based on that analysis.
+
+    `on_event(name, data)` is called as each stage finishes so callers can report progress
+    and checkpoint their work. `resume_state` takes what those events handed out earlier
+    ({"structure": [...], "chapters": [...]}) so an interrupted book skips the finished work.
     """
+    resume_state = resume_state or {}
     print("\n--- STAGE 1: ARCHITECTING THE BOOK STRUCTURE ---")
     
     # --- NEW: LOGIC TO DETERMINE EXACT CHAPTER COUNT ---
@@ -94,16 +112,22 @@ async def generate_astrology_book(natal_chart_json: dict, target_word_count: int
         
     print(f"Targeting {num_chapters} chapters for a ~{target_word_count} word book.")
 
-    # Call the Architect AI with the specific number of chapters required
-    structure_prompt = build_book_structure_prompt(natal_chart_json, num_chapters)
-    structure_response = await openai.chat.completions.create(
-        model=MODEL_TEXT,
-        messages=[{"role": "user", "content": structure_prompt}],
-        response_format={"type": "json_object"},
-        temperature=0.3 # Slightly more creative to find distinct themes
-    )
-    book_structure = json.loads(structure_response.choices[0].message.content)
-    dynamic_chapters = book_structure.get("chapters", [])
+    if resume_state.get("structure"):
+        print("Reusing the book structure from the interrupted run.")
+        dynamic_chapters = resume_state["structure"]
+    else:
+        # Call the Architect AI with the specific number of chapters required
+        structure_prompt = build_book_structure_prompt(natal_chart_json, num_chapters)
+        with usage_ledger.call("structure", MODEL_TEXT, prompt_chars=len(structure_prompt)) as usage:
+            structure_response = await get_openai_client().chat.completions.create(
+                model=MODEL_TEXT,
+                messages=[{"role": "user", "content": structure_prompt}],
+                response_format={"type": "json_object"},
+                temperature=0.3 # Slightly more creative to find distinct themes
+            )
+            usage.update(usage_ledger.tokens(structure_response))
+        book_structure = json.loads(structure_response.choices[0].message.content)
+        dynamic_chapters = book_structure.get("chapters", [])
 
     if not dynamic_chapters or len(dynamic_chapters) != num_chapters:
         raise ValueError(f"The AI Architect failed to generate the required {num_chapters} chapters. It returned {len(dynamic_chapters)}.")
@@ -111,23 +135,30 @@ async def generate_astrology_book(natal_chart_json: dict, target_word_count: int
     print(f"--- Book structure defined with {len(dynamic_chapters)} thematic chapters. ---")
     for i, chap in enumerate(dynamic_chapters):
         print(f"  Chapter {i+1}: {chap['theme_title']}")
+    _emit(on_event, "architecture_done", num_chapters=num_chapters, chapter_titles=[chap['theme_title'] for chap in dynamic_chapters], structure=dynamic_chapters)
 
     # Calculate word count per chapter based on the new, correct chapter count
     words_per_chapter = int(target_word_count / num_chapters)
     
-    chapters_data = []
+    chapters_data = list(resume_state.get("chapters", []))
     print("\n--- STAGE 2: WRITING THE CHAPTERS ---")
     for i, chapter_details in enumerate(dynamic_chapters):
+        if i < len(chapters_data):
+            print(f"\n[Chapter {i+1} was already written before the interruption, skipping.]")
+            continue
         section_title = chapter_details["theme_title"]
         print(f"\n[Generating Content for Chapter {i+1}: {section_title}]")
         
-        chapter_prompt = build_dynamic_chapter_prompt(chapter_details, natal_chart_json, words_per_chapter)
-        section_text = await generate_content_block(chapter_prompt)
-        
-        image_summary = await summarize_section(section_text)
-        image_path = await generate_chapter_image(image_summary)
+        with usage_ledger.attribute(chapter=i + 1):
+            chapter_prompt = build_dynamic_chapter_prompt(chapter_details, natal_chart_json, words_per_chapter)
+            section_text = await generate_content_block(chapter_prompt)
+            _emit(on_event, "chapter_written", index=i + 1, total=num_chapters, heading=section_title, word_count=len(section_text.split()), content=section_text)
+            
+            image_summary = await summarize_section(section_text)
+            image_path = await generate_chapter_image(image_summary)
         
         chapters_data.append({"heading": section_title, "content": section_text, "image_path": image_path})
+        _emit(on_event, "image_saved", index=i + 1, total=num_chapters, image_path=image_path, chapter=chapters_data[-1])
         await asyncio.sleep(5)
 
     print("\n--- STAGE 3: GENERATING INTRODUCTORY AND CONCLUDING TEXTS ---")
@@ -137,9 +168,11 @@ async def generate_astrology_book(natal_chart_json: dict, target_word_count: int
     print("  - Generating dynamic prologue...")
     prologue_prompt = build_prologue_prompt(natal_chart_json)
     try:
-        prologue_response = await openai.chat.completions.create(
-            model=MODEL_TEXT, messages=[{"role": "user", "content": prologue_prompt}], temperature=0.7
-        )
+        with usage_ledger.call("prologue", MODEL_TEXT, prompt_chars=len(prologue_prompt)) as usage:
+            prologue_response = await get_openai_client().chat.completions.create(
+                model=MODEL_TEXT, messages=[{"role": "user", "content": prologue_prompt}], temperature=0.7
+            )
+            usage.update(usage_ledger.tokens(prologue_response))
         intro_text = prologue_response.choices[0].message.content.strip()
     except Exception as e:
         print(f"    - Could not generate dynamic prologue, using fallback. Error: {e}")
@@ -0,0 +1,109 @@
+# app/calibrate_page_estimator.py
+"""
+Compares `estimate_pages` against real WeasyPrint layouts.
+
+    python -m app.calibrate_page_estimator                        # synthetic 15k/30k/50k books
+    python -m app.calibrate_page_estimator generated_jobs/*/book_data.json --images
+
+Each book is laid out once (the same pass 1 `save_book_as_pdf` runs) and the
+real page count and section start pages are compared with the estimate. The
+report ends with a suggested PAGE_ESTIMATE_TEXT_LINE_SCALE.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from datetime import datetime
+
+from weasyprint import HTML
+
+from app.book_pdf_exporter import BASE_URL, BOOK_LANGUAGE, BOOK_TEMPLATE, get_stylesheet, toc_entries
+from app.page_estimator import TEXT_LINE_SCALE, estimate_pages
+from app.synthetic_books import BOOK_TIERS, make_book, write_sample_image
+
+DEFAULT_TITLE = "The Architecture of You"
+SAMPLE_IMAGE_PATH = os.path.join("generated_jobs", "calibration", "sample_image.png")
+
+
+def measure(title: str, book_data: dict) -> dict:
+    """Lays the book out with WeasyPrint and reads off its page count and section start pages."""
+    entries = toc_entries(book_data)
+    css, font_config = get_stylesheet()
+    context = {"page_map": None, "toc_entries": entries, **book_data, "book_title": title, "book_language": BOOK_LANGUAGE,
+               "print_date": datetime.now().strftime("%B %d, %Y")}
+    doc = HTML(string=BOOK_TEMPLATE.render(context), base_url=BASE_URL).render(stylesheets=[css], font_config=font_config)
+
+    targets = {entry["href"][1:] for entry in entries}
+    first_content_page = next((p for p, page in enumerate(doc.pages) if targets & set(page.anchors)), 0)
+    starts = {}
+    for p, page in enumerate(doc.pages):
+        for anchor in page.anchors:
+            if anchor in targets and f"#{anchor}" not in starts:
+                starts[f"#{anchor}"] = p - first_content_page + 1
+    return {"total_pages": len(doc.pages), "body_pages": len(doc.pages) - first_content_page, "starts": starts}
+
+
+def _load_books(paths: list) -> list:
+    books = []
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if "book_data" in data:
+                books.append((path, data.get("title", DEFAULT_TITLE), data["book_data"]))
+            else:
+                books.append((path, DEFAULT_TITLE, data))
+    return books
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("books", nargs="*", help="book_data JSON files (or {title, book_data}); synthetic tiers if omitted")
+    parser.add_argument("--images", action="store_true", help="give synthetic chapters an illustration page")
+    parser.add_argument("--seeds", type=int, default=1, help="synthetic books per tier")
+    parser.add_argument("--out", help="also write the full report here as JSON")
+    args = parser.parse_args()
+
+    if args.books:
+        books = _load_books(args.books)
+    else:
+        image_path = write_sample_image(SAMPLE_IMAGE_PATH) if args.images else None
+        books = [(f"synthetic-{tier}-{seed}", DEFAULT_TITLE, make_book(words, seed=seed, image_path=image_path))
+                 for tier, words in BOOK_TIERS.items() for seed in range(args.seeds)]
+
+    rows = []
+    print(f"{'book':<32} {'est':>5} {'real':>5} {'err':>6} {'worst start':>12} {'est ms':>7} {'render s':>9}")
+    for name, title, book_data in books:
+        started = time.perf_counter()
+        estimate = estimate_pages(title, book_data)
+        estimate_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        real = measure(title, book_data)
+        render_seconds = time.perf_counter() - started
+
+        start_errors = [section["start_page"] - real["starts"].get(section["href"], section["start_page"])
+                        for section in estimate["sections"]]
+        worst_start = max(start_errors, key=abs, default=0)
+        error = estimate["total_pages"] - real["total_pages"]
+        rows.append({"book": name, "estimate": estimate, "real": real, "error_pages": error,
+                     "worst_start_error": worst_start, "estimate_ms": round(estimate_ms, 2),
+                     "render_seconds": round(render_seconds, 2)})
+        print(f"{name[-32:]:<32} {estimate['total_pages']:>5} {real['total_pages']:>5} "
+              f"{error / real['total_pages']:>+6.1%} {worst_start:>+12d} {estimate_ms:>7.1f} {render_seconds:>9.1f}")
+
+    # Body pages are almost all flowed text, so their ratio is how far the line scale is off.
+    ratios = [row["real"]["body_pages"] / row["estimate"]["body_pages"] for row in rows if row["estimate"]["body_pages"]]
+    if ratios:
+        suggested = TEXT_LINE_SCALE * sum(ratios) / len(ratios)
+        mean_error = sum(abs(row["error_pages"]) / row["real"]["total_pages"] for row in rows) / len(rows)
+        print(f"\nMean absolute error {mean_error:.1%} at PAGE_ESTIMATE_TEXT_LINE_SCALE={TEXT_LINE_SCALE}; "
+              f"suggested value {suggested:.3f}.")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# app/http_clients.py
+import importlib.util
+import os
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# HTTP/2 needs the optional `h2` package (pip install "httpx[http2]"); without it we stay on HTTP/1.1.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+ASTROLOGY_API_BASE_URL = "https://json.astrologyapi.com/v1"
+
+# Keep-alive pool sizes per upstream. OpenAI carries chapter, summary and image-prompt
+# traffic for every book in flight, so it gets the largest pool.
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "50"))
+ASTROLOGY_MAX_CONNECTIONS = int(os.getenv("ASTROLOGY_MAX_CONNECTIONS", "10"))
+IMAGE_DOWNLOAD_MAX_CONNECTIONS = int(os.getenv("IMAGE_DOWNLOAD_MAX_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "30"))
+
+_openai: Optional[AsyncOpenAI] = None
+_openai_http: Optional[httpx.AsyncClient] = None
+_astrology: Optional[httpx.AsyncClient] = None
+_images: Optional[httpx.AsyncClient] = None
+
+
+def _limits(max_connections: int) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+    )
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """The process-wide OpenAI client, sharing one connection pool across every call site."""
+    global _openai, _openai_http
+    if _openai is None:
+        _openai_http = httpx.AsyncClient(
+            limits=_limits(OPENAI_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+            http2=HTTP2_AVAILABLE,
+        )
+        _openai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=_openai_http)
+    return _openai
+
+
+def get_astrology_client() -> httpx.AsyncClient:
+    """Pooled client for AstrologyAPI, with the account credentials already attached."""
+    global _astrology
+    if _astrology is None:
+        _astrology = httpx.AsyncClient(
+            base_url=ASTROLOGY_API_BASE_URL,
+            auth=(os.getenv("ASTROLOGY_API_USER_ID") or "", os.getenv("ASTROLOGY_API_KEY") or ""),
+            limits=_limits(ASTROLOGY_MAX_CONNECTIONS),
+            timeout=30.0,
+            http2=HTTP2_AVAILABLE,
+        )
+    return _astrology
+
+
+def get_image_download_client() -> httpx.AsyncClient:
+    """Pooled client for fetching generated images from the OpenAI CDN."""
+    global _images
+    if _images is None:
+        _images = httpx.AsyncClient(
+            limits=_limits(IMAGE_DOWNLOAD_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            follow_redirects=True,
+            http2=HTTP2_AVAILABLE,
+        )
+    return _images
+
+
+async def open_clients():
+    """Creates every pool up front; called from the FastAPI lifespan."""
+    get_openai_client()
+    get_astrology_client()
+    get_image_download_client()
+    print(f"HTTP connection pools ready (HTTP/2 {'enabled' if HTTP2_AVAILABLE else 'unavailable'}).")
+
+
+async def close_clients():
+    """Closes every pool; called when the server shuts down."""
+    global _openai, _openai_http, _astrology, _images
+    for client in (_openai_http, _astrology, _images):
+        if client is not None:
+            await client.aclose()
+    _openai = _openai_http = _astrology = _images = None
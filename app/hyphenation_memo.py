@@ -0,0 +1,87 @@
+# app/hyphenation_memo.py
+import json
+import os
+
+import pyphen
+
+# Where the hyphenation points of every word seen so far are kept between processes.
+HYPHENATION_MEMO_PATH = os.getenv("HYPHENATION_MEMO_PATH", os.path.join("generated_jobs", ".cache", "hyphenation.json"))
+# Words kept per language; the memo stops growing past this.
+HYPHENATION_MEMO_MAX_WORDS = int(os.getenv("HYPHENATION_MEMO_MAX_WORDS", "200000"))
+
+# State of this process: the mtime of the file as last loaded, and the words it held then.
+_loaded_mtime = None
+_saved_words = 0
+
+
+def _dictionaries(languages):
+    """pyphen's shared dictionaries (one per language, cached for the process) keyed by language."""
+    paths = {}
+    for language in languages:
+        language = pyphen.language_fallback(language)
+        if language:
+            path = pyphen.LANGUAGES[language]
+            # Creating a Pyphen loads the patterns into pyphen.hdcache, which WeasyPrint shares.
+            pyphen.Pyphen(filename=path)
+            paths[language] = pyphen.hdcache[path]
+    return paths
+
+
+def _word_count():
+    return sum(len(hd.cache) for hd in pyphen.hdcache.values())
+
+
+def preload(language):
+    """Parses the hyphenation patterns for a language now rather than in the middle of the first book."""
+    _dictionaries([language])
+
+
+def load():
+    """
+    Seeds pyphen's per-word caches from the memo file, so words hyphenated by
+    earlier processes are not looked up again. Cheap when the file has not
+    changed since this process last read it.
+    """
+    global _loaded_mtime, _saved_words
+    try:
+        mtime = os.path.getmtime(HYPHENATION_MEMO_PATH)
+    except OSError:
+        return
+    if mtime == _loaded_mtime:
+        return
+    try:
+        with open(HYPHENATION_MEMO_PATH, "r", encoding="utf-8") as f:
+            memo = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read the hyphenation memo {HYPHENATION_MEMO_PATH}. Error: {e}")
+        return
+    for language, hd in _dictionaries(list(memo)).items():
+        for word, points in memo[language].items():
+            if word not in hd.cache:
+                hd.cache[word] = [pyphen.DataInt(point) for point in points]
+    _loaded_mtime = mtime
+    _saved_words = _word_count()
+
+
+def save():
+    """Writes the words hyphenated in this process back to the memo file, if there are new ones."""
+    global _loaded_mtime, _saved_words
+    if _word_count() <= _saved_words:
+        return
+    load()  # Merge whatever other processes saved in the meantime.
+    languages = {path: language for language, path in pyphen.LANGUAGES.items()}
+    memo = {}
+    for path, hd in pyphen.hdcache.items():
+        language = languages.get(path)
+        if not language or not hd.cache:
+            continue
+        # Nonstandard hyphenation (e.g. 'ff=f') carries data a plain list cannot hold; those words are left out.
+        words = [(word, points) for word, points in hd.cache.items() if all(point.data is None for point in points)]
+        memo[language] = {word: [int(point) for point in points] for word, points in words[:HYPHENATION_MEMO_MAX_WORDS]}
+    os.makedirs(os.path.dirname(HYPHENATION_MEMO_PATH) or ".", exist_ok=True)
+    partial_path = f"{HYPHENATION_MEMO_PATH}.{os.getpid()}.partial"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        json.dump(memo, f, separators=(",", ":"))
+    os.replace(partial_path, HYPHENATION_MEMO_PATH)
+    _loaded_mtime = os.path.getmtime(HYPHENATION_MEMO_PATH)
+    _saved_words = _word_count()
@@ -0,0 +1,351 @@
+# app/job_store.py
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    request_json TEXT NOT NULL,
+    result_json TEXT,
+    error TEXT,
+    owner TEXT,
+    lease_expires_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    client_ip TEXT,
+    started_at REAL,
+    request_key TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_transitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    message TEXT,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_transitions_job ON job_transitions (job_id, id);
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data_json TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, id);
+CREATE TABLE IF NOT EXISTS job_artifacts (
+    job_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (job_id, name)
+);
+"""
+
+# Columns added after the first release; older databases get them on startup.
+MIGRATIONS = {
+    "jobs": [("client_ip", "TEXT"), ("started_at", "REAL"), ("request_key", "TEXT")],
+}
+POST_MIGRATION_SCHEMA = """
+CREATE INDEX IF NOT EXISTS jobs_client_status ON jobs (client_ip, status);
+CREATE INDEX IF NOT EXISTS jobs_request_key_status ON jobs (request_key, status);
+"""
+
+# Used for wait estimates until enough jobs have finished to measure.
+DEFAULT_JOB_SECONDS = 600.0
+
+
+class QueueFull(Exception):
+    """Raised when admitting a job would push the queue past its configured depth."""
+
+    def __init__(self, message: str, queue_position: int, retry_after: int, estimated_wait_seconds: int):
+        super().__init__(message)
+        self.queue_position = queue_position
+        self.retry_after = retry_after
+        self.estimated_wait_seconds = estimated_wait_seconds
+
+
+def _row_to_job(row: sqlite3.Row) -> dict:
+    job = dict(row)
+    job["request"] = json.loads(job.pop("request_json"))
+    result_json = job.pop("result_json")
+    job["result"] = json.loads(result_json) if result_json else None
+    return job
+
+
+class JobStore:
+    """
+    Durable record of book generation jobs, kept in SQLite (WAL mode) so that
+    several uvicorn workers or processes can share one queue and a restart
+    can pick up where the last process stopped.
+
+    Running jobs hold a lease that their worker keeps renewing. A job whose
+    lease has expired belongs to a dead worker and may be claimed again.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            for table, columns in MIGRATIONS.items():
+                existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for name, column_type in columns:
+                    if name not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+            conn.executescript(POST_MIGRATION_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per call keeps the store safe to use from
+        # the event loop, the threadpool and other processes alike.
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """Runs the block under SQLite's write lock, so claims never race."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def create_job(self, request: dict, client_ip: Optional[str] = None, max_queued: Optional[int] = None,
+                   max_queued_per_client: Optional[int] = None, active_capacity: int = 1,
+                   request_key: Optional[str] = None) -> dict:
+        """
+        Queues a new job. When queue limits are given, the check and the insert
+        happen under one write lock so concurrent submissions cannot overshoot;
+        a request past either limit raises QueueFull with a wait estimate.
+
+        If `request_key` matches a job that is still queued or running, no new
+        job is created: the existing one is returned with `coalesced` set.
+        """
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self._transaction() as conn:
+            if request_key is not None:
+                existing = conn.execute(
+                    "SELECT id FROM jobs WHERE request_key = ? AND status IN ('queued', 'running') "
+                    "ORDER BY created_at LIMIT 1",
+                    (request_key,),
+                ).fetchone()
+                if existing is not None:
+                    return {**self._get_job(conn, existing["id"]), "coalesced": True}
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if max_queued is not None and queued >= max_queued:
+                raise self._queue_full(conn, "The server is busy generating other books.",
+                                       queued, queued - max_queued + 1, active_capacity)
+            if max_queued_per_client is not None and client_ip is not None:
+                client_queued = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND client_ip = ?", (client_ip,)
+                ).fetchone()[0]
+                if client_queued >= max_queued_per_client:
+                    raise self._queue_full(conn, "You already have the maximum number of books waiting.",
+                                           queued, client_queued - max_queued_per_client + 1, active_capacity)
+            conn.execute(
+                "INSERT INTO jobs (id, status, stage, progress, message, request_json, client_ip, request_key, "
+                "created_at, updated_at) VALUES (?, 'queued', 'queued', 0, 'Waiting for a free worker.', ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(request), client_ip, request_key, now, now),
+            )
+            conn.execute(
+                "INSERT INTO job_transitions (job_id, stage, message, at) VALUES (?, 'queued', NULL, ?)",
+                (job_id, now),
+            )
+            return {**self._get_job(conn, job_id), "coalesced": False}
+
+    def _average_job_seconds(self, conn) -> float:
+        row = conn.execute(
+            "SELECT AVG(updated_at - started_at) FROM (SELECT updated_at, started_at FROM jobs "
+            "WHERE status = 'succeeded' AND started_at IS NOT NULL ORDER BY updated_at DESC LIMIT 20)"
+        ).fetchone()
+        return row[0] or DEFAULT_JOB_SECONDS
+
+    def _queue_full(self, conn, message: str, queued: int, overflow: int, active_capacity: int) -> QueueFull:
+        # A queue slot opens roughly every (average job time / number of active slots),
+        # and `overflow` slots have to open before this request would fit.
+        average = self._average_job_seconds(conn)
+        per_slot = average / max(active_capacity, 1)
+        retry_after = int(per_slot * overflow) + 1
+        estimated_wait = int(per_slot * (queued + 1) + average)
+        return QueueFull(message, queue_position=queued + 1, retry_after=retry_after, estimated_wait_seconds=estimated_wait)
+
+    def queue_position(self, job_id: str, active_capacity: int = 1) -> Optional[dict]:
+        """How many queued jobs are ahead of this one, and roughly how long until it finishes."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT status, created_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row["status"] != "queued":
+                return None
+            ahead = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (row["created_at"],)
+            ).fetchone()[0]
+            average = self._average_job_seconds(conn)
+        return {
+            "queue_position": ahead + 1,
+            "estimated_wait_seconds": int(average * (ahead // max(active_capacity, 1) + 1)),
+        }
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            return self._get_job(conn, job_id)
+
+    def _get_job(self, conn, job_id: str) -> Optional[dict]:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def claim_next(self, owner: str, lease_seconds: float, max_active: Optional[int] = None,
+                   max_active_per_client: Optional[int] = None) -> Optional[dict]:
+        """
+        Atomically takes the oldest queued job, or a running job whose worker
+        stopped renewing its lease, and leases it to `owner`.
+
+        Nothing is claimed while `max_active` jobs are already running across
+        every process, and jobs from a client already running
+        `max_active_per_client` books wait their turn behind other clients.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            if max_active is not None:
+                active = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND lease_expires_at >= ?", (now,)
+                ).fetchone()[0]
+                if active >= max_active:
+                    return None
+            row = conn.execute(
+                "SELECT id FROM jobs AS candidate WHERE (status = 'queued' "
+                "OR (status = 'running' AND lease_expires_at < ?)) "
+                "AND (? IS NULL OR candidate.client_ip IS NULL OR (SELECT COUNT(*) FROM jobs AS active "
+                "     WHERE active.status = 'running' AND active.lease_expires_at >= ? "
+                "     AND active.client_ip = candidate.client_ip) < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now, max_active_per_client, now, max_active_per_client),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1, started_at = COALESCE(started_at, ?), updated_at = ? WHERE id = ?",
+                (owner, now + lease_seconds, now, now, row["id"]),
+            )
+        return self.get_job(row["id"])
+
+    def renew_lease(self, job_id: str, owner: str, lease_seconds: float) -> bool:
+        """Extends a lease; returns False if another worker has taken the job over."""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (now + lease_seconds, job_id, owner),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, job_id: str, owner: str):
+        """
+        Hands a job back to the queue when its worker shuts down cleanly. The
+        interrupted attempt is not counted against the job.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, lease_expires_at = NULL, "
+                "attempts = MAX(attempts - 1, 0), updated_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time(), job_id, owner),
+            )
+
+    def update_progress(self, job_id: str, stage: str, progress: float, message: str):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT stage, progress FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            progress = max(row["progress"], min(progress, 1.0))
+            conn.execute(
+                "UPDATE jobs SET stage = ?, progress = ?, message = ?, updated_at = ? WHERE id = ?",
+                (stage, progress, message, now, job_id),
+            )
+            conn.execute(
+                "INSERT INTO job_events (job_id, event, data_json, at) VALUES (?, 'progress', ?, ?)",
+                (job_id, json.dumps({"stage": stage, "progress": round(progress, 3), "message": message}), now),
+            )
+            if row["stage"] != stage:
+                conn.execute(
+                    "INSERT INTO job_transitions (job_id, stage, message, at) VALUES (?, ?, ?, ?)",
+                    (job_id, stage, message, now),
+                )
+
+    def record_artifact(self, job_id: str, name: str, path: str):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_artifacts (job_id, name, path, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, name, path, time.time()),
+            )
+
+    def get_artifacts(self, job_id: str) -> dict:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT name, path FROM job_artifacts WHERE job_id = ?", (job_id,)).fetchall()
+        return {row["name"]: row["path"] for row in rows}
+
+    def add_event(self, job_id: str, event: str, data: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO job_events (job_id, event, data_json, at) VALUES (?, ?, ?, ?)",
+                (job_id, event, json.dumps(data), time.time()),
+            )
+
+    def get_events(self, job_id: str, after_id: int = 0) -> list:
+        """Events recorded for a job after the given event id, oldest first."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, event, data_json, at FROM job_events WHERE job_id = ? AND id > ? ORDER BY id",
+                (job_id, after_id),
+            ).fetchall()
+        return [{"id": row["id"], "event": row["event"], "data": json.loads(row["data_json"]), "at": row["at"]} for row in rows]
+
+    def get_transitions(self, job_id: str) -> list:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT stage, message, at FROM job_transitions WHERE job_id = ? ORDER BY id", (job_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def finish(self, job_id: str, owner: str, status: str, result: Optional[dict] = None, error: Optional[str] = None):
+        """Marks a job succeeded or failed, provided `owner` still holds it."""
+        now = time.time()
+        stage = "completed" if status == "succeeded" else "failed"
+        message = "Your book is ready." if status == "succeeded" else "Book generation failed."
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, progress = CASE WHEN ? = 'succeeded' THEN 1 ELSE progress END, "
+                "message = ?, result_json = ?, error = ?, owner = NULL, lease_expires_at = NULL, updated_at = ? "
+                "WHERE id = ? AND owner = ?",
+                (status, stage, status, message, json.dumps(result) if result is not None else None, error, now, job_id, owner),
+            )
+            if cursor.rowcount == 1:
+                conn.execute(
+                    "INSERT INTO job_transitions (job_id, stage, message, at) VALUES (?, ?, ?, ?)",
+                    (job_id, stage, error or message, now),
+                )
+                conn.execute(
+                    "INSERT INTO job_events (job_id, event, data_json, at) VALUES (?, ?, ?, ?)",
+                    (job_id, stage, json.dumps({"status": status, "message": message, "result": result, "error": error}), now),
+                )
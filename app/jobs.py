@@ -0,0 +1,282 @@
+# app/jobs.py
+import asyncio
+import hashlib
+import json
+import re
+import os
+import socket
+import traceback
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from app.job_store import JobStore, QueueFull
+
+# Number of books that may be generated concurrently by this process.
+BOOK_WORKERS = int(os.getenv("BOOK_WORKERS", "4"))
+# Where job records and their intermediate artifacts are kept.
+JOBS_DIR = os.getenv("JOBS_DIR", "generated_jobs")
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join(JOBS_DIR, "jobs.sqlite3"))
+# A running job whose worker has not renewed its lease for this long is considered orphaned.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# How often idle workers look for jobs submitted by other processes.
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+# Jobs that keep killing their worker are failed rather than retried forever.
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", "3"))
+
+# --- Admission limits ---
+# Books generating at once across every process sharing the job store, and per client IP.
+MAX_ACTIVE_JOBS = int(os.getenv("MAX_ACTIVE_JOBS", str(BOOK_WORKERS)))
+MAX_ACTIVE_JOBS_PER_CLIENT = int(os.getenv("MAX_ACTIVE_JOBS_PER_CLIENT", "1"))
+# Books allowed to wait for a slot; beyond this, new requests are turned away with a 429.
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "20"))
+MAX_QUEUED_JOBS_PER_CLIENT = int(os.getenv("MAX_QUEUED_JOBS_PER_CLIENT", "3"))
+
+# Coarse pipeline stages, in the order a job moves through them.
+STAGES = [
+    "queued",
+    "parsing_prompt",
+    "fetching_chart",
+    "architecting",
+    "writing_chapters",
+    "rendering_pdf",
+    "completed",
+]
+
+
+def request_key(request: dict) -> str:
+    """
+    Identifies requests that would produce the same book, so double-clicks and
+    retries share one pipeline. Case, spacing and time formatting are ignored.
+    """
+    birth_time = request["birth_time"].strip()
+    time_match = re.match(r"^(\d{1,2}):(\d{2})", birth_time)
+    if time_match:
+        birth_time = f"{int(time_match.group(1)):02d}:{time_match.group(2)}"
+    normalized = {
+        "birth_date": request["birth_date"].strip(),
+        "birth_time": birth_time,
+        "birth_location": " ".join(re.sub(r"\s*,\s*", ", ", request["birth_location"]).split()).casefold(),
+        "target_word_count": int(request["target_word_count"]),
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class Job:
+    """
+    A claimed job as seen by the runner. Progress and artifacts are written
+    through to the store so another worker can resume the job. The writes run
+    off the event loop, one after another in the order they were made, since
+    SQLite may hold them for up to its busy timeout; `flush` waits for them.
+    """
+
+    def __init__(self, record: dict, store: JobStore, artifacts: dict, loop: asyncio.AbstractEventLoop):
+        self.id = record["id"]
+        self.request = record["request"]
+        self.attempts = record["attempts"]
+        self.store = store
+        self.workdir = os.path.join(JOBS_DIR, self.id)
+        self.artifacts = artifacts
+        self._loop = loop
+        self._writes: Optional[asyncio.Task] = None
+        self._write_error: Optional[Exception] = None
+        os.makedirs(self.workdir, exist_ok=True)
+
+    def write(self, fn: Callable, *args):
+        """Queues a store write behind the job's earlier ones. Safe to call from a helper thread."""
+        if self._in_loop_thread():
+            self._queue_write(fn, args)
+        else:
+            self._loop.call_soon_threadsafe(self._queue_write, fn, args)
+
+    def _in_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _queue_write(self, fn: Callable, args: tuple):
+        previous = self._writes
+
+        async def run_write():
+            if previous is not None:
+                await asyncio.shield(previous)
+            try:
+                await asyncio.to_thread(fn, *args)
+            except Exception as e:
+                print(f"ERROR: could not record {fn.__name__} for job {self.id}: {e}")
+                self._write_error = self._write_error or e
+
+        self._writes = self._loop.create_task(run_write())
+
+    async def flush(self, raise_errors: bool = True):
+        """Waits for the queued writes; raises the first one that failed unless told not to."""
+        if self._writes is not None:
+            await asyncio.shield(self._writes)
+        if raise_errors and self._write_error is not None:
+            raise self._write_error
+
+    def load_artifact(self, name: str):
+        """Returns a previously saved JSON artifact, or None if this stage has not completed."""
+        path = self.artifacts.get(name)
+        if not path or not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_artifact(self, name: str, data) -> str:
+        """Persists a JSON artifact and records it, marking the stage that produced it as done."""
+        path = os.path.join(self.workdir, f"{name}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+        self.record_artifact(name, path)
+        return path
+
+    def record_artifact(self, name: str, path: str):
+        self.artifacts[name] = path
+        self.write(self.store.record_artifact, self.id, name, path)
+
+    def emit(self, event: str, data: dict):
+        """Publishes a pipeline event to anyone following the job's event stream."""
+        self.write(self.store.add_event, self.id, event, data)
+
+
+# A runner receives the job and a `report(stage, progress, message)` callback.
+ProgressReporter = Callable[[str, float, str], None]
+JobRunner = Callable[[Job, ProgressReporter], Awaitable[dict]]
+
+
+class JobManager:
+    """
+    Accepts book requests into the durable job store and runs them on a
+    fixed-size pool of background workers. Every process sharing the store
+    runs its own pool; they coordinate through leases in the database.
+    """
+
+    def __init__(self, runner: JobRunner, num_workers: int = BOOK_WORKERS, db_path: str = JOBS_DB_PATH):
+        self.runner = runner
+        self.num_workers = num_workers
+        self.store = JobStore(db_path)
+        self.active_capacity = MAX_ACTIVE_JOBS
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: list = []
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(n)) for n in range(self.num_workers)]
+        print(f"Started {self.num_workers} book generation workers as {self.owner}.")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, request: dict, client_ip: Optional[str] = None) -> dict:
+        """
+        Queues a request, raising QueueFull if the queue or this client's share of it is full.
+        An identical request that is already queued or running is returned instead of a new job.
+        """
+        record = self.store.create_job(
+            request,
+            client_ip=client_ip,
+            max_queued=MAX_QUEUED_JOBS,
+            max_queued_per_client=MAX_QUEUED_JOBS_PER_CLIENT,
+            active_capacity=self.active_capacity,
+            request_key=request_key(request),
+        )
+        if record["coalesced"]:
+            print(f"Request matches in-flight job {record['id']}; attaching to it.")
+            return record
+        print(f"Queued job {record['id']}.")
+        if self._wakeup:
+            self._wakeup.set()
+        return record
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.store.get_job(job_id)
+
+    def queue_position(self, job_id: str) -> Optional[dict]:
+        return self.store.queue_position(job_id, active_capacity=self.active_capacity)
+
+    def describe(self, job_id: str) -> Optional[dict]:
+        """The client-facing view of a job: status, stage, progress and result."""
+        record = self.store.get_job(job_id)
+        if record is None:
+            return None
+        return {
+            "job_id": record["id"],
+            "status": record["status"],
+            "stage": record["stage"],
+            "progress": round(record["progress"], 3),
+            "message": record["message"],
+            "result": record["result"],
+            "error": record["error"],
+            "attempts": record["attempts"],
+            "created_at": record["created_at"],
+            "updated_at": record["updated_at"],
+            "queue": self.queue_position(job_id),
+            "history": self.store.get_transitions(job_id),
+        }
+
+    async def _worker(self, worker_number: int):
+        while True:
+            record = await asyncio.to_thread(
+                self.store.claim_next, self.owner, JOB_LEASE_SECONDS, self.active_capacity, MAX_ACTIVE_JOBS_PER_CLIENT
+            )
+            if record is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(record)
+
+    async def _keep_lease(self, job_id: str, runner_task: asyncio.Task) -> bool:
+        """Renews the job's lease until cancelled. If it is lost, stops the runner and returns True."""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            if not await asyncio.to_thread(self.store.renew_lease, job_id, self.owner, JOB_LEASE_SECONDS):
+                print(f"Lost the lease on job {job_id}; another worker has taken it over. Stopping this run.")
+                runner_task.cancel()
+                return True
+
+    async def _run(self, record: dict):
+        job_id = record["id"]
+        if record["attempts"] > MAX_JOB_ATTEMPTS:
+            await asyncio.to_thread(
+                self.store.finish, job_id, self.owner, "failed", error=f"Gave up after {MAX_JOB_ATTEMPTS} attempts."
+            )
+            return
+
+        def report(stage: str, progress: float, message: str = ""):
+            job.write(self.store.update_progress, job_id, stage, progress, message)
+
+        if record["attempts"] > 1:
+            print(f"Resuming job {job_id} (attempt {record['attempts']}).")
+        artifacts = await asyncio.to_thread(self.store.get_artifacts, job_id)
+        job = Job(record, self.store, artifacts, asyncio.get_running_loop())
+        runner_task = asyncio.ensure_future(self.runner(job, report))
+        lease_keeper = asyncio.create_task(self._keep_lease(job_id, runner_task))
+        try:
+            result = await runner_task
+            # The final status must not land before the progress and events that led to it.
+            await job.flush()
+            await asyncio.to_thread(self.store.finish, job_id, self.owner, "succeeded", result=result)
+        except asyncio.CancelledError:
+            if lease_keeper.done() and not lease_keeper.cancelled() and lease_keeper.result():
+                # The job is another worker's now; it resumes from the artifacts saved so far.
+                return
+            # Shutting down: hand the job back so the next worker resumes it.
+            await asyncio.to_thread(self.store.release, job_id, self.owner)
+            raise
+        except Exception as e:
+            print(f"\n--- AN ERROR OCCURRED IN JOB {job_id} ---")
+            traceback.print_exc()
+            await job.flush(raise_errors=False)
+            await asyncio.to_thread(self.store.finish, job_id, self.owner, "failed", error=str(e))
+        finally:
+            lease_keeper.cancel()
@@ -1,35 +1,78 @@
 # app/main.py
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse # <-- Added FileResponse for the frontend
-from fastapi.staticfiles import StaticFiles # <-- Added StaticFiles for PDF downloads
-from fastapi.concurrency import run_in_threadpool
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, JSONResponse # <-- Added FileResponse for the frontend
+from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field
 from app.book_writer import generate_astrology_book
-from app.book_pdf_exporter import save_book_as_pdf
+from app.render_pool import RenderPool
+from app.page_estimator import estimate_pages
 from app.astrology_api_client import get_natal_chart_data
 from app.prompt_builder import build_data_extraction_prompt 
+from app.jobs import JobManager, QueueFull, JOBS_DB_PATH
+from app.artifact_store import ArtifactStore
+from app.http_clients import get_openai_client, open_clients, close_clients
+from app import usage_ledger
 from dotenv import load_dotenv
 import os
 import re
-import traceback
 import json
-from openai import AsyncOpenAI, RateLimitError
+import asyncio
+from email.utils import formatdate
+from openai import RateLimitError
 from datetime import datetime 
 
 load_dotenv()
 
-# Initialize OpenAI client for the parsing step
-openai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 MODEL_TEXT = "gpt-4-1106-preview" # Use a smart model for parsing
+# How often an open event stream checks the job store, and how often it sends a keep-alive.
+SSE_POLL_SECONDS = float(os.getenv("SSE_POLL_SECONDS", "0.5"))
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+# WeasyPrint renders are CPU-heavy; this many render processes run alongside the server.
+MAX_CONCURRENT_RENDERS = int(os.getenv("MAX_CONCURRENT_RENDERS", "2"))
+# Only trust X-Forwarded-For when running behind a proxy that sets it.
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "false").lower() == "true"
+
+render_pool = RenderPool(size=MAX_CONCURRENT_RENDERS)
+
+# Generated PDFs live here and are served by `download_book`.
+BOOKS_DIR = "generated_books"
+# How often the artifact store is swept for expired files, and how long downloads may be cached.
+ARTIFACT_SWEEP_SECONDS = float(os.getenv("ARTIFACT_SWEEP_SECONDS", "600"))
+DOWNLOAD_MAX_AGE_SECONDS = int(os.getenv("DOWNLOAD_MAX_AGE_SECONDS", "86400"))
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+artifact_store = ArtifactStore(JOBS_DB_PATH)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One keep-alive pool per upstream, shared by every job in this process.
+    await open_clients()
+    # Render processes are warmed up before any job can reach the PDF stage.
+    await render_pool.start()
+    await job_manager.start()
+    sweeper = asyncio.create_task(sweep_artifacts())
+    yield
+    sweeper.cancel()
+    await job_manager.stop()
+    await render_pool.stop()
+    await close_clients()
+
+async def sweep_artifacts():
+    """Periodically evicts expired or over-budget PDFs and images."""
+    while True:
+        try:
+            await asyncio.to_thread(artifact_store.evict)
+        except Exception as e:
+            print(f"Artifact sweep failed: {e}")
+        await asyncio.sleep(ARTIFACT_SWEEP_SECONDS)
 
 app = FastAPI(
     title="Personal Portrait Generator",
     description="An API to generate a personalized interpretation book based on a plain text birth prompt.",
-    version="3.0.0"
+    version="3.1.0",
+    lifespan=lifespan
 )
 
-# This is necessary for the frontend to be able to link to the generated PDF
-app.mount("/generated_books", StaticFiles(directory="generated_books"), name="generated_books")
 
 # <<<====== 1. UPDATE BookRequest to match the new form fields ======>>>
 class BookRequest(BaseModel):
@@ -39,6 +82,12 @@ class BookRequest(BaseModel):
     # UPDATED FIELD:
     target_word_count: int = Field(15000, description="Desired book length: 15000, 30000, or 50000")
 
+def client_ip_for(request: Request) -> str:
+    """The address admission limits are counted against."""
+    if TRUST_PROXY_HEADERS and request.headers.get("x-forwarded-for"):
+        return request.headers["x-forwarded-for"].split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
 def sanitize_filename(text: str) -> str:
     """Removes invalid characters from a string to make it a valid filename."""
     sanitized = re.sub(r'[\\/*?:"<>|]', "", text)
@@ -53,12 +102,14 @@ async def extract_birth_data_from_prompt(prompt: str) -> dict:
     extraction_prompt = build_data_extraction_prompt(prompt)
     
     try:
-        response = await openai.chat.completions.create(
-            model=MODEL_TEXT,
-            messages=[{"role": "user", "content": extraction_prompt}],
-            response_format={"type": "json_object"},
-            temperature=0.0 # Be precise
-        )
+        with usage_ledger.call("parse", MODEL_TEXT, prompt_chars=len(extraction_prompt)) as usage:
+            response = await get_openai_client().chat.completions.create(
+                model=MODEL_TEXT,
+                messages=[{"role": "user", "content": extraction_prompt}],
+                response_format={"type": "json_object"},
+                temperature=0.0 # Be precise
+            )
+            usage.update(usage_ledger.tokens(response))
         
         structured_data = json.loads(response.choices[0].message.content)
         print("Successfully parsed prompt into structured data:", structured_data)
@@ -82,59 +133,300 @@ async def read_root():
     return FileResponse('index.html')
 
 
-@app.post("/generate-book/", summary="Generate a Personal Portrait Book")
-async def generate_book(request: BookRequest):
+async def run_book_job(job, report) -> dict:
     """
-    Generates a complete PDF book from a simple text prompt containing birth info.
+    Runs the full generation pipeline for one queued job, reporting progress as it goes.
+
+    Every stage saves its output as a job artifact before moving on, so a job that is
+    picked up again after a crash or restart resumes from its last completed stage.
+    Every OpenAI call the job makes, in every attempt, is kept in its `usage` artifact.
     """
-    if not all([request.birth_date, request.birth_time, request.birth_location]):
-        raise HTTPException(status_code=400, detail="Date, time, and location fields cannot be empty.")
-    
-    user_prompt = f"{request.birth_date} at {request.birth_time} in {request.birth_location}"
-    
-    # <<<====== 2. VALIDATE the new word count field ======>>>
-    if request.target_word_count not in [15000, 30000, 50000]:
-        raise HTTPException(status_code=400, detail="Word count must be one of: 15000, 30000, 50000.")
+    usage = job.load_artifact("usage") or []
+    try:
+        with usage_ledger.ledger(usage, job_id=job.id, tier=job.request['target_word_count'], attempt=job.attempts):
+            return await _run_book_pipeline(job, report)
+    finally:
+        job.save_artifact("usage", usage)
 
-    print(f"--- Starting Book Generation for prompt: '{user_prompt}' ---")
 
-    try:
+async def _run_book_pipeline(job, report) -> dict:
+    request = job.request
+    user_prompt = f"{request['birth_date']} at {request['birth_time']} in {request['birth_location']}"
+    print(f"--- Starting Book Generation for job {job.id}, prompt: '{user_prompt}' ---")
+
+    birth_data = job.load_artifact("birth_data")
+    if birth_data is None:
+        report("parsing_prompt", 0.02, "Reading your birth details...")
         birth_data = await extract_birth_data_from_prompt(user_prompt)
+        job.save_artifact("birth_data", birth_data)
+
+    natal_chart_data = job.load_artifact("natal_chart")
+    if natal_chart_data is None:
+        report("fetching_chart", 0.05, "Fetching your natal chart...")
         natal_chart_data = await get_natal_chart_data(**birth_data)
+        job.save_artifact("natal_chart", natal_chart_data)
 
-        book_title = "The Architecture of You" # A more fitting title
+    book_title = "The Architecture of You" # A more fitting title
+
+    book_data = job.load_artifact("book_data")
+    if book_data is None:
         print(f"Generating book components for: '{book_title}'...")
+        report("architecting", 0.08, "Designing the structure of your book...")
+        book_progress = job.load_artifact("book_progress") or {"structure": None, "chapters": []}
+
+        # Chapters and their images make up the bulk of the wait, so they get most of the progress bar.
+        # The structure and each finished chapter are checkpointed so a resumed job does not pay for them twice.
+        def on_book_event(event: str, data: dict):
+            if event == "architecture_done":
+                book_progress["structure"] = data["structure"]
+                job.save_artifact("book_progress", book_progress)
+                job.emit("architecture_done", {"num_chapters": data["num_chapters"], "chapter_titles": data["chapter_titles"]})
+                report("writing_chapters", 0.12, f"Writing {data['num_chapters']} chapters...")
+            elif event == "chapter_written":
+                job.emit("chapter_written", {"index": data["index"], "total": data["total"], "heading": data["heading"], "word_count": data["word_count"], "excerpt": data["content"][:1500]})
+                report("writing_chapters", 0.12 + 0.7 * (data['index'] - 0.5) / data['total'], f"Chapter {data['index']} of {data['total']} written.")
+            elif event == "image_saved":
+                book_progress["chapters"].append(data["chapter"])
+                job.save_artifact("book_progress", book_progress)
+                if data["image_path"]:
+                    # Recorded against the job so the artifact store keeps it until the PDF is built.
+                    job.record_artifact(f"image_{data['index']}", data["image_path"])
+                    artifact_store.register(data["image_path"], kind="image")
+                job.emit("image_saved", {"index": data["index"], "total": data["total"], "has_image": data["image_path"] is not None})
+                report("writing_chapters", 0.12 + 0.7 * data['index'] / data['total'], f"Chapter {data['index']} of {data['total']} illustrated.")
 
-        # <<<====== 3. PASS target_word_count to the book writer ======>>>
         book_data = await generate_astrology_book(
             natal_chart_json=natal_chart_data,
-            target_word_count=request.target_word_count # Pass the new parameter
+            target_word_count=request['target_word_count'],
+            on_event=on_book_event,
+            resume_state=book_progress
         )
+        job.save_artifact("book_data", book_data)
         print("Book components generated successfully.")
 
+    # A layout-free page count, available to the client long before the PDF is.
+    page_estimate = estimate_pages(book_title, book_data)
+    job.emit("pages_estimated", {"total_pages": page_estimate["total_pages"], "sections": page_estimate["sections"]})
+
+    output_pdf_path = job.artifacts.get("pdf")
+    if not output_pdf_path or not os.path.exists(output_pdf_path):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{sanitize_filename(book_title)}_{timestamp}.pdf"
+        filename = f"{sanitize_filename(book_title)}_{job.id[:8]}_{timestamp}.pdf"
         print(f"Generating unique PDF: {filename}...")
-        
-        output_pdf_path = await run_in_threadpool(
-            save_book_as_pdf,
+        report("rendering_pdf", 0.85, "Typesetting your PDF...")
+
+        # Called from the render pool's helper thread; the job store is safe to write to from there.
+        def on_render_event(event: str, data: dict):
+            if event == "pdf_ready":
+                data = {"bytes": data["bytes"]}
+            job.emit(event, data)
+            if event == "render_pass_done":
+                report("rendering_pdf", 0.85 + 0.07 * data["render_pass"], f"Render pass {data['render_pass']} of 2 complete.")
+
+        output_pdf_path = await render_pool.render(
             title=book_title,
             book_data=book_data,
-            filename=filename
+            filename=filename,
+            on_event=on_render_event
         )
+        job.record_artifact("pdf", output_pdf_path)
+        artifact_store.register(output_pdf_path, kind="pdf")
         print("\n--- SUCCESS ---")
         print(f"Personalized book saved to: {output_pdf_path}")
-        
-        pdf_url = f"/generated_books/{filename}"
 
-        return {
-            "title": book_title,
-            "pdf_file": pdf_url,
-            "preview": book_data.get('prologue_text', '') + "\n\n" + book_data.get('chapters', [{}])[0].get('content', '')[:1500] + "..."
-        }
+    return {
+        "title": book_title,
+        "pdf_file": f"/generated_books/{os.path.basename(output_pdf_path)}",
+        "estimated_pages": page_estimate["total_pages"],
+        "preview": book_data.get('prologue_text', '') + "\n\n" + book_data.get('chapters', [{}])[0].get('content', '')[:1500] + "..."
+    }
 
-    except Exception as e:
-        print(f"\n--- AN ERROR OCCURRED ---")
-        print(f"An error occurred during book generation: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+job_manager = JobManager(runner=run_book_job)
+
+
+@app.post("/generate-book/", status_code=202, summary="Queue a Personal Portrait Book")
+async def generate_book(request: BookRequest, http_request: Request):
+    """
+    Validates the birth details and queues the book for generation.
+    Returns a job id immediately; poll `GET /jobs/{job_id}` for progress and the PDF link.
+    A request identical to one already in flight gets that job's id (`coalesced: true`).
+    When the queue is full, responds 429 with `Retry-After` and an estimate of the wait.
+    """
+    if not all([request.birth_date, request.birth_time, request.birth_location]):
+        raise HTTPException(status_code=400, detail="Date, time, and location fields cannot be empty.")
+    
+    # <<<====== 2. VALIDATE the new word count field ======>>>
+    if request.target_word_count not in [15000, 30000, 50000]:
+        raise HTTPException(status_code=400, detail="Word count must be one of: 15000, 30000, 50000.")
+
+    try:
+        job = job_manager.submit(request.model_dump(), client_ip=client_ip_for(http_request))
+    except QueueFull as e:
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+            content={
+                "detail": f"{e} Please try again in about {max(e.retry_after // 60, 1)} minute(s).",
+                "queue_position": e.queue_position,
+                "estimated_wait_seconds": e.estimated_wait_seconds
+            }
+        )
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/jobs/{job['id']}",
+        "coalesced": job["coalesced"],
+        **(job_manager.queue_position(job["id"]) or {})
+    }
+
+
+@app.get("/jobs/{job_id}", summary="Get the status of a book generation job")
+async def get_job(job_id: str):
+    """
+    Returns the current stage and progress of a job, and the PDF link once it has succeeded.
+    """
+    job = job_manager.describe(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+
+
+@app.get("/metrics/render", summary="PDF render pool metrics")
+async def render_metrics():
+    """
+    Reports how many renders are waiting for a worker, worker memory, recycles and
+    timeouts, and recent render and queue-wait times.
+    """
+    return render_pool.stats()
+
+
+def format_sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+@app.get("/jobs/{job_id}/events", summary="Stream the progress of a book generation job")
+async def stream_job_events(job_id: str, request: Request):
+    """
+    Server-Sent Events stream of a job's pipeline events: progress updates, architecture done,
+    chapter N written, image N saved, render passes and finally `completed` or `failed`.
+    Reconnecting clients resume after the `Last-Event-ID` they last saw.
+    """
+    if job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    try:
+        last_event_id = int(request.headers.get("last-event-id", "0"))
+    except ValueError:
+        last_event_id = 0
+
+    async def event_stream():
+        nonlocal last_event_id
+        # Tell the browser how long to wait before reconnecting if the stream drops.
+        yield "retry: 3000\n\n"
+        idle_seconds = 0.0
+        while not await request.is_disconnected():
+            events = await asyncio.to_thread(job_manager.store.get_events, job_id, last_event_id)
+            for event in events:
+                last_event_id = event["id"]
+                yield format_sse(event)
+                if event["event"] in ("completed", "failed"):
+                    return
+            if events:
+                idle_seconds = 0.0
+            elif idle_seconds >= SSE_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                idle_seconds = 0.0
+            await asyncio.sleep(SSE_POLL_SECONDS)
+            idle_seconds += SSE_POLL_SECONDS
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+
+def parse_range(range_header: str, size: int):
+    """
+    Parses a single `bytes=` range into inclusive (start, end) offsets.
+    Returns None for headers we do not honour (multiple ranges, other units),
+    and raises ValueError for ranges that cannot be satisfied.
+    """
+    units, _, spec = range_header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, _, end_text = spec.strip().partition("-")
+    if start_text == "":
+        # Suffix range: the last N bytes.
+        length = int(end_text)
+        if length <= 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(start_text)
+    end = int(end_text) if end_text else size - 1
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def iter_file(path: str, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_BYTES, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@app.api_route("/generated_books/{filename}", methods=["GET", "HEAD"], summary="Download a generated book")
+async def download_book(filename: str, request: Request):
+    """
+    Serves a generated PDF with a strong ETag, `Range` support for resumable
+    downloads, and cache headers. Books evicted from the artifact store are gone (404).
+    """
+    if filename != os.path.basename(filename) or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="Book not found.")
+    path = os.path.join(BOOKS_DIR, filename)
+    artifact = await asyncio.to_thread(artifact_store.lookup, path, "pdf")
+    if artifact is None:
+        raise HTTPException(status_code=404, detail="Book not found. It may have expired; please generate it again.")
+
+    size = artifact["size"]
+    headers = {
+        "ETag": artifact["etag"],
+        "Accept-Ranges": "bytes",
+        # File names are unique per book, so the content behind a URL never changes.
+        "Cache-Control": f"private, max-age={DOWNLOAD_MAX_AGE_SECONDS}, immutable",
+        "Last-Modified": formatdate(os.path.getmtime(path), usegmt=True),
+        "Content-Disposition": f'inline; filename="{filename}"',
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or artifact["etag"] in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == artifact["etag"]):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type="application/pdf")
+    return StreamingResponse(iter_file(path, start, end - start + 1), status_code=status_code,
+                             headers=headers, media_type="application/pdf")
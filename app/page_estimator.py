@@ -0,0 +1,225 @@
+# app/page_estimator.py
+import math
+import os
+import re
+from functools import lru_cache
+
+from fontTools.ttLib import TTFont
+
+from app.book_pdf_exporter import FONTS_DIR, MAIN_CSS, toc_entries
+
+PT_PER_UNIT = {"pt": 1.0, "mm": 72 / 25.4, "cm": 72 / 2.54, "in": 72.0, "px": 0.75}
+# Monospace advance, in em, of the fallback font the debug pages' <pre> blocks are set in.
+MONOSPACE_ADVANCE_EM = 0.6
+# Multiplies the estimated number of lines of body text. Hyphenation and justification
+# fit a little more on a line than a greedy word-by-word fill does; tune this with
+# `python -m app.calibrate_page_estimator` against real renders.
+TEXT_LINE_SCALE = float(os.getenv("PAGE_ESTIMATE_TEXT_LINE_SCALE", "1.0"))
+
+
+def _rule(selector: str) -> dict:
+    """The declarations of the first rule in MAIN_CSS for exactly this selector."""
+    match = re.search(r"(?:^|[}\s])" + re.escape(selector) + r"\s*\{([^{}]*)\}", MAIN_CSS)
+    if not match:
+        return {}
+    declarations = {}
+    for declaration in match.group(1).split(";"):
+        if ":" in declaration:
+            name, value = declaration.split(":", 1)
+            declarations[name.strip()] = value.strip()
+    return declarations
+
+
+def _length(value: str, font_size: float = 0.0) -> float:
+    """A CSS length in points; `em` is relative to `font_size`."""
+    match = re.match(r"^(-?[\d.]+)\s*([a-z%]*)$", value.strip())
+    if not match:
+        return 0.0
+    number, unit = float(match.group(1)), match.group(2)
+    if unit == "em":
+        return number * font_size
+    return number * PT_PER_UNIT.get(unit, 1.0)
+
+
+def _line_height(value: str, font_size: float) -> float:
+    # Unitless line-heights are multiples of the font size, as in CSS.
+    if re.match(r"^[\d.]+$", value.strip()):
+        return float(value) * font_size
+    return _length(value, font_size)
+
+
+@lru_cache(maxsize=1)
+def page_layout() -> dict:
+    """Page geometry and text metrics, in points, read from the book stylesheet."""
+    page = _rule("@page")
+    width, height = (_length(v) for v in page.get("size", "140mm 216mm").split())
+    margin = _length(page.get("margin", "25mm"))
+
+    body = _rule("body")
+    font_size = _length(body.get("font-size", "11pt"))
+    body_line_height = _line_height(body.get("line-height", "1.6"), font_size)
+
+    paragraph = _rule(".content-block p")
+    paragraph_line_height = _line_height(paragraph.get("line-height", "1.7"), font_size)
+    drop_cap_size = _length(_rule(".content-block p:first-child::first-letter").get("font-size", "3.5em"), font_size)
+
+    heading = _rule(".content-page h2")
+    heading_size = _length(heading.get("font-size", "20pt"))
+
+    pre = _rule(".debug-page pre")
+    pre_size = _length(pre.get("font-size", "8pt"))
+
+    toc_entry = _rule(".toc-entry")
+    toc_size = _length(toc_entry.get("font-size", "8pt"))
+    toc_title = _rule(".toc-page h1")
+    toc_title_size = _length(toc_title.get("font-size", "24pt"))
+
+    return {
+        "content_width": width - 2 * margin,
+        "content_height": height - 2 * margin,
+        "font_size": font_size,
+        "line_height": paragraph_line_height,
+        "first_line_height": max(paragraph_line_height, drop_cap_size * paragraph_line_height / font_size),
+        "text_indent": _length(paragraph.get("text-indent", "2em"), font_size),
+        "paragraph_gap": _length(_rule(".content-block p + p").get("margin-top", "1em"), font_size),
+        "heading_height": heading_size * body_line_height / font_size + _length(heading.get("margin-bottom", "2.5em"), heading_size),
+        "pre_line_height": _line_height(pre.get("line-height", "1.1"), pre_size),
+        "pre_chars_per_line": max(1, int((width - 2 * margin) / (pre_size * MONOSPACE_ADVANCE_EM))),
+        "toc_entry_height": _line_height(toc_entry.get("line-height", "1.25"), toc_size) + _length(toc_entry.get("margin-bottom", "0.7em"), toc_size),
+        "toc_header_height": 2 * _length(_rule(".toc-page").get("padding", "2em 0").split()[0], font_size)
+        + toc_title_size * body_line_height / font_size + _length(toc_title.get("margin-bottom", "1.2em"), toc_title_size),
+    }
+
+
+@lru_cache(maxsize=1)
+def _advances() -> tuple:
+    """Advance widths of LibreBaskerville Regular, in em, keyed by code point, plus the average."""
+    font = TTFont(os.path.join(FONTS_DIR, "LibreBaskerville-Regular.ttf"), lazy=True)
+    units_per_em = font["head"].unitsPerEm
+    metrics = font["hmtx"]
+    advances = {code: metrics[glyph][0] / units_per_em for code, glyph in font.getBestCmap().items()}
+    font.close()
+    letters = [advances[ord(c)] for c in "etaoinshrdlu" if ord(c) in advances]
+    return advances, sum(letters) / len(letters)
+
+
+@lru_cache(maxsize=65536)
+def _word_em(word: str) -> float:
+    advances, average = _advances()
+    return sum(advances.get(ord(c), average) for c in word)
+
+
+def _paragraph_lines(text: str, line_width_em: float, indent_em: float) -> int:
+    """Lines a paragraph wraps to when filled greedily, word by word."""
+    space = _advances()[0].get(32, 0.25)
+    lines, used, empty = 1, indent_em, True
+    for word in text.split():
+        width = _word_em(word)
+        if empty:
+            used += width
+        elif used + space + width <= line_width_em:
+            used += space + width
+        else:
+            lines += 1
+            used = width
+        empty = False
+        while used > line_width_em:
+            # A word wider than the line is broken across lines.
+            lines += 1
+            used -= line_width_em
+    return lines
+
+
+def _flow_pages(text: str, layout: dict, heading: bool) -> int:
+    """Pages a `.content-page` section occupies: an optional heading, then its paragraphs."""
+    line_width_em = layout["content_width"] / layout["font_size"]
+    indent_em = layout["text_indent"] / layout["font_size"]
+    page_height = layout["content_height"]
+    pages, y = 1, layout["heading_height"] if heading else 0.0
+    for index, paragraph in enumerate(p for p in text.split("\n\n") if p.strip()):
+        lines = _paragraph_lines(paragraph, line_width_em, 0.0 if index == 0 else indent_em)
+        lines = max(1, round(lines * TEXT_LINE_SCALE))
+        if index:
+            y += layout["paragraph_gap"]
+        # The first paragraph opens with a drop cap, which makes its first line taller.
+        heights = [layout["first_line_height"] if index == 0 else layout["line_height"]] + [layout["line_height"]] * (lines - 1)
+        for height in heights:
+            if y + height > page_height and y > 0:
+                pages += 1
+                y = 0.0
+            y += height
+    return pages
+
+
+def _pre_pages(text: str, layout: dict) -> int:
+    lines = sum(max(1, math.ceil(len(line) / layout["pre_chars_per_line"])) for line in text.split("\n"))
+    per_page = max(1, int(layout["content_height"] // layout["pre_line_height"]))
+    return max(1, math.ceil(lines / per_page))
+
+
+def _toc_pages(entries: list, layout: dict) -> int:
+    height = layout["toc_header_height"] + len(entries) * layout["toc_entry_height"]
+    return max(1, math.ceil(height / layout["content_height"]))
+
+
+def estimate_pages(title: str, book_data: dict) -> dict:
+    """
+    Predicts the page count of `save_book_as_pdf(title, book_data, ...)` without
+    rendering, from the font metrics and the stylesheet's page and text settings.
+
+    Mirrors the template's page sequence: front matter (debug pages, blanks, title,
+    print date, contents), then the numbered body, where each section starts on a
+    new page. `start_page` uses the same numbering as the Table of Contents.
+    """
+    layout = page_layout()
+    entries = toc_entries(book_data)
+
+    front = 0
+    if book_data.get("swapi_call_text"):
+        front += 1
+    if book_data.get("swapi_json_output"):
+        front += _pre_pages(book_data["swapi_json_output"], layout)
+    front += 2  # blank pages
+    if book_data.get("image_path"):
+        front += 1
+    front += 2  # title and print date
+    front += 2  # blank pages
+    front += _toc_pages(entries, layout)
+    front += 1  # blank page
+
+    # Body pages are counted from 0 here and renumbered below so that, as in the
+    # Table of Contents, page 1 is the page where the first section starts.
+    sections = []
+    page = 0
+
+    def add(entry_index: int, text: str, heading: bool, pages_before: int = 0, pages_after: int = 0):
+        nonlocal page
+        page += pages_before
+        pages = _flow_pages(text, layout, heading)
+        sections.append({**entries[entry_index], "start_page": page, "pages": pages})
+        page += pages + pages_after
+
+    index = 0
+    if book_data.get("preface_text"):
+        add(index, book_data["preface_text"], heading=True, pages_after=1)
+        index += 1
+    if book_data.get("prologue_text"):
+        add(index, book_data["prologue_text"], heading=True, pages_after=1)
+        index += 1
+    for chapter in book_data.get("chapters", []):
+        # The chapter title page, and the illustration if there is one, come before the text.
+        before = 1 + (1 if chapter.get("image_path") else 0)
+        add(index, chapter.get("content", ""), heading=False, pages_before=before)
+        index += 1
+    if book_data.get("epilogue_text"):
+        add(index, book_data["epilogue_text"], heading=True, pages_before=1)
+
+    first_start = sections[0]["start_page"] if sections else 0
+    for section in sections:
+        section["start_page"] += 1 - first_start
+    return {
+        "total_pages": front + page,
+        "front_matter_pages": front,
+        "body_pages": page,
+        "sections": sections,
+    }
@@ -0,0 +1,268 @@
+# app/render_pool.py
+import asyncio
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+import traceback
+from collections import deque
+from typing import Callable, Optional
+
+# Each worker is replaced after this many books, or once its resident memory passes the
+# threshold, so fragmentation and caches left behind by WeasyPrint never accumulate.
+RENDER_MAX_RENDERS_PER_WORKER = int(os.getenv("RENDER_MAX_RENDERS_PER_WORKER", "25"))
+RENDER_MAX_RSS_BYTES = int(os.getenv("RENDER_MAX_RSS_BYTES", str(1536 * 1024 ** 2)))
+# A render still running after this long is treated as a runaway layout and its worker is killed.
+RENDER_TIMEOUT_SECONDS = float(os.getenv("RENDER_TIMEOUT_SECONDS", "600"))
+# How long a freshly spawned worker may take to import WeasyPrint and load the fonts.
+RENDER_WORKER_START_SECONDS = float(os.getenv("RENDER_WORKER_START_SECONDS", "120"))
+# Number of recent renders the timing metrics are computed over.
+RENDER_STATS_WINDOW = 200
+
+
+class RenderTimeout(RuntimeError):
+    pass
+
+
+class RenderFailed(RuntimeError):
+    pass
+
+
+def _rss_bytes() -> int:
+    """Current resident set size of this process, falling back to the peak where /proc is unavailable."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _worker_main(conn):
+    """
+    Entry point of a render process. Warms WeasyPrint up once, then renders
+    books sent over the pipe until it is told to stop or the pipe closes.
+    """
+    from app.book_pdf_exporter import save_book_as_pdf, warm_up
+
+    warm_up()
+    conn.send(("ready", _rss_bytes()))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+
+        def on_event(event: str, data: dict):
+            conn.send(("event", event, data))
+
+        try:
+            path = save_book_as_pdf(**request, on_event=on_event)
+            conn.send(("done", path, _rss_bytes()))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}", traceback.format_exc(), _rss_bytes()))
+
+
+class _RenderWorker:
+    def __init__(self, ctx, number: int):
+        self.number = number
+        self.renders = 0
+        self.rss_bytes = 0
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), name=f"pdf-render-{number}", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self, timeout: float):
+        if not self.conn.poll(timeout):
+            self.kill()
+            raise RenderFailed(f"Render worker {self.number} did not start within {timeout:.0f}s.")
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            self.kill()
+            raise RenderFailed(f"Render worker {self.number} exited while warming up (exit code {self.process.exitcode}).")
+        self.rss_bytes = message[1]
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class RenderPool:
+    """
+    A fixed set of long-lived processes that turn books into PDFs.
+
+    Workers are spawned up front with WeasyPrint imported and the fonts and
+    stylesheet already loaded, so a render starts laying out immediately.
+    Each worker is recycled after a number of renders or once its memory
+    grows past a threshold, and a render that exceeds its timeout has its
+    worker killed and replaced. Callers that find every worker busy wait in
+    line; `stats()` reports that queue and how long renders are taking.
+    """
+
+    def __init__(self, size: int, max_renders_per_worker: int = RENDER_MAX_RENDERS_PER_WORKER,
+                 max_rss_bytes: int = RENDER_MAX_RSS_BYTES, timeout_seconds: float = RENDER_TIMEOUT_SECONDS):
+        self.size = size
+        self.max_renders_per_worker = max_renders_per_worker
+        self.max_rss_bytes = max_rss_bytes
+        self.timeout_seconds = timeout_seconds
+        # Spawn rather than fork: the server process has an event loop and threads running.
+        self._ctx = multiprocessing.get_context("spawn")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._workers: set = set()
+        self._spawned = 0
+        self._waiting = 0
+        self._busy = 0
+        self._render_seconds = deque(maxlen=RENDER_STATS_WINDOW)
+        self._wait_seconds = deque(maxlen=RENDER_STATS_WINDOW)
+        self._counts = {"renders": 0, "failures": 0, "timeouts": 0, "crashes": 0, "recycles": 0}
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._idle = asyncio.Queue()
+        workers = await asyncio.gather(*(asyncio.to_thread(self._spawn) for _ in range(self.size)))
+        for worker in workers:
+            self._idle.put_nowait(worker)
+        print(f"Started {self.size} PDF render workers.")
+
+    async def stop(self):
+        for worker in list(self._workers):
+            await asyncio.to_thread(worker.close)
+        self._workers.clear()
+
+    def _spawn(self) -> _RenderWorker:
+        self._spawned += 1
+        worker = _RenderWorker(self._ctx, self._spawned)
+        self._workers.add(worker)
+        try:
+            worker.wait_ready(RENDER_WORKER_START_SECONDS)
+        except RenderFailed:
+            self._workers.discard(worker)
+            raise
+        return worker
+
+    def _replace(self, worker: _RenderWorker, reason: str) -> _RenderWorker:
+        print(f"Replacing render worker {worker.number} after {worker.renders} render(s): {reason}.")
+        self._workers.discard(worker)
+        if reason.startswith("recycle"):
+            worker.close()
+        else:
+            worker.kill()
+        return self._spawn()
+
+    async def render(self, title: str, book_data: dict, filename: str,
+                     on_event: Optional[Callable[[str, dict], None]] = None) -> str:
+        """
+        Renders a book on the next free worker and returns the PDF path.
+        `on_event` is called from a helper thread, as `save_book_as_pdf` would call it.
+        """
+        queued_at = time.monotonic()
+        self._waiting += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self._waiting -= 1
+        if worker is None:
+            try:
+                worker = await asyncio.to_thread(self._spawn)
+            except RenderFailed:
+                self._idle.put_nowait(None)
+                raise
+        self._wait_seconds.append(time.monotonic() - queued_at)
+        request = {"title": title, "book_data": book_data, "filename": filename}
+        # The worker goes back to the idle queue from the helper thread itself,
+        # so a cancelled caller cannot leak it while the render finishes.
+        return await asyncio.to_thread(self._dispatch, worker, request, on_event)
+
+    def _dispatch(self, worker: _RenderWorker, request: dict, on_event) -> str:
+        self._busy += 1
+        started_at = time.monotonic()
+        deadline = started_at + self.timeout_seconds
+        replace_reason = None
+        try:
+            worker.conn.send(request)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not worker.conn.poll(remaining):
+                    self._counts["timeouts"] += 1
+                    replace_reason = "render timed out"
+                    raise RenderTimeout(f"PDF render exceeded {self.timeout_seconds:.0f}s and was stopped.")
+                message = worker.conn.recv()
+                kind = message[0]
+                if kind == "event":
+                    if on_event:
+                        on_event(message[1], message[2])
+                    continue
+                worker.renders += 1
+                worker.rss_bytes = message[-1]
+                if kind == "error":
+                    self._counts["failures"] += 1
+                    print(f"Render worker {worker.number} failed:\n{message[2]}")
+                    raise RenderFailed(message[1])
+                self._counts["renders"] += 1
+                self._render_seconds.append(time.monotonic() - started_at)
+                return message[1]
+        except (EOFError, OSError) as e:
+            self._counts["crashes"] += 1
+            replace_reason = "worker died"
+            raise RenderFailed(f"Render worker exited mid-render (exit code {worker.process.exitcode}).") from e
+        finally:
+            self._busy -= 1
+            if replace_reason is None:
+                if worker.renders >= self.max_renders_per_worker:
+                    replace_reason = "recycle: render limit reached"
+                elif worker.rss_bytes >= self.max_rss_bytes:
+                    replace_reason = f"recycle: RSS {worker.rss_bytes // 1024 ** 2} MiB over limit"
+                if replace_reason:
+                    self._counts["recycles"] += 1
+            self._return(worker, replace_reason)
+
+    def _return(self, worker: Optional[_RenderWorker], replace_reason: Optional[str]):
+        if replace_reason:
+            try:
+                worker = self._replace(worker, replace_reason)
+            except RenderFailed as e:
+                # Leave an empty slot so the pool keeps its size; the next render starts a worker in it.
+                print(f"{e} Retrying on next use.")
+                worker = None
+        self._loop.call_soon_threadsafe(self._idle.put_nowait, worker)
+
+    def stats(self) -> dict:
+        """Queue depth, worker state and recent render timings, for the metrics endpoint."""
+        def percentiles(samples) -> dict:
+            if not samples:
+                return {"p50": None, "p95": None, "max": None}
+            ordered = sorted(samples)
+            return {
+                "p50": round(statistics.median(ordered), 3),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+                "max": round(ordered[-1], 3),
+            }
+
+        return {
+            "workers": self.size,
+            "busy": self._busy,
+            "queue_depth": self._waiting,
+            **self._counts,
+            "render_seconds": percentiles(self._render_seconds),
+            "queue_wait_seconds": percentiles(self._wait_seconds),
+            "worker_rss_bytes": sorted(w.rss_bytes for w in self._workers),
+        }
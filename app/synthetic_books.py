@@ -0,0 +1,91 @@
+# app/synthetic_books.py
+import json
+import os
+import random
+
+# Word counts of the book tiers we sell.
+BOOK_TIERS = {"15k": 15000, "30k": 30000, "50k": 50000}
+
+# Enough vocabulary, with realistic word lengths, for the text to wrap and hyphenate like a real chapter.
+_VOCABULARY = (
+    "the of and to in a is that your you with as for this its are chart sun moon rising venus mars "
+    "mercury jupiter saturn uranus neptune pluto house houses sign signs aspect aspects trine square "
+    "opposition conjunction sextile natal placement placements energy emotional relationships career "
+    "intuition transformation responsibility communication independence sensitivity creativity "
+    "ambition discipline partnership foundation expression understanding philosophical unconventional "
+    "nurturing protective analytical harmonious determination resilience vulnerability perspective "
+    "throughout between within beyond toward because although whenever especially naturally deeply"
+).split()
+
+SAMPLE_CHART = {"planets": [{"name": "Sun", "sign": "Leo", "house": 10}, {"name": "Moon", "sign": "Pisces", "house": 5}],
+                "houses": [{"house": n, "sign": "Aries"} for n in range(1, 13)]}
+
+
+def _paragraph(rng: random.Random, words: int) -> str:
+    sentences, remaining = [], words
+    while remaining > 0:
+        length = min(remaining, rng.randint(8, 24))
+        sentence = " ".join(rng.choice(_VOCABULARY) for _ in range(length))
+        sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        remaining -= length
+    return " ".join(sentences)
+
+
+def _text(rng: random.Random, words: int) -> str:
+    paragraphs, remaining = [], words
+    while remaining > 0:
+        length = min(remaining, rng.randint(60, 160))
+        paragraphs.append(_paragraph(rng, length))
+        remaining -= length
+    return "\n\n".join(paragraphs)
+
+
+def synthetic_text(words: int, seed=0) -> str:
+    """Deterministic prose of roughly `words` words, in paragraphs separated by blank lines."""
+    return _text(random.Random(f"text:{words}:{seed}"), words)
+
+
+def chapters_for(target_words: int) -> int:
+    """The chapter count `generate_astrology_book` uses for a word count."""
+    if target_words <= 20000:
+        return 4
+    if target_words <= 40000:
+        return 8
+    return 12
+
+
+def make_book(target_words: int, seed: int = 0, image_path: str = None, debug_pages: bool = True) -> dict:
+    """
+    A deterministic stand-in for `generate_astrology_book` output, shaped exactly
+    like the `book_data` that `save_book_as_pdf` renders. The same arguments
+    always give the same book, so renders can be compared across runs.
+    """
+    rng = random.Random(f"{target_words}:{seed}")
+    num_chapters = chapters_for(target_words)
+    frame_words = max(200, target_words // 30)
+    chapter_words = (target_words - 3 * frame_words) // num_chapters
+    return {
+        "swapi_call_text": "Symbolic data based on birth details." if debug_pages else None,
+        "swapi_json_output": json.dumps(SAMPLE_CHART, indent=4) if debug_pages else None,
+        "preface_text": _text(rng, frame_words),
+        "prologue_text": _text(rng, frame_words),
+        "epilogue_text": _text(rng, frame_words),
+        "chapters": [
+            {
+                "heading": " ".join(rng.choice(_VOCABULARY) for _ in range(rng.randint(2, 5))).title(),
+                "content": _text(rng, chapter_words),
+                "image_path": image_path,
+            }
+            for _ in range(num_chapters)
+        ],
+    }
+
+
+def write_sample_image(path: str, size: int = 1024) -> str:
+    """A noisy PNG the size of a generated chapter image, so image-heavy books weigh what real ones do."""
+    from PIL import Image
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if not os.path.exists(path):
+        Image.frombytes("RGB", (size, size), random.Random(size).randbytes(size * size * 3)).save(path)
+    return path
@@ -0,0 +1,165 @@
+# app/usage_ledger.py
+"""
+OpenAI usage ledger for book jobs.
+
+Every OpenAI call is made inside `call(stage, model, ...)`, which records one entry:
+prompt and completion tokens (from `response.usage`) or the number of images, the
+call's duration, and who it was for: job, tier (the target word count), stage and
+chapter. `run_book_job` keeps each job's entries as its `usage` artifact, next to
+its other artifacts, so they survive a resume and accumulate across attempts.
+
+    python -m app.usage_ledger                     # per-tier aggregates of every job in JOBS_DIR
+    python -m app.usage_ledger --out usage.json
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+# USD per 1K tokens, and per image by size. Only used to estimate cost when
+# summarising; override with OPENAI_PRICES (the same shape, as JSON).
+PRICES = {
+    "gpt-4-1106-preview": {"prompt": 0.01, "completion": 0.03},
+    "dall-e-3": {"1024x1024": 0.04, "1024x1792": 0.08, "1792x1024": 0.08},
+}
+PRICES.update(json.loads(os.getenv("OPENAI_PRICES", "{}")))
+
+# The job's entries, and who the calls made now are for. Context variables, so
+# concurrent jobs (and the asyncio tasks they start) keep theirs apart.
+_ledger: ContextVar[Optional[list]] = ContextVar("usage_ledger_entries", default=None)
+_attribution: ContextVar[dict] = ContextVar("usage_ledger_attribution", default={})
+
+
+@contextmanager
+def ledger(entries: list, **fields):
+    """Records the calls made in the enclosed block into `entries`, attributed to `fields` (job_id, tier)."""
+    entries_token = _ledger.set(entries)
+    attribution_token = _attribution.set({key: value for key, value in fields.items() if value is not None})
+    try:
+        yield entries
+    finally:
+        _attribution.reset(attribution_token)
+        _ledger.reset(entries_token)
+
+
+@contextmanager
+def attribute(**fields):
+    """Attributes the calls made in the enclosed block to these fields as well (e.g. chapter)."""
+    token = _attribution.set({**_attribution.get(), **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _attribution.reset(token)
+
+
+def tokens(response) -> dict:
+    """The token counts of a chat completion, for `entry.update(...)`."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+
+@contextmanager
+def call(stage: str, model: str, **fields):
+    """
+    Records the OpenAI call made in the enclosed block. Yields the entry, so the
+    caller can add what the response reports: `entry.update(tokens(response))` for a
+    chat completion, `entry["images"] = len(response.data)` for an image. A call that
+    raises is recorded with its error. Outside a ledger it does nothing.
+    """
+    entries = _ledger.get()
+    if entries is None:
+        yield {}
+        return
+    entry = {
+        **_attribution.get(), "stage": stage, "model": model, **fields,
+        "prompt_tokens": 0, "completion_tokens": 0, "images": 0,
+        "at": datetime.now(timezone.utc).isoformat(),
+    }
+    started = time.perf_counter()
+    try:
+        yield entry
+    except BaseException as e:
+        entry["error"] = type(e).__name__
+        raise
+    finally:
+        entry["seconds"] = round(time.perf_counter() - started, 3)
+        entries.append(entry)
+
+
+def cost(entry: dict) -> float:
+    """The estimated USD cost of one entry, or 0.0 for a model missing from PRICES."""
+    prices = PRICES.get(entry.get("model"), {})
+    if entry.get("images"):
+        return entry["images"] * prices.get(entry.get("size"), 0.0)
+    return (entry.get("prompt_tokens", 0) * prices.get("prompt", 0.0) + entry.get("completion_tokens", 0) * prices.get("completion", 0.0)) / 1000
+
+
+def summarize(entries: list) -> dict:
+    """
+    Per-tier aggregates of ledger entries: the number of books, and per stage the
+    calls, errors, tokens, images and estimated cost, in total and per book.
+    """
+    books = defaultdict(list)
+    for entry in entries:
+        books[entry.get("job_id")].append(entry)
+    tiers = {}
+    for book_entries in books.values():
+        tier = next((str(entry["tier"]) for entry in book_entries if entry.get("tier") is not None), "unknown")
+        summary = tiers.setdefault(tier, {"books": 0, "stages": {}, "total": {}})
+        summary["books"] += 1
+        for entry in book_entries:
+            for totals in (summary["stages"].setdefault(entry["stage"], {}), summary["total"]):
+                for field, value in (("calls", 1), ("errors", 1 if entry.get("error") else 0), ("prompt_tokens", entry.get("prompt_tokens", 0)),
+                                     ("completion_tokens", entry.get("completion_tokens", 0)), ("images", entry.get("images", 0)), ("cost", cost(entry))):
+                    totals[field] = totals.get(field, 0) + value
+    for summary in tiers.values():
+        for totals in list(summary["stages"].values()) + [summary["total"]]:
+            totals["cost"] = round(totals["cost"], 4)
+            totals["per_book"] = {field: round(totals[field] / summary["books"], 4 if field == "cost" else 1)
+                                  for field in ("calls", "prompt_tokens", "completion_tokens", "images", "cost")}
+    return tiers
+
+
+def print_summary(tiers: dict):
+    for tier, summary in sorted(tiers.items()):
+        print(f"\nTier {tier}: {summary['books']} book(s), ${summary['total']['cost']:.2f} (${summary['total']['per_book']['cost']:.4f} per book)")
+        print(f"  {'stage':<14} {'calls':>7} {'errors':>7} {'prompt/book':>12} {'compl./book':>12} {'images/book':>12} {'$/book':>9}")
+        for stage, totals in sorted(summary["stages"].items(), key=lambda item: -item[1]["cost"]):
+            per_book = totals["per_book"]
+            print(f"  {stage:<14} {totals['calls']:>7} {totals['errors']:>7} {per_book['prompt_tokens']:>12} "
+                  f"{per_book['completion_tokens']:>12} {per_book['images']:>12} {per_book['cost']:>9.4f}")
+
+
+def main():
+    from app.jobs import JOBS_DIR
+
+    parser = argparse.ArgumentParser(description="Per-tier OpenAI usage of the book jobs on disk.")
+    parser.add_argument("--jobs-dir", default=JOBS_DIR)
+    parser.add_argument("--out", help="also write the aggregates here as JSON")
+    args = parser.parse_args()
+
+    entries = []
+    for path in sorted(glob.glob(os.path.join(args.jobs_dir, "*", "usage.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            entries.extend(json.load(f))
+    if not entries:
+        print(f"No usage ledgers found under {args.jobs_dir}.")
+        return
+    tiers = summarize(entries)
+    print_summary(tiers)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(tiers, f, indent=2)
+        print(f"\nAggregates written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
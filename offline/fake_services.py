@@ -0,0 +1,575 @@
+# offline/fake_services.py
+"""
+Local stand-ins for every external service the factory calls, for load tests
+that cost nothing and hit no real rate limits:
+
+  openai      chat completions, image generations and the generated image files
+  astrology   AstrologyAPI's western_horoscope
+  lulu        Lulu's token endpoint and print jobs
+  aws         S3 (path-style, with multipart uploads), Secrets Manager, and the
+              DynamoDB, SQS and Step Functions calls the handlers make
+
+Each service is an HTTP server on its own port. Every endpoint samples a
+latency from a lognormal distribution (given as a median and a p99), fails a
+fraction of requests with a 5xx, throttles a fraction with a 429 (or the AWS
+equivalent), and can enforce a requests-per-second limit that answers 429 with
+Retry-After once its burst is spent. See PROFILES for the settings.
+
+    python -m offline.fake_services --profile realistic --time-scale 0.1
+
+starts them in the foreground and prints the environment variables that point
+the handlers at them; offline/run_orders.py starts them itself.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+from app.synthetic_books import SAMPLE_CHART, synthetic_text
+
+# Latency in seconds, as a median and a p99; rates are fractions of requests; rate_limit is requests/second.
+DEFAULT_ENDPOINT = {"median": 0.0, "p99": 0.0, "error_rate": 0.0, "throttle_rate": 0.0, "rate_limit": None, "burst": 10, "retry_after": 1.0}
+
+PROFILES = {
+    # No latency and no failures: measures the handlers themselves.
+    "instant": {},
+    # Roughly what production sees from each service.
+    "realistic": {
+        "openai.chat": {"median": 12.0, "p99": 60.0, "error_rate": 0.005, "throttle_rate": 0.01, "retry_after": 2.0},
+        "openai.images": {"median": 10.0, "p99": 30.0, "error_rate": 0.01, "throttle_rate": 0.01, "retry_after": 5.0},
+        "openai.files": {"median": 0.3, "p99": 1.5},
+        "astrology": {"median": 0.6, "p99": 3.0, "error_rate": 0.002},
+        "lulu.auth": {"median": 0.4, "p99": 2.0},
+        "lulu.print_jobs": {"median": 1.2, "p99": 6.0, "error_rate": 0.005},
+        "aws.s3": {"median": 0.03, "p99": 0.25, "throttle_rate": 0.001},
+        "aws.secretsmanager": {"median": 0.03, "p99": 0.15},
+        "aws.other": {"median": 0.02, "p99": 0.1},
+    },
+    # Production latencies with the failure modes turned up, to exercise retries and Catch paths.
+    "hostile": {
+        "openai.chat": {"median": 12.0, "p99": 90.0, "error_rate": 0.03, "throttle_rate": 0.08, "rate_limit": 2, "burst": 20, "retry_after": 5.0},
+        "openai.images": {"median": 10.0, "p99": 45.0, "error_rate": 0.05, "throttle_rate": 0.1, "rate_limit": 0.5, "burst": 5, "retry_after": 10.0},
+        "openai.files": {"median": 0.5, "p99": 4.0, "error_rate": 0.02},
+        "astrology": {"median": 0.8, "p99": 6.0, "error_rate": 0.03, "throttle_rate": 0.05, "rate_limit": 5, "burst": 5},
+        "lulu.auth": {"median": 0.5, "p99": 3.0, "error_rate": 0.02},
+        "lulu.print_jobs": {"median": 1.5, "p99": 10.0, "error_rate": 0.03, "throttle_rate": 0.02},
+        "aws.s3": {"median": 0.05, "p99": 0.5, "error_rate": 0.005, "throttle_rate": 0.01},
+        "aws.secretsmanager": {"median": 0.05, "p99": 0.3, "throttle_rate": 0.02},
+        "aws.other": {"median": 0.03, "p99": 0.2, "throttle_rate": 0.01},
+    },
+}
+
+# What the handlers find in Secrets Manager.
+FAKE_SECRETS = {
+    "OpenAIKey": "sk-offline",
+    "AstrologyAPIUserID": "offline",
+    "AstrologyAPIKey": "offline",
+    "LuluApiClientKey": "offline",
+    "LuluApiClientSecret": "offline",
+    "ShopifyWebhookSecret": "offline-webhook-secret",
+}
+
+SAMPLE_BIRTH_DATA = {"day": 31, "month": 3, "year": 1990, "hour": 11, "min": 46, "lat": 23.0225, "lon": 72.5714, "tzone": 5.5}
+
+
+def endpoint_settings(profile: str, overrides: dict = None) -> dict:
+    """Settings for every endpoint: the defaults, then the profile, then `overrides` (same shape as a profile)."""
+    settings = {}
+    for name in PROFILES["realistic"]:
+        settings[name] = {**DEFAULT_ENDPOINT, **PROFILES[profile].get(name, {}), **(overrides or {}).get(name, {})}
+    return settings
+
+
+def _png(size: int, seed: int) -> bytes:
+    """A small solid-colour PNG, so downloads and renders see a real image."""
+    colour = bytes(random.Random(seed).randrange(256) for _ in range(3))
+    raw = b"".join(b"\x00" + colour * size for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b"")
+
+
+class _Endpoint:
+    """Latency, failure and rate-limit behaviour of one endpoint, shared by every request to it."""
+
+    def __init__(self, settings: dict, time_scale: float, rng: random.Random):
+        self.settings = settings
+        self.time_scale = time_scale
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.tokens = float(settings["burst"])
+        self.refilled_at = time.monotonic()
+
+    def latency(self) -> float:
+        median, p99 = self.settings["median"], self.settings["p99"]
+        if median <= 0:
+            return 0.0
+        # 2.326 is the z-score of the 99th percentile.
+        sigma = math.log(max(p99, median) / median) / 2.326
+        with self.lock:
+            sample = self.rng.lognormvariate(math.log(median), sigma)
+        return sample * self.time_scale
+
+    def admit(self):
+        """None to serve the request, or ("throttle", retry_after) / ("error", None) to fail it."""
+        with self.lock:
+            # Latencies shrink with the time scale, so requests arrive faster; the limit keeps pace.
+            rate = self.settings["rate_limit"] and self.settings["rate_limit"] / max(self.time_scale, 0.001)
+            if rate:
+                now = time.monotonic()
+                self.tokens = min(float(self.settings["burst"]), self.tokens + (now - self.refilled_at) * rate)
+                self.refilled_at = now
+                if self.tokens < 1:
+                    return "throttle", (1 - self.tokens) / rate
+                self.tokens -= 1
+            roll = self.rng.random()
+        if roll < self.settings["throttle_rate"]:
+            return "throttle", self.settings["retry_after"] * self.time_scale
+        if roll < self.settings["throttle_rate"] + self.settings["error_rate"]:
+            return "error", None
+        return None
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service: str, handler, settings: dict, time_scale: float, seed: int):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.service = service
+        rng = random.Random(f"{service}:{seed}")
+        self.endpoints = {name: _Endpoint(value, time_scale, rng) for name, value in settings.items() if name.split(".")[0] == service}
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.state = {}
+        self.state_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on a slow fake (timeouts, retries) are expected, not worth a traceback.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count(self, key: str):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _send(self, status: int, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _serve(self, endpoint_name: str, handle, throttled, failed):
+        """Runs `handle` behind the endpoint's latency, rate limit and failure injection."""
+        server = self.server
+        endpoint = server.endpoints[endpoint_name]
+        server.count(f"{endpoint_name}.requests")
+        time.sleep(endpoint.latency())
+        verdict = endpoint.admit()
+        if verdict and verdict[0] == "throttle":
+            server.count(f"{endpoint_name}.throttled")
+            return throttled(max(verdict[1], 0.001))
+        if verdict and verdict[0] == "error":
+            server.count(f"{endpoint_name}.errors")
+            return failed()
+        return handle()
+
+    def _dispatch(self):
+        raise NotImplementedError
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = lambda self: self._dispatch()
+
+
+class OpenAIHandler(_Handler):
+    def _throttled(self, retry_after):
+        self._send(429, {"error": {"message": "Rate limit reached (offline fake).", "type": "requests", "code": "rate_limit_exceeded"}},
+                   headers={"Retry-After": f"{retry_after:.3f}", "retry-after-ms": str(int(retry_after * 1000))})
+
+    def _failed(self):
+        self._send(500, {"error": {"message": "The server had an error (offline fake).", "type": "server_error"}})
+
+    def _dispatch(self):
+        path = urlparse(self.path).path
+        if self.command == "POST" and path.endswith("/chat/completions"):
+            request = json.loads(self._body() or b"{}")
+            self._serve("openai.chat", lambda: self._chat(request), self._throttled, self._failed)
+        elif self.command == "POST" and path.endswith("/images/generations"):
+            request = json.loads(self._body() or b"{}")
+            self._serve("openai.images", lambda: self._image(request), self._throttled, self._failed)
+        elif self.command in ("GET", "HEAD") and path.startswith("/files/"):
+            self._serve("openai.files", lambda: self._file(path), self._throttled, self._failed)
+        else:
+            self._send(404, {"error": {"message": f"No fake for {self.command} {path}"}})
+
+    def _chat(self, request: dict):
+        prompt = " ".join(m.get("content") or "" for m in request.get("messages", []) if isinstance(m.get("content"), str))
+        seed = int(hashlib.sha1(prompt.encode()).hexdigest()[:8], 16)
+        if '"day", "month", "year"' in prompt:
+            content = json.dumps(SAMPLE_BIRTH_DATA)
+        elif "book architect" in prompt:
+            match = re.search(r"Generate exactly (\d+) chapters", prompt)
+            chapters = int(match.group(1)) if match else 4
+            content = json.dumps({
+                "title": "The Architecture of You",
+                "subtitle": "A Personal Interpretation",
+                "foreword": synthetic_text(80, seed),
+                "preface": synthetic_text(250, seed + 1),
+                "prologue": synthetic_text(350, seed + 2),
+                "chapters": [{"title": f"Chapter Theme {n}", "theme": synthetic_text(15, seed + 10 + n),
+                              "description": synthetic_text(60, seed + 30 + n)} for n in range(1, chapters + 1)],
+                "epilogue": synthetic_text(250, seed + 3),
+            })
+        elif prompt.startswith("Summarize"):
+            content = synthetic_text(min(request.get("max_tokens") or 100, 100), seed)
+        else:
+            match = re.search(r"approximately (\d+) words", prompt)
+            content = synthetic_text(int(match.group(1)) if match else 800, seed)
+        prompt_tokens = len(prompt.split()) * 4 // 3
+        completion_tokens = len(content.split()) * 4 // 3
+        self._send(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _image(self, request: dict):
+        name = f"{uuid.uuid4().hex}.png"
+        self._send(200, {"created": int(time.time()), "data": [{"url": f"{self.server.url}/files/{name}", "revised_prompt": request.get("prompt")}]})
+
+    def _file(self, path: str):
+        with self.server.state_lock:
+            image = self.server.state.get("image")
+            if image is None:
+                image = self.server.state["image"] = _png(1024, 0)
+        self._send(200, image, content_type="image/png")
+
+
+class AstrologyHandler(_Handler):
+    def _dispatch(self):
+        path = urlparse(self.path).path
+        if self.command == "POST" and path.endswith("/western_horoscope"):
+            self._body()
+            self._serve("astrology", lambda: self._send(200, SAMPLE_CHART),
+                        lambda retry_after: self._send(429, {"status": False, "msg": "Too many requests"}, headers={"Retry-After": f"{retry_after:.3f}"}),
+                        lambda: self._send(500, {"status": False, "msg": "Internal error"}))
+        else:
+            self._send(404, {"status": False, "msg": f"No fake for {path}"})
+
+
+class LuluHandler(_Handler):
+    def _throttled(self, retry_after):
+        self._send(429, {"detail": "Request was throttled."}, headers={"Retry-After": f"{retry_after:.3f}"})
+
+    def _failed(self):
+        self._send(502, {"detail": "Bad gateway (offline fake)."})
+
+    def _dispatch(self):
+        path = urlparse(self.path).path
+        body = self._body()
+        if self.command == "POST" and path.endswith("/openid-connect/token"):
+            self._serve("lulu.auth", lambda: self._send(200, {"access_token": uuid.uuid4().hex, "expires_in": 3600, "token_type": "Bearer"}),
+                        self._throttled, self._failed)
+        elif self.command == "POST" and path.rstrip("/").endswith("/print-jobs"):
+            self._serve("lulu.print_jobs", lambda: self._print_job(json.loads(body or b"{}")), self._throttled, self._failed)
+        else:
+            self._send(404, {"detail": f"No fake for {self.command} {path}"})
+
+    def _print_job(self, request: dict):
+        with self.server.state_lock:
+            jobs = self.server.state.setdefault("print_jobs", [])
+            jobs.append(request)
+            job_id = len(jobs)
+        self._send(201, {"id": job_id, "external_id": request.get("external_id"), "status": {"name": "CREATED"},
+                         "line_items": request.get("line_items", [])})
+
+
+class AWSHandler(_Handler):
+    """S3 on path-style URLs; Secrets Manager, DynamoDB, SQS and Step Functions on the JSON protocol."""
+
+    def _dispatch(self):
+        target = self.headers.get("X-Amz-Target")
+        if target:
+            request = json.loads(self._body() or b"{}")
+            service, operation = target.split(".", 1)
+            endpoint = "aws.secretsmanager" if service == "secretsmanager" else "aws.other"
+            self._serve(endpoint, lambda: self._json_operation(service, operation, request),
+                        lambda retry_after: self._send(400, {"__type": "ThrottlingException", "message": "Rate exceeded"}, "application/x-amz-json-1.0"),
+                        lambda: self._send(500, {"__type": "InternalFailure", "message": "Internal failure (offline fake)"}, "application/x-amz-json-1.0"))
+        else:
+            body = self._body()
+            self._serve("aws.s3", lambda: self._s3(body),
+                        lambda retry_after: self._s3_error(503, "SlowDown", "Please reduce your request rate."),
+                        lambda: self._s3_error(500, "InternalError", "We encountered an internal error (offline fake)."))
+
+    # --- JSON protocol services ---
+
+    def _json_error(self, error_type: str, message: str):
+        self._send(400, {"__type": error_type, "message": message}, "application/x-amz-json-1.0")
+
+    def _json_operation(self, service: str, operation: str, request: dict):
+        state, lock = self.server.state, self.server.state_lock
+        if operation == "GetSecretValue":
+            return self._send(200, {"ARN": request["SecretId"], "Name": request["SecretId"], "SecretString": json.dumps(FAKE_SECRETS)}, "application/x-amz-json-1.1")
+        if operation == "GetItem":
+            with lock:
+                table = state.setdefault("dynamodb", {}).setdefault(request["TableName"], [])
+                item = next((item for item in table if all(item.get(k) == v for k, v in request["Key"].items())), None)
+            return self._send(200, {"Item": item} if item else {}, "application/x-amz-json-1.0")
+        if operation == "PutItem":
+            item = request["Item"]
+            with lock:
+                table = state.setdefault("dynamodb", {}).setdefault(request["TableName"], [])
+                if "ConditionExpression" not in request:
+                    table.append(item)
+                    return self._send(200, {}, "application/x-amz-json-1.0")
+                # Only the optimistic-locking form is faked: attribute_not_exists(<key>) OR <attr> = :<value> ...
+                condition, values = request["ConditionExpression"], request.get("ExpressionAttributeValues", {})
+                key = re.search(r"attribute_not_exists\((\w+)\)", condition).group(1)
+                existing = next((index for index, stored in enumerate(table) if stored.get(key) == item[key]), None)
+                if existing is not None and not any(table[existing].get(attr) == values[value]
+                                                    for attr, value in re.findall(r"(\w+) = (:\w+)", condition)):
+                    return self._json_error("ConditionalCheckFailedException", "The conditional request failed")
+                if existing is None:
+                    table.append(item)
+                else:
+                    table[existing] = item
+            return self._send(200, {}, "application/x-amz-json-1.0")
+        if operation == "SendMessage":
+            body = request["MessageBody"]
+            message = {"MessageId": str(uuid.uuid4()), "ReceiptHandle": uuid.uuid4().hex, "Body": body,
+                       "MD5OfBody": hashlib.md5(body.encode()).hexdigest()}
+            with lock:
+                state.setdefault("sqs", {}).setdefault(request["QueueUrl"], []).append(message)
+            return self._send(200, {"MessageId": message["MessageId"], "MD5OfMessageBody": message["MD5OfBody"]}, "application/x-amz-json-1.0")
+        if operation == "ReceiveMessage":
+            with lock:
+                queue = state.setdefault("sqs", {}).setdefault(request["QueueUrl"], [])
+                now = time.time()
+                visible = [m for m in queue if m.get("_visible_at", 0) <= now]
+                taken = visible[:request.get("MaxNumberOfMessages", 1)]
+                queue[:] = [m for m in queue if not any(m is t for t in taken)]
+                state.setdefault("sqs_in_flight", {}).update({m["ReceiptHandle"]: {**m, "_queue_url": request["QueueUrl"]} for m in taken})
+            messages = [{k: v for k, v in m.items() if not k.startswith("_")} for m in taken]
+            return self._send(200, {"Messages": messages} if messages else {}, "application/x-amz-json-1.0")
+        if operation == "ChangeMessageVisibility":
+            # Puts the message back on its queue, hidden for VisibilityTimeout seconds.
+            with lock:
+                message = state.setdefault("sqs_in_flight", {}).pop(request["ReceiptHandle"], None)
+                if message:
+                    message = {**message, "ReceiptHandle": uuid.uuid4().hex, "_visible_at": time.time() + request["VisibilityTimeout"]}
+                    state.setdefault("sqs", {}).setdefault(message.pop("_queue_url"), []).append(message)
+            return self._send(200, {}, "application/x-amz-json-1.0")
+        if operation == "DeleteMessage":
+            with lock:
+                state.setdefault("sqs_in_flight", {}).pop(request["ReceiptHandle"], None)
+            return self._send(200, {}, "application/x-amz-json-1.0")
+        if operation == "StartExecution":
+            arn = request["stateMachineArn"].replace(":stateMachine:", ":execution:") + f":{request['name']}"
+            with lock:
+                executions = state.setdefault("executions", {})
+                if arn in executions:
+                    return self._json_error("ExecutionAlreadyExists", f"Execution already exists: '{arn}'")
+                executions[arn] = {"executionArn": arn, "stateMachineArn": request["stateMachineArn"], "name": request["name"],
+                                   "status": "RUNNING", "startDate": time.time(), "input": request.get("input", "{}")}
+            listener = state.get("on_start_execution")
+            if listener:
+                listener(executions[arn])
+            return self._send(200, {"executionArn": arn, "startDate": executions[arn]["startDate"]}, "application/x-amz-json-1.0")
+        if operation == "DescribeExecution":
+            with lock:
+                execution = state.get("executions", {}).get(request["executionArn"])
+            if not execution:
+                return self._json_error("ExecutionDoesNotExist", f"Execution does not exist: '{request['executionArn']}'")
+            return self._send(200, {k: v for k, v in execution.items() if not k.startswith("_")}, "application/x-amz-json-1.0")
+        return self._json_error("UnknownOperationException", f"No fake for {service}.{operation}")
+
+    # --- S3 ---
+
+    def _s3_error(self, status: int, code: str, message: str):
+        self._send(status, f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{code}</Code><Message>{escape(message)}</Message></Error>",
+                   "application/xml")
+
+    def _s3(self, body: bytes):
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        state, lock = self.server.state, self.server.state_lock
+        with lock:
+            objects = state.setdefault("s3", {})
+            uploads = state.setdefault("s3_uploads", {})
+
+        if not key:
+            # Bucket-level calls (CreateBucket, HeadBucket) always succeed.
+            return self._send(200, b"", "application/xml")
+        if self.command == "POST" and "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            with lock:
+                uploads[upload_id] = {"bucket": bucket, "key": key, "parts": {}}
+            return self._send(200, f"<InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                                   f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>", "application/xml")
+        if "uploadId" in query:
+            upload_id = query["uploadId"][0]
+            with lock:
+                upload = uploads.get(upload_id)
+            if upload is None:
+                return self._s3_error(404, "NoSuchUpload", "The specified upload does not exist.")
+            if self.command == "PUT":
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+                with lock:
+                    upload["parts"][int(query["partNumber"][0])] = body
+                return self._send(200, b"", "application/xml", headers={"ETag": etag})
+            if self.command == "POST":
+                numbers = [int(n) for n in re.findall(r"<PartNumber>(\d+)</PartNumber>", body.decode())]
+                with lock:
+                    data = b"".join(upload["parts"][n] for n in numbers)
+                    objects[(bucket, key)] = data
+                    uploads.pop(upload_id, None)
+                etag = f'"{hashlib.md5(data).hexdigest()}-{len(numbers)}"'
+                return self._send(200, f"<CompleteMultipartUploadResult><Location>{self.server.url}/{escape(bucket)}/{escape(key)}</Location>"
+                                       f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key><ETag>{escape(etag)}</ETag>"
+                                       f"</CompleteMultipartUploadResult>", "application/xml")
+            if self.command == "DELETE":
+                with lock:
+                    uploads.pop(upload_id, None)
+                return self._send(204, b"", "application/xml")
+        if self.command == "PUT":
+            with lock:
+                objects[(bucket, key)] = body
+            return self._send(200, b"", "application/xml", headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+        if self.command in ("GET", "HEAD"):
+            with lock:
+                data = objects.get((bucket, key))
+            if data is None:
+                return self._s3_error(404, "NoSuchKey", "The specified key does not exist.")
+            return self._send(200, data, "application/octet-stream", headers={"ETag": f'"{hashlib.md5(data).hexdigest()}"'})
+        if self.command == "DELETE":
+            with lock:
+                objects.pop((bucket, key), None)
+            return self._send(204, b"", "application/xml")
+        return self._s3_error(405, "MethodNotAllowed", f"{self.command} is not supported by the fake.")
+
+
+HANDLERS = {"openai": OpenAIHandler, "astrology": AstrologyHandler, "lulu": LuluHandler, "aws": AWSHandler}
+
+
+class FakeServices:
+    """Starts every fake in background threads. Use as a context manager, or call start() and stop()."""
+
+    def __init__(self, profile: str = "instant", overrides: dict = None, time_scale: float = 1.0, seed: int = 0):
+        settings = endpoint_settings(profile, overrides)
+        self.servers = {name: FakeServer(name, handler, settings, time_scale, seed) for name, handler in HANDLERS.items()}
+        self.threads = []
+
+    def start(self):
+        for server in self.servers.values():
+            thread = threading.Thread(target=server.serve_forever, name=f"fake-{server.service}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def environment(self) -> dict:
+        """Environment variables that point the src/* handlers, boto3 and the OpenAI SDK at the fakes."""
+        aws = self.servers["aws"].url
+        lulu = self.servers["lulu"].url
+        return {
+            "AWS_ENDPOINT_URL": aws,
+            "AWS_ACCESS_KEY_ID": "offline",
+            "AWS_SECRET_ACCESS_KEY": "offline",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            # The fake S3 reads plain bodies; skip the optional CRC trailers newer botocore adds.
+            "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required",
+            "AWS_RESPONSE_CHECKSUM_VALIDATION": "when_required",
+            "OPENAI_BASE_URL": f"{self.servers['openai'].url}/v1",
+            "ASTROLOGY_API_URL": f"{self.servers['astrology'].url}/v1",
+            "LULU_API_URL": lulu,
+            "LULU_AUTH_URL": f"{lulu}/auth/realms/glasstree/protocol/openid-connect/token",
+        }
+
+    def stats(self) -> dict:
+        stats = {}
+        for server in self.servers.values():
+            with server.stats_lock:
+                stats.update(server.stats)
+        return dict(sorted(stats.items()))
+
+    @property
+    def aws_state(self) -> dict:
+        return self.servers["aws"].state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=list(PROFILES), default="realistic")
+    parser.add_argument("--config", help="JSON file of per-endpoint overrides, shaped like a profile")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiplies every latency and Retry-After")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    overrides = None
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+    with FakeServices(args.profile, overrides, args.time_scale, args.seed) as services:
+        for name, value in services.environment().items():
+            print(f"export {name}={value}")
+        print("# S3 needs path-style addressing: set `s3 = addressing_style = path` in AWS_CONFIG_FILE.")
+        try:
+            while True:
+                time.sleep(60)
+                print(json.dumps(services.stats()))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
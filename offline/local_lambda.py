@@ -0,0 +1,165 @@
+# offline/local_lambda.py
+import importlib.util
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import defaultdict
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+TERRAFORM_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "terraform"))
+# The shared layer's own modules (book_tracing, ...), importable as they are from /opt/python on Lambda.
+LAYER_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "_build_artifacts", "python"))
+# What Lambda gives a function whose Terraform sets no timeout.
+DEFAULT_LAMBDA_TIMEOUT_SECONDS = 3
+
+_module_numbers = itertools.count(1)
+# Cold starts import one at a time: two threads importing the same third-party
+# package at once can each see the other's half-initialised module.
+_load_lock = threading.Lock()
+
+if LAYER_DIR not in sys.path:
+    sys.path.append(LAYER_DIR)
+
+
+class LambdaError(Exception):
+    """A failed invocation, named the way Step Functions sees it (the exception's class name)."""
+
+    def __init__(self, error: str, cause: str):
+        super().__init__(f"{error}: {cause}")
+        self.error = error
+        self.cause = cause
+
+
+def load_handler(name: str, module_name: str = None):
+    """
+    Imports src/<name>/app.py under its own module name. Its directory is importable
+    while it loads, for its sibling modules, but after site-packages, so packages a
+    function vendors for its zip (order_ingestion's typing_extensions) do not shadow
+    the installed ones the other handlers need.
+    """
+    directory = os.path.join(SRC_DIR, name)
+    sys.path.append(directory)
+    try:
+        spec = importlib.util.spec_from_file_location(module_name or f"{name}_app", os.path.join(directory, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+    return module
+
+
+def terraform_timeouts(terraform_dir: str = TERRAFORM_DIR) -> dict:
+    """Each aws_lambda_function's timeout in seconds, keyed by its Terraform resource name (= its src/ directory)."""
+    timeouts = {}
+    for filename in sorted(os.listdir(terraform_dir)):
+        if not filename.endswith(".tf"):
+            continue
+        with open(os.path.join(terraform_dir, filename), "r", encoding="utf-8") as f:
+            text = f.read()
+        for match in re.finditer(r'resource\s+"aws_lambda_function"\s+"(\w+)"\s*\{(.*?)\n\}', text, re.S):
+            timeout = re.search(r"^\s*timeout\s*=\s*(\d+)", match.group(2), re.M)
+            timeouts[match.group(1)] = int(timeout.group(1)) if timeout else DEFAULT_LAMBDA_TIMEOUT_SECONDS
+    return timeouts
+
+
+class LambdaContext:
+    """The parts of the Lambda context object the handlers use."""
+
+    def __init__(self, function_name: str, timeout_seconds: float):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self.memory_limit_in_mb = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "128"))
+        self._deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+class LocalLambda:
+    """
+    Invokes the src/* handlers in this process the way Lambda would. Each function
+    keeps a pool of containers, each a separately imported copy of its app.py with
+    its own module globals. An invocation takes an idle container or cold-starts a
+    new one, so concurrent invocations never share a handler's state, just as on
+    Lambda. Payloads go in and out as JSON.
+
+    A function that runs past its Terraform timeout fails with Sandbox.Timedout once
+    it returns; it is not interrupted.
+    """
+
+    def __init__(self, timeouts: dict = None, enforce_timeouts: bool = True):
+        self.timeouts = terraform_timeouts() if timeouts is None else timeouts
+        self.enforce_timeouts = enforce_timeouts
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.stats = defaultdict(lambda: {"invocations": 0, "cold_starts": 0, "errors": 0, "seconds": [], "cold_start_seconds": []})
+
+    @staticmethod
+    def function_name(function: str) -> str:
+        """The src/ directory behind a function ARN, name or alias."""
+        return function.split(":function:")[-1].split(":")[0]
+
+    def _container(self, name: str):
+        with self.lock:
+            if self.idle[name]:
+                return self.idle[name].pop()
+        started = time.perf_counter()
+        with _load_lock:
+            module = load_handler(name, f"{name}_app_{next(_module_numbers)}")
+        with self.lock:
+            self.stats[name]["cold_starts"] += 1
+            self.stats[name]["cold_start_seconds"].append(time.perf_counter() - started)
+        return module
+
+    def prewarm(self, functions) -> None:
+        """
+        Starts one container of each function up front. Besides sparing the first
+        invocations a cold start, this finishes every third-party import before
+        invocations run concurrently; openai, for one, checks sys.modules for httpx
+        on each request and trips over a copy another thread is still importing.
+        """
+        for function in functions:
+            name = self.function_name(function)
+            with self.lock:
+                warm = bool(self.idle[name])
+            if not warm:
+                container = self._container(name)
+                with self.lock:
+                    self.idle[name].append(container)
+
+    def invoke(self, function: str, payload):
+        name = self.function_name(function)
+        container = self._container(name)
+        timeout = self.timeouts.get(name, DEFAULT_LAMBDA_TIMEOUT_SECONDS)
+        started = time.perf_counter()
+        error = None
+        try:
+            result = container.lambda_handler(json.loads(json.dumps(payload)), LambdaContext(name, timeout))
+            result = json.loads(json.dumps(result))
+        except Exception as e:
+            error = LambdaError(type(e).__name__, json.dumps({
+                "errorMessage": str(e), "errorType": type(e).__name__, "stackTrace": traceback.format_exc().splitlines()}))
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.idle[name].append(container)
+                self.stats[name]["invocations"] += 1
+                self.stats[name]["seconds"].append(elapsed)
+        if error is None and self.enforce_timeouts and elapsed > timeout:
+            error = LambdaError("Sandbox.Timedout", json.dumps({"errorMessage": f"Task timed out after {timeout:.2f} seconds"}))
+        if error is not None:
+            with self.lock:
+                self.stats[name]["errors"] += 1
+            raise error
+        return result
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {name: {**value, "seconds": list(value["seconds"]), "cold_start_seconds": list(value["cold_start_seconds"])}
+                    for name, value in self.stats.items()}
@@ -0,0 +1,313 @@
+# offline/run_orders.py
+"""
+Pushes synthetic Shopify orders through the real src/* Lambda handlers, against
+the local fakes in offline/fake_services.py, and reports throughput and
+p50/p95/p99 latency per stage.
+
+    python -m offline.run_orders --orders 50 --workers 8 --profile realistic --time-scale 0.05
+    python -m offline.run_orders --orders 200 --workers 16 --profile hostile --time-scale 0.02 --skip-pdf --out run.json
+
+Each worker process takes orders one at a time and keeps its handlers warm
+between them. An order goes through the same hops it does in AWS:
+
+  order_ingestion (webhook) -> SQS -> start_execution -> Step Functions input
+  -> the state machine from terraform/step_functions.tf, run by
+     offline/state_machine.py: per book fetch_astrology -> architect_book ->
+     write_chapters, then release_capacity -> generate_pdf (the order's books
+     in chunks, one invocation each) -> notify_lulu
+
+Stages after start_execution are reported by state name. --skip-pdf replaces
+generate_pdf with a placeholder PDF upload, for machines without WeasyPrint.
+
+start_execution admits orders through the capacity ledger (see capacity_ledger in
+the shared layer), kept in the fake DynamoDB. An order it defers goes back on the
+fake queue, and the time a worker waits until it gets an order started is
+reported as `queued`. Its settings (OPENAI_TOKENS_PER_MINUTE, MAX_IN_FLIGHT_BOOKS,
+...) are read from the environment; --no-admission-control starts every order at
+once, as before.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import boto3
+
+from offline.fake_services import FAKE_SECRETS, PROFILES, FakeServices
+from offline.local_lambda import LocalLambda, load_handler
+from offline.state_machine import DEFAULT_MAP_CONCURRENCY, ExecutionStats, StateMachine, definition_from_terraform, lambda_functions, validate
+
+REGION = "us-east-1"
+ACCOUNT = "000000000000"
+ARTIFACTS_BUCKET = "offline-artifacts"
+RAW_PAYLOADS_BUCKET = "offline-raw-payloads"
+QUEUE_URL = f"https://sqs.{REGION}.amazonaws.com/{ACCOUNT}/offline-book-orders"
+STATE_MACHINE_ARN = f"arn:aws:states:{REGION}:{ACCOUNT}:stateMachine:offline-StateMachine"
+CAPACITY_TABLE_NAME = "offline-capacity"
+# How long a worker waits for an order it can start before giving up (a message start_execution
+# failed on, rather than deferred, never comes back to the fake queue).
+QUEUE_WAIT_TIMEOUT_SECONDS = 300
+SECRET_ARN = f"arn:aws:secretsmanager:{REGION}:{ACCOUNT}:secret:offline-api-keys"
+
+# The handlers that run before the state machine does.
+INGESTION_STAGES = ["order_ingestion", "start_execution"]
+
+# Loaded by this worker process: the ingestion handlers, keyed by src/ directory
+# name, and the state machine that runs everything after them.
+handlers = {}
+machine = None
+
+
+def handler_environment(services_env: dict, config_dir: str) -> dict:
+    config_path = os.path.join(config_dir, "aws_config")
+    with open(config_path, "w") as f:
+        # The fake S3 only understands path-style URLs.
+        f.write("[default]\ns3 =\n    addressing_style = path\n")
+    return {
+        **services_env,
+        "AWS_CONFIG_FILE": config_path,
+        "API_KEYS_SECRET_ARN": SECRET_ARN,
+        "ARTIFACTS_BUCKET": ARTIFACTS_BUCKET,
+        "RAW_PAYLOADS_BUCKET": RAW_PAYLOADS_BUCKET,
+        "ORDERS_TABLE_NAME": "offline-orders",
+        "BOOK_ORDERS_QUEUE_URL": QUEUE_URL,
+        "STATE_MACHINE_ARN": STATE_MACHINE_ARN,
+        "CAPACITY_TABLE_NAME": CAPACITY_TABLE_NAME,
+    }
+
+
+def _init_worker(environment: dict, skip_pdf: bool, verbose: bool, map_concurrency: int, time_scale: float):
+    global machine
+    os.environ.update(environment)
+    if not verbose:
+        # The handlers print whole payloads; at load-test volumes that drowns the report.
+        sys.stdout = open(os.devnull, "w")
+    for name in INGESTION_STAGES:
+        handlers[name] = load_handler(name)
+    lambdas = LocalLambda()
+    lambdas.prewarm(name for name in lambda_functions(definition_from_terraform()) if not (skip_pdf and "generate_pdf" in name))
+
+    def invoke(function: str, payload):
+        if skip_pdf and LocalLambda.function_name(function) == "generate_pdf":
+            return _placeholder_pdfs(payload["books"])
+        return lambdas.invoke(function, payload)
+
+    # main() has already shown the definition's warnings once.
+    # Retry intervals shrink with the fakes' latencies, as the handlers' own waits do.
+    machine = StateMachine(invoke=invoke, map_concurrency=map_concurrency, retry_time_scale=time_scale, warn=lambda message: None)
+
+
+def synthetic_order(number: int, books: int) -> dict:
+    """A Shopify orders/create webhook body with `books` book line items."""
+    return {
+        "id": 5_000_000 + number,
+        "customer": {"email": f"customer{number}@example.com", "first_name": "Offline", "last_name": f"Customer {number}"},
+        "shipping_address": {"first_name": "Offline", "last_name": f"Customer {number}", "address1": "1 Test Street", "city": "Springfield",
+                             "province_code": "IL", "country_code": "US", "zip": "62701"},
+        "line_items": [
+            {"id": 7_000_000 + number * 10 + n, "properties": [
+                {"name": "Custom Text", "value": f"The Book of Customer {number}.{n}"},
+                {"name": "Address", "value": "Ahmedabad, Gujarat, India"},
+                {"name": "Delivery Date & Time", "value": f"1990-03-{n + 1:02d} 11:46"},
+                {"name": "Word Count", "value": ("15000", "30000", "50000")[(number + n) % 3]},
+            ]}
+            for n in range(books)
+        ],
+    }
+
+
+def webhook_event(order: dict) -> dict:
+    body = json.dumps(order)
+    digest = hmac.new(FAKE_SECRETS["ShopifyWebhookSecret"].encode(), body.encode(), hashlib.sha256).digest()
+    return {"headers": {"x-shopify-hmac-sha256": base64.b64encode(digest).decode()}, "body": body}
+
+
+def run_order(number: int, books: int) -> dict:
+    """Runs one order end to end in this worker; returns per-stage timings and the outcome."""
+    timings = defaultdict(list)
+    started = time.perf_counter()
+
+    def timed(stage: str, function, *args):
+        stage_started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            timings[stage].append(time.perf_counter() - stage_started)
+
+    stage = "order_ingestion"
+    try:
+        response = timed(stage, handlers[stage].lambda_handler, webhook_event(synthetic_order(number, books)), None)
+        if response.get("statusCode") != 200:
+            raise RuntimeError(f"order_ingestion answered {response}")
+
+        # SQS delivers a message to start_execution; it may be another worker's order, as in a real queue.
+        # An order it has no capacity for yet goes back on the queue, hidden for a while.
+        sqs = boto3.client("sqs")
+        stage = "start_execution"
+        queued_at = time.perf_counter()
+        while True:
+            messages = sqs.receive_message(QueueUrl=QUEUE_URL, MaxNumberOfMessages=1).get("Messages", [])
+            if not messages:
+                if time.perf_counter() - queued_at > QUEUE_WAIT_TIMEOUT_SECONDS:
+                    raise RuntimeError(f"no order on the queue could be started within {QUEUE_WAIT_TIMEOUT_SECONDS}s")
+                time.sleep(0.05)
+                continue
+            message = messages[0]
+            record = {"messageId": message["MessageId"], "receiptHandle": message["ReceiptHandle"], "body": message["Body"]}
+            response = timed(stage, handlers[stage].lambda_handler, {"Records": [record]}, None)
+            if not response.get("batchItemFailures"):
+                break
+        timings["queued"].append(time.perf_counter() - queued_at)
+        sqs.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=message["ReceiptHandle"])
+        order_id = json.loads(message["Body"])["order_id"]
+        execution_arn = STATE_MACHINE_ARN.replace(":stateMachine:", ":execution:") + f":{order_id}"
+        execution_input = json.loads(boto3.client("stepfunctions").describe_execution(executionArn=execution_arn)["input"])
+
+        stage = "state_machine"
+        machine.stats = ExecutionStats()
+        execution = machine.execute(execution_input, name=order_id)
+        for name, entry in machine.stats.snapshot().items():
+            timings[name].extend(entry["seconds"])
+            if entry["errors"] and execution["status"] == "FAILED":
+                stage = name
+        if execution["status"] != "SUCCEEDED":
+            raise RuntimeError(f"execution failed with {execution['error']}: {execution['cause'][:1000]}")
+        outcome = {"ok": True}
+    except Exception as e:
+        outcome = {"ok": False, "failed_stage": stage, "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+    return {"order": number, "books": books, "seconds": time.perf_counter() - started, "timings": dict(timings), **outcome}
+
+
+def _placeholder_pdfs(written_books: list) -> list:
+    s3 = boto3.client("s3")
+    results = []
+    for book in written_books:
+        payload = dict(book["Payload"])
+        key = f"final-pdfs/{payload['order_id']}/{payload['line_item_id']}.pdf"
+        s3.put_object(Bucket=ARTIFACTS_BUCKET, Key=key, Body=b"%PDF-1.7\n% offline placeholder\n", ContentType="application/pdf")
+        payload["final_pdf_s3_path"] = f"s3://{ARTIFACTS_BUCKET}/{key}"
+        results.append({"Payload": payload})
+    return results
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        cuts = [ordered[0]] * 99
+    else:
+        cuts = statistics.quantiles(ordered, n=100, method="inclusive")
+    return {"count": len(ordered), "p50": round(cuts[49], 3), "p95": round(cuts[94], 3), "p99": round(cuts[98], 3),
+            "max": round(ordered[-1], 3), "total": round(sum(ordered), 3)}
+
+
+def summarise(results: list, wall_seconds: float) -> dict:
+    stages = defaultdict(list)
+    for result in results:
+        for stage, seconds in result["timings"].items():
+            stages[stage].extend(seconds)
+    succeeded = [r for r in results if r["ok"]]
+    failures = defaultdict(int)
+    for result in results:
+        if not result["ok"]:
+            failures[result["failed_stage"]] += 1
+    return {
+        "orders": len(results),
+        "succeeded": len(succeeded),
+        "failed_by_stage": dict(failures),
+        "books": sum(r["books"] for r in succeeded),
+        "wall_seconds": round(wall_seconds, 2),
+        "orders_per_minute": round(len(succeeded) / wall_seconds * 60, 2) if wall_seconds else 0.0,
+        "books_per_minute": round(sum(r["books"] for r in succeeded) / wall_seconds * 60, 2) if wall_seconds else 0.0,
+        "order_seconds": percentiles([r["seconds"] for r in succeeded]),
+        "stages": {stage: percentiles(seconds) for stage, seconds in stages.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=20)
+    parser.add_argument("--books-per-order", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=4, help="worker processes, each running one order at a time")
+    parser.add_argument("--profile", choices=list(PROFILES), default="realistic")
+    parser.add_argument("--config", help="JSON file of per-endpoint overrides for the fakes, shaped like a profile")
+    parser.add_argument("--time-scale", type=float, default=0.05, help="multiplies every fake latency and Retry-After")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--map-concurrency", type=int, default=DEFAULT_MAP_CONCURRENCY, help="books of one order written at once")
+    parser.add_argument("--skip-pdf", action="store_true", help="upload a placeholder instead of running generate_pdf")
+    parser.add_argument("--no-admission-control", action="store_true", help="start every order at once instead of through the capacity ledger")
+    parser.add_argument("--trace-dir", help="write the handlers' trace spans here; see offline/trace_waterfall.py")
+    parser.add_argument("--usage-dir", help="write the handlers' OpenAI usage ledger here; see offline/usage_report.py")
+    parser.add_argument("--metrics-dir", help="write the handlers' metrics here as NDJSON, one file per stage")
+    parser.add_argument("--profile-handlers", help="stages to profile, comma-separated, or all; see book_profiling in the shared layer")
+    parser.add_argument("--profile-dir", default="profiles", help="where --profile-handlers writes the profiles")
+    parser.add_argument("--verbose", action="store_true", help="show the handlers' own output")
+    parser.add_argument("--out", help="also write the summary and every order's result here as JSON")
+    args = parser.parse_args()
+
+    # Shown once here rather than by every worker.
+    for warning in validate(definition_from_terraform()):
+        print(f"WARNING: {warning}")
+    overrides = None
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+
+    with FakeServices(args.profile, overrides, args.time_scale, args.seed) as services, tempfile.TemporaryDirectory() as config_dir:
+        environment = handler_environment(services.environment(), config_dir)
+        environment["RESILIENCE_TIME_SCALE"] = str(args.time_scale)
+        if args.no_admission_control:
+            del environment["CAPACITY_TABLE_NAME"]
+        if args.trace_dir:
+            environment["TRACE_DIR"] = os.path.abspath(args.trace_dir)
+        if args.usage_dir:
+            environment["USAGE_DIR"] = os.path.abspath(args.usage_dir)
+        if args.metrics_dir:
+            environment["METRICS_DIR"] = os.path.abspath(args.metrics_dir)
+        if args.profile_handlers:
+            environment["PROFILE_HANDLERS"] = args.profile_handlers
+            environment["PROFILE_DIR"] = os.path.abspath(args.profile_dir)
+        ctx = multiprocessing.get_context("spawn")
+        results = []
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx, initializer=_init_worker, initargs=(environment, args.skip_pdf, args.verbose, args.map_concurrency, args.time_scale)) as pool:
+            futures = [pool.submit(run_order, n, args.books_per_order) for n in range(args.orders)]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if not result["ok"]:
+                    print(f"Order {result['order']} failed in {result['failed_stage']}: {result['error']}")
+        summary = summarise(results, time.perf_counter() - started)
+        summary["fake_services"] = services.stats()
+        summary["run"] = {"profile": args.profile, "time_scale": args.time_scale, "workers": args.workers, "map_concurrency": args.map_concurrency, "skip_pdf": args.skip_pdf}
+
+    print(f"\n{summary['succeeded']}/{summary['orders']} orders ({summary['books']} books) in {summary['wall_seconds']}s: "
+          f"{summary['orders_per_minute']} orders/min, {summary['books_per_minute']} books/min")
+    if summary["failed_by_stage"]:
+        print(f"Failures by stage: {summary['failed_by_stage']}")
+    print(f"\n{'stage':<26} {'calls':>6} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'max s':>8}")
+    for stage, stats in [("order (end to end)", summary["order_seconds"])] + list(summary["stages"].items()):
+        if stats["count"]:
+            print(f"{stage:<26} {stats['count']:>6} {stats['p50']:>8.3f} {stats['p95']:>8.3f} {stats['p99']:>8.3f} {stats['max']:>8.3f}")
+    injected = {k: v for k, v in summary["fake_services"].items() if not k.endswith(".requests")}
+    if injected:
+        print(f"\nInjected by the fakes: {injected}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "orders": sorted(results, key=lambda r: r["order"])}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,685 @@
+# offline/state_machine.py
+"""
+Runs the order state machine from terraform/step_functions.tf in one process,
+invoking the src/* handlers directly instead of through Step Functions and Lambda.
+
+    python -m offline.state_machine --input execution_input.json
+    python -m offline.state_machine --input execution_input.json --map-pool process --map-concurrency 8 --out result.json
+
+It implements the part of the Amazon States Language the definition uses: Task
+(lambda:invoke or a bare function ARN, with Parameters, ResultSelector,
+TimeoutSeconds, Retry and Catch), Map (ItemsPath, Parameters with the $$.Map
+context, Iterator/ItemProcessor, MaxConcurrency), Pass, Succeed and Fail, with
+InputPath, ResultPath and OutputPath. Paths may use [*], and templates the
+States.ArrayPartition intrinsic. Anything else is refused when the definition
+loads, or fails the execution, rather than half-run.
+
+Map iterations run on a thread pool, or on a process pool of warm workers with
+--map-pool process, up to the Map's MaxConcurrency (or --map-concurrency when it
+has none). Each concurrent invocation gets its own warm copy of the handler, as
+it would on Lambda; see offline/local_lambda.py. Together that makes this a
+single-host mode for running many orders without AWS. offline/run_orders.py uses
+it for everything after start_execution.
+
+The definition is read from the Terraform source: the `definition = jsonencode(...)`
+block is parsed as the small subset of HCL it is written in, and
+aws_lambda_function.<name>.arn references become ARNs whose function name is
+<name>, which is also its src/ directory.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from offline.local_lambda import LambdaError, LocalLambda
+
+TERRAFORM_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "terraform", "step_functions.tf"))
+REGION = "us-east-1"
+ACCOUNT = "000000000000"
+# Step Functions' limit on a state's input or output, in bytes.
+MAX_PAYLOAD_BYTES = 256 * 1024
+DEFAULT_MAP_CONCURRENCY = int(os.getenv("OFFLINE_MAP_CONCURRENCY", "10"))
+
+# The predefined error names. Matching is case-sensitive, so anything else under
+# "States." is an ordinary name that no error the service raises will carry.
+PREDEFINED_ERRORS = {
+    "States.ALL", "States.BranchFailed", "States.DataLimitExceeded", "States.ExceedToleratedFailureThreshold",
+    "States.HeartbeatTimeout", "States.Http.Socket", "States.IntrinsicFailure", "States.ItemReaderFailed",
+    "States.NoChoiceMatched", "States.ParameterPathFailure", "States.Permissions", "States.QueryEvaluationError",
+    "States.ResultPathMatchFailure", "States.ResultWriterFailed", "States.Runtime", "States.TaskFailed", "States.Timeout",
+}
+# States.ALL does not catch these; they always end the execution.
+TERMINAL_ERRORS = {"States.DataLimitExceeded", "States.Runtime"}
+SUPPORTED_STATES = {"Task", "Map", "Pass", "Succeed", "Fail"}
+
+
+class ExecutionFailed(Exception):
+    """An error the state being run did not handle, with the ASL error name and cause."""
+
+    def __init__(self, error: str, cause: str = ""):
+        super().__init__(f"{error}: {cause}")
+        self.error = error
+        self.cause = cause
+
+
+class DefinitionError(ValueError):
+    pass
+
+
+# -----------------------------------------------------------------------------
+# Reading the definition out of Terraform
+# -----------------------------------------------------------------------------
+
+_TOKEN = re.compile(r"""
+    (?P<space>\s+|\#[^\n]*|//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<name>[A-Za-z_][\w.\-]*)
+  | (?P<punct>[{}\[\]=:,()])
+""", re.S | re.X)
+
+
+def _resolve_reference(expression: str):
+    """The value of a Terraform expression the definition may contain."""
+    expression = expression.strip()
+    match = re.fullmatch(r"aws_lambda_function\.(\w+)\.arn", expression)
+    if match:
+        return f"arn:aws:lambda:{REGION}:{ACCOUNT}:function:{match.group(1)}"
+    if expression in ("true", "false"):
+        return expression == "true"
+    if expression == "null":
+        return None
+    raise DefinitionError(f"Cannot resolve Terraform expression {expression!r} offline")
+
+
+def _string_value(literal: str):
+    text = json.loads(literal)
+    whole = re.fullmatch(r"\$\{([^}]*)\}", text)
+    if whole:
+        return _resolve_reference(whole.group(1))
+    return re.sub(r"\$\{([^}]*)\}", lambda m: str(_resolve_reference(m.group(1))), text)
+
+
+def _tokens(source: str) -> list:
+    tokens, position = [], 0
+    while position < len(source):
+        match = _TOKEN.match(source, position)
+        if not match:
+            raise DefinitionError(f"Unexpected {source[position:position + 20]!r} in the state machine definition")
+        position = match.end()
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group()))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, expected: str = None):
+        kind, text = self.peek()
+        if expected is not None and text != expected:
+            raise DefinitionError(f"Expected {expected!r} in the state machine definition, found {text!r}")
+        self.position += 1
+        return kind, text
+
+    def value(self):
+        kind, text = self.peek()
+        if text == "{":
+            return self.object()
+        if text == "[":
+            return self.array()
+        self.take()
+        if kind == "string":
+            return _string_value(text)
+        if kind == "number":
+            return float(text) if "." in text else int(text)
+        if kind == "name":
+            return _resolve_reference(text)
+        raise DefinitionError(f"Unexpected {text!r} in the state machine definition")
+
+    def object(self) -> dict:
+        self.take("{")
+        result = {}
+        while self.peek()[1] != "}":
+            kind, text = self.take()
+            key = json.loads(text) if kind == "string" else text
+            if self.peek()[1] not in ("=", ":"):
+                raise DefinitionError(f"Expected = or : after {key!r} in the state machine definition")
+            self.take()
+            result[key] = self.value()
+            if self.peek()[1] == ",":
+                self.take()
+        self.take("}")
+        return result
+
+    def array(self) -> list:
+        self.take("[")
+        result = []
+        while self.peek()[1] != "]":
+            result.append(self.value())
+            if self.peek()[1] == ",":
+                self.take()
+        self.take("]")
+        return result
+
+
+def definition_from_terraform(path: str = TERRAFORM_PATH) -> dict:
+    """The state machine definition written as `definition = jsonencode({...})` in `path`."""
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.read()
+    start = re.search(r"\bdefinition\s*=\s*jsonencode\(", source)
+    if not start:
+        raise DefinitionError(f"No `definition = jsonencode(...)` in {path}")
+    parser = _Parser(_tokens(source[start.end():]))
+    definition = parser.value()
+    parser.take(")")
+    return definition
+
+
+def validate(definition: dict) -> list:
+    """Raises DefinitionError on what this executor cannot run; returns warnings about what it can."""
+    warnings = []
+
+    def walk(states: dict, start_at: str, where: str):
+        if start_at not in states:
+            raise DefinitionError(f"{where}: StartAt {start_at!r} is not a state")
+        for name, state in states.items():
+            kind = state.get("Type")
+            if kind not in SUPPORTED_STATES:
+                raise DefinitionError(f"{where}.{name}: state type {kind!r} is not supported offline")
+            if state.get("Next") and state["Next"] not in states:
+                raise DefinitionError(f"{where}.{name}: Next {state['Next']!r} is not a state")
+            for handler in state.get("Catch", []):
+                if handler.get("Next") not in states:
+                    raise DefinitionError(f"{where}.{name}: Catch Next {handler.get('Next')!r} is not a state")
+            for rule in state.get("Retry", []) + state.get("Catch", []):
+                for error in rule.get("ErrorEquals", []):
+                    if error.startswith("States.") and error not in PREDEFINED_ERRORS:
+                        known = next((e for e in PREDEFINED_ERRORS if e.lower() == error.lower()), None)
+                        warnings.append(f"{where}.{name}: ErrorEquals {error!r} is not a predefined error name"
+                                        + (f" (did you mean {known!r}?)" if known else "")
+                                        + "; it only matches an error of exactly that name, so this rule never fires")
+            if kind == "Task" and state.get("Resource") != "arn:aws:states:::lambda:invoke" and ":function:" not in state.get("Resource", ""):
+                raise DefinitionError(f"{where}.{name}: only Lambda tasks are supported offline, not {state.get('Resource')!r}")
+            if kind == "Map":
+                processor = state.get("ItemProcessor") or state.get("Iterator")
+                if not processor or state.get("ItemReader"):
+                    raise DefinitionError(f"{where}.{name}: only inline Maps over ItemsPath are supported offline")
+                walk(processor["States"], processor["StartAt"], f"{where}.{name}")
+
+    walk(definition["States"], definition["StartAt"], "States")
+    return warnings
+
+
+# -----------------------------------------------------------------------------
+# Paths
+# -----------------------------------------------------------------------------
+
+# A [*] step in a path: every element of an array.
+_WILDCARD = object()
+_ARRAY_PARTITION = re.compile(r"States\.ArrayPartition\(\s*(\$[^,]*?)\s*,\s*(\$[^,]*?|\d+)\s*\)")
+
+
+def _path_steps(path: str) -> list:
+    steps = []
+    for part in re.findall(r"\.([^.\[\]]+)|\[(\d+|\*)\]|\['([^']+)'\]", path[1:] if path.startswith("$") else path):
+        name, index, quoted = part
+        steps.append(_WILDCARD if index == "*" else int(index) if index else (name or quoted))
+    return steps
+
+
+def read_path(path: str, data, context: dict = None):
+    """
+    The value at a path such as "$.a.b[0]", or at "$$.Map.Item.Value" in the context
+    object. A path with [*] steps selects every match, as one flat list.
+    """
+    if path.startswith("$$"):
+        data, path = context or {}, path[1:]
+    if not path.startswith("$"):
+        raise ExecutionFailed("States.Runtime", f"Invalid path {path!r}")
+    steps = _path_steps(path)
+    if _WILDCARD in steps:
+        matches = [data]
+        for step in steps:
+            if step is _WILDCARD:
+                matches = [item for value in matches if isinstance(value, list) for item in value]
+            else:
+                matches = [value[step] for value in matches if _has_step(value, step)]
+        return matches
+    value = data
+    for step in steps:
+        try:
+            value = value[step]
+        except (KeyError, IndexError, TypeError):
+            raise ExecutionFailed("States.Runtime", f"The JSONPath {path!r} could not be found in the input")
+    return value
+
+
+def _has_step(value, step) -> bool:
+    if isinstance(step, int):
+        return isinstance(value, list) and -len(value) <= step < len(value)
+    return isinstance(value, dict) and step in value
+
+
+def _intrinsic(expression: str, data, context: dict = None):
+    """The value of the intrinsic functions the definition uses (only States.ArrayPartition)."""
+    match = _ARRAY_PARTITION.fullmatch(expression.strip())
+    if not match:
+        raise ExecutionFailed("States.Runtime", f"Intrinsic function {expression!r} is not supported offline")
+    array = read_path(match.group(1), data, context)
+    size = read_path(match.group(2), data, context) if match.group(2).startswith("$") else int(match.group(2))
+    if not isinstance(array, list) or not isinstance(size, int) or size < 1:
+        raise ExecutionFailed("States.IntrinsicFailure", f"Invalid arguments to {expression!r}")
+    return [array[start:start + size] for start in range(0, len(array), size)]
+
+
+def write_path(path, data, result):
+    """`data` with `result` placed at ResultPath `path` ("$" replaces it, None discards the result)."""
+    if path is None:
+        return data
+    steps = _path_steps(path)
+    if not steps:
+        return result
+    if not isinstance(data, dict):
+        raise ExecutionFailed("States.ResultPathMatchFailure", f"Unable to apply ResultPath {path!r} to a non-object input")
+    data = json.loads(json.dumps(data))
+    target = data
+    for step in steps[:-1]:
+        if not isinstance(target.get(step), dict):
+            target[step] = {}
+        target = target[step]
+    target[steps[-1]] = result
+    return data
+
+
+def apply_template(template, data, context: dict = None):
+    """Evaluates a Parameters or ResultSelector template: keys ending in ".$" take the value at their path."""
+    if isinstance(template, dict):
+        result = {}
+        for key, value in template.items():
+            if key.endswith(".$"):
+                if isinstance(value, str) and value.startswith("States."):
+                    result[key[:-2]] = _intrinsic(value, data, context)
+                elif isinstance(value, str) and value.startswith("$"):
+                    result[key[:-2]] = read_path(value, data, context)
+                else:
+                    raise ExecutionFailed("States.Runtime", f"Invalid template value ({key}: {value!r})")
+            else:
+                result[key] = apply_template(value, data, context)
+        return result
+    if isinstance(template, list):
+        return [apply_template(value, data, context) for value in template]
+    return template
+
+
+def lambda_functions(definition: dict) -> list:
+    """The functions the definition's Lambda tasks invoke, in the order they appear."""
+    functions = []
+
+    def walk(states: dict):
+        for state in states.values():
+            if state["Type"] == "Task":
+                function = state.get("Parameters", {}).get("FunctionName") if state["Resource"] == "arn:aws:states:::lambda:invoke" else state["Resource"]
+                if function and function not in functions:
+                    functions.append(function)
+            elif state["Type"] == "Map":
+                walk((state.get("ItemProcessor") or state["Iterator"])["States"])
+
+    walk(definition["States"])
+    return functions
+
+
+def _payload_bytes(data) -> int:
+    return len(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+
+
+def _matches(error_equals: list, error: str, from_task: bool) -> bool:
+    if error in error_equals:
+        return True
+    if "States.ALL" in error_equals and error not in TERMINAL_ERRORS:
+        return True
+    if "States.TaskFailed" in error_equals and from_task and error not in TERMINAL_ERRORS | {"States.Timeout"}:
+        return True
+    return False
+
+
+# -----------------------------------------------------------------------------
+# The executor
+# -----------------------------------------------------------------------------
+
+class ExecutionStats:
+    """Per-state timings and outcomes, merged across threads and Map worker processes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = defaultdict(lambda: {"entered": 0, "seconds": [], "errors": defaultdict(int), "retries": 0, "caught": 0,
+                                           "max_input_bytes": 0, "max_output_bytes": 0})
+
+    def record(self, name: str, **values):
+        with self.lock:
+            entry = self.states[name]
+            if "seconds" in values:
+                entry["entered"] += 1
+                entry["seconds"].append(values["seconds"])
+            if values.get("error"):
+                entry["errors"][values["error"]] += 1
+            entry["retries"] += values.get("retries", 0)
+            entry["caught"] += values.get("caught", 0)
+            entry["max_input_bytes"] = max(entry["max_input_bytes"], values.get("input_bytes", 0))
+            entry["max_output_bytes"] = max(entry["max_output_bytes"], values.get("output_bytes", 0))
+
+    def merge(self, other: dict):
+        with self.lock:
+            for name, theirs in other.items():
+                entry = self.states[name]
+                entry["entered"] += theirs["entered"]
+                entry["seconds"].extend(theirs["seconds"])
+                for error, count in theirs["errors"].items():
+                    entry["errors"][error] += count
+                for key in ("retries", "caught"):
+                    entry[key] += theirs[key]
+                for key in ("max_input_bytes", "max_output_bytes"):
+                    entry[key] = max(entry[key], theirs[key])
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {name: {**entry, "seconds": list(entry["seconds"]), "errors": dict(entry["errors"])} for name, entry in self.states.items()}
+
+
+class StateMachine:
+    """
+    Executes a state machine definition in this process. `invoke(function_arn, payload)`
+    runs a Lambda function and returns its JSON result or raises LambdaError; it defaults
+    to a LocalLambda over src/. `retry_time_scale` multiplies every Retry interval, so
+    local runs need not sleep for real.
+    """
+
+    def __init__(self, definition: dict = None, invoke=None, map_pool: str = "thread", map_concurrency: int = DEFAULT_MAP_CONCURRENCY,
+                 retry_time_scale: float = 1.0, warn=print):
+        self.definition = definition_from_terraform() if definition is None else definition
+        for warning in validate(self.definition):
+            warn(f"WARNING: {warning}")
+        if map_pool not in ("thread", "process"):
+            raise ValueError(f"map_pool must be 'thread' or 'process', not {map_pool!r}")
+        self.lambdas = None if invoke else LocalLambda()
+        if self.lambdas is not None:
+            self.lambdas.prewarm(lambda_functions(self.definition))
+        self.invoke = invoke or self.lambdas.invoke
+        self.map_pool = map_pool
+        self.map_concurrency = map_concurrency
+        self.retry_time_scale = retry_time_scale
+        self.stats = ExecutionStats()
+        self._process_pool = None
+        self._pool_lock = threading.Lock()
+
+    def close(self):
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, execution_input: dict, name: str = None) -> dict:
+        """
+        Runs one execution to the end. Returns {"status": "SUCCEEDED", "output": ...} or
+        {"status": "FAILED", "error": ..., "cause": ...}, plus its wall time.
+        """
+        name = name or f"offline-{int(time.time() * 1000)}"
+        context = {"Execution": {"Id": f"arn:aws:states:{REGION}:{ACCOUNT}:execution:offline:{name}", "Name": name, "Input": execution_input,
+                                 "StartTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}}
+        started = time.perf_counter()
+        try:
+            output = self.run_states(self.definition, execution_input, context)
+            result = {"status": "SUCCEEDED", "output": output}
+        except ExecutionFailed as e:
+            result = {"status": "FAILED", "error": e.error, "cause": e.cause}
+        result["seconds"] = time.perf_counter() - started
+        return result
+
+    def run_states(self, machine: dict, data, context: dict):
+        """Runs a StartAt/States block (the whole machine, or one Map iteration) and returns its output."""
+        name = machine["StartAt"]
+        while True:
+            state = machine["States"][name]
+            state_context = {**context, "State": {"Name": name, "EnteredTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}}
+            started = time.perf_counter()
+            error = None
+            try:
+                data, name = self.run_state(name, state, data, state_context)
+            except ExecutionFailed as e:
+                error = e.error
+                raise
+            finally:
+                self.stats.record(state_context["State"]["Name"], seconds=time.perf_counter() - started, error=error)
+            if name is None:
+                return data
+
+    def run_state(self, name: str, state: dict, data, context: dict):
+        """Runs one state; returns its output and the next state's name (None when this one ends the block)."""
+        kind = state["Type"]
+        input_bytes = _payload_bytes(data)
+        self.stats.record(name, input_bytes=input_bytes)
+        if input_bytes > MAX_PAYLOAD_BYTES:
+            raise ExecutionFailed("States.DataLimitExceeded", f"The input of state {name!r} is {input_bytes} bytes, over the {MAX_PAYLOAD_BYTES} byte limit")
+        if kind == "Fail":
+            raise ExecutionFailed(state.get("Error", "States.Fail"), state.get("Cause", ""))
+
+        input_path = state.get("InputPath", "$")
+        effective = read_path(input_path, data, context) if input_path is not None else {}
+        try:
+            if kind == "Succeed":
+                output, following = effective, None
+            elif kind == "Pass":
+                result = state["Result"] if "Result" in state else apply_template(state["Parameters"], effective, context) if "Parameters" in state else effective
+                output, following = write_path(state.get("ResultPath", "$"), data, result), state.get("Next")
+            else:
+                if kind == "Task":
+                    result = self.run_task(name, state, effective, context)
+                else:
+                    result = self.run_map(name, state, effective, context)
+                if "ResultSelector" in state:
+                    result = apply_template(state["ResultSelector"], result, context)
+                output, following = write_path(state.get("ResultPath", "$"), data, result), state.get("Next")
+        except ExecutionFailed as e:
+            handler = next((c for c in state.get("Catch", []) if _matches(c["ErrorEquals"], e.error, kind == "Task")), None)
+            if handler is None or e.error in TERMINAL_ERRORS:
+                raise
+            self.stats.record(name, caught=1, error=e.error)
+            output = write_path(handler.get("ResultPath", "$"), data, {"Error": e.error, "Cause": e.cause})
+            return output, handler["Next"]
+
+        if state.get("OutputPath", "$") is None:
+            output = {}
+        elif state.get("OutputPath", "$") != "$":
+            output = read_path(state["OutputPath"], output, context)
+        output_bytes = _payload_bytes(output)
+        self.stats.record(name, output_bytes=output_bytes)
+        if output_bytes > MAX_PAYLOAD_BYTES:
+            raise ExecutionFailed("States.DataLimitExceeded", f"The output of state {name!r} is {output_bytes} bytes, over the {MAX_PAYLOAD_BYTES} byte limit")
+        if kind != "Succeed" and state.get("End"):
+            following = None
+        return output, following
+
+    def run_task(self, name: str, state: dict, effective, context: dict):
+        parameters = apply_template(state["Parameters"], effective, context) if "Parameters" in state else effective
+        if state["Resource"] == "arn:aws:states:::lambda:invoke":
+            function, payload, wrap = parameters["FunctionName"], parameters.get("Payload", effective), True
+        else:
+            function, payload, wrap = state["Resource"], parameters, False
+
+        attempts = defaultdict(int)
+        while True:
+            started = time.perf_counter()
+            try:
+                result = self.invoke(function, payload)
+                timeout = state.get("TimeoutSeconds")
+                if timeout and time.perf_counter() - started > timeout:
+                    raise ExecutionFailed("States.Timeout", f"State {name!r} ran past its TimeoutSeconds of {timeout}")
+                if wrap:
+                    return {"ExecutedVersion": "$LATEST", "Payload": result, "StatusCode": 200}
+                return result
+            except (LambdaError, ExecutionFailed) as e:
+                retrier = next((r for r in state.get("Retry", []) if _matches(r["ErrorEquals"], e.error, True)), None)
+                if retrier is None or e.error in TERMINAL_ERRORS:
+                    raise ExecutionFailed(e.error, e.cause)
+                index = state["Retry"].index(retrier)
+                if attempts[index] >= retrier.get("MaxAttempts", 3):
+                    raise ExecutionFailed(e.error, e.cause)
+                delay = retrier.get("IntervalSeconds", 1) * retrier.get("BackoffRate", 2.0) ** attempts[index]
+                delay = min(delay, retrier.get("MaxDelaySeconds", delay))
+                if retrier.get("JitterStrategy") == "FULL":
+                    delay = random.uniform(0, delay)
+                attempts[index] += 1
+                self.stats.record(name, retries=1, error=e.error)
+                time.sleep(delay * self.retry_time_scale)
+
+    def run_map(self, name: str, state: dict, effective, context: dict) -> list:
+        items = read_path(state.get("ItemsPath", "$"), effective, context)
+        if not isinstance(items, list):
+            raise ExecutionFailed("States.Runtime", f"ItemsPath of state {name!r} did not select an array")
+        processor = state.get("ItemProcessor") or state["Iterator"]
+        template = state.get("ItemSelector", state.get("Parameters"))
+        inputs = []
+        for index, item in enumerate(items):
+            item_context = {**context, "Map": {"Item": {"Index": index, "Value": item}}}
+            inputs.append((apply_template(template, effective, item_context) if template is not None else item, item_context))
+        if not inputs:
+            return []
+
+        concurrency = state.get("MaxConcurrency") or self.map_concurrency
+        workers = max(1, min(concurrency, len(inputs)))
+        if self.map_pool == "process":
+            pool, owned = self._processes(), False
+            futures = [pool.submit(_run_iteration, processor, data, item_context, self.retry_time_scale) for data, item_context in inputs]
+        else:
+            pool, owned = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"map-{name}"), True
+            futures = [pool.submit(self._run_iteration, processor, data, item_context) for data, item_context in inputs]
+        try:
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            # As in Step Functions, one failed iteration fails the Map; the ones not yet started never run.
+            for future in pending:
+                future.cancel()
+            results = []
+            for future in futures:
+                if future.cancelled():
+                    continue
+                outcome = future.result()
+                if self.map_pool == "process":
+                    self.stats.merge(outcome["stats"])
+                    self._merge_lambda_stats(outcome["lambdas"])
+                    if outcome["status"] == "FAILED":
+                        raise ExecutionFailed(outcome["error"], outcome["cause"])
+                    outcome = outcome["output"]
+                results.append(outcome)
+            return results
+        finally:
+            if owned:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    def _run_iteration(self, processor: dict, data, context: dict):
+        return self.run_states(processor, data, context)
+
+    def _processes(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.map_concurrency, mp_context=multiprocessing.get_context("spawn"),
+                                                         initializer=_init_map_worker, initargs=(dict(os.environ),))
+            return self._process_pool
+
+    def _merge_lambda_stats(self, theirs: dict):
+        if self.lambdas is None:
+            return
+        with self.lambdas.lock:
+            for function, values in theirs.items():
+                entry = self.lambdas.stats[function]
+                for key in ("invocations", "cold_starts", "errors"):
+                    entry[key] += values[key]
+                for key in ("seconds", "cold_start_seconds"):
+                    entry[key].extend(values[key])
+
+
+# A Map worker process's own executor, which keeps its handlers warm between iterations.
+_worker_machine = None
+
+
+def _init_map_worker(environment: dict):
+    global _worker_machine
+    os.environ.update(environment)
+    _worker_machine = StateMachine({"StartAt": "Noop", "States": {"Noop": {"Type": "Succeed"}}}, map_pool="thread", warn=lambda message: None)
+
+
+def _run_iteration(processor: dict, data, context: dict, retry_time_scale: float) -> dict:
+    """Runs one Map iteration in a worker process; returns its outcome and what it measured."""
+    machine = _worker_machine
+    machine.retry_time_scale = retry_time_scale
+    machine.stats = ExecutionStats()
+    machine.lambdas.prewarm(lambda_functions(processor))
+    machine.lambdas.stats.clear()
+    try:
+        outcome = {"status": "SUCCEEDED", "output": machine.run_states(processor, data, context)}
+    except ExecutionFailed as e:
+        outcome = {"status": "FAILED", "error": e.error, "cause": e.cause}
+    except Exception as e:
+        outcome = {"status": "FAILED", "error": "States.Runtime", "cause": f"{type(e).__name__}: {e}\n{traceback.format_exc()}"}
+    outcome["stats"] = machine.stats.snapshot()
+    outcome["lambdas"] = machine.lambdas.snapshot()
+    return outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", required=True, help="JSON file with the execution input, as start_execution builds it")
+    parser.add_argument("--definition", default=TERRAFORM_PATH, help="Terraform file with the state machine, or a .json ASL definition")
+    parser.add_argument("--map-pool", choices=["thread", "process"], default="thread")
+    parser.add_argument("--map-concurrency", type=int, default=DEFAULT_MAP_CONCURRENCY, help="iterations at once for Maps without MaxConcurrency")
+    parser.add_argument("--retry-time-scale", type=float, default=1.0, help="multiplies every Retry interval")
+    parser.add_argument("--out", help="also write the result and per-state stats here as JSON")
+    args = parser.parse_args()
+
+    if args.definition.endswith(".json"):
+        with open(args.definition, "r", encoding="utf-8") as f:
+            definition = json.load(f)
+    else:
+        definition = definition_from_terraform(args.definition)
+    with open(args.input, "r", encoding="utf-8") as f:
+        execution_input = json.load(f)
+
+    with StateMachine(definition, map_pool=args.map_pool, map_concurrency=args.map_concurrency, retry_time_scale=args.retry_time_scale) as machine:
+        result = machine.execute(execution_input)
+        states = machine.stats.snapshot()
+        lambdas = machine.lambdas.snapshot()
+
+    print(f"\nExecution {result['status']} in {result['seconds']:.2f}s" + (f": {result['error']}: {result['cause'][:500]}" if result["status"] == "FAILED" else ""))
+    print(f"\n{'state':<28} {'runs':>5} {'total s':>8} {'max s':>7} {'errors':>7} {'max out KB':>11}")
+    for name, entry in states.items():
+        print(f"{name:<28} {entry['entered']:>5} {sum(entry['seconds']):>8.2f} {max(entry['seconds'], default=0):>7.2f} "
+              f"{sum(entry['errors'].values()):>7} {entry['max_output_bytes'] / 1024:>11.1f}")
+    print(f"\n{'function':<18} {'calls':>6} {'cold':>5} {'errors':>7}")
+    for name, entry in lambdas.items():
+        print(f"{name:<18} {entry['invocations']:>6} {entry['cold_starts']:>5} {entry['errors']:>7}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"result": result, "states": states, "lambdas": lambdas}, f, indent=2)
+    sys.exit(0 if result["status"] == "SUCCEEDED" else 1)
+
+
+if __name__ == "__main__":
+    main()
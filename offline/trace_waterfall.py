@@ -0,0 +1,146 @@
+# offline/trace_waterfall.py
+"""
+Turns the spans the Lambdas recorded for an order (see book_tracing in the
+shared layer) into a per-book waterfall.
+
+    python -m offline.trace_waterfall --bucket my-artifacts-bucket --trace-id 3f2a...
+    python -m offline.trace_waterfall --dir /tmp/traces                  # every trace run_orders --trace-dir wrote
+    python -m offline.trace_waterfall --dir /tmp/traces --trace-id 3f2a... --out order.trace.json
+
+Prints each book's stages and external calls in start order, and writes the
+trace in the Chrome trace event format: open the file in https://ui.perfetto.dev
+or chrome://tracing to see one row group per book, one row per stage invocation.
+The trace id of an order is in its DynamoDB record and its Step Functions input.
+"""
+import argparse
+import json
+import os
+from collections import defaultdict
+
+ORDER_LEVEL = "order"
+
+
+def load_documents(trace_id: str = None, directory: str = None, bucket: str = None, prefix: str = "traces") -> dict:
+    """Every invocation document, grouped by trace id."""
+    documents = defaultdict(list)
+    if directory:
+        root = os.path.join(directory, prefix)
+        for current, _, files in os.walk(os.path.join(root, trace_id) if trace_id else root):
+            for name in sorted(files):
+                if name.endswith(".json"):
+                    with open(os.path.join(current, name), "r", encoding="utf-8") as f:
+                        document = json.load(f)
+                    documents[document["trace_id"]].append(document)
+    else:
+        import boto3
+        s3 = boto3.client("s3")
+        pages = s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=f"{prefix}/{trace_id}/" if trace_id else f"{prefix}/")
+        for page in pages:
+            for item in page.get("Contents", []):
+                document = json.loads(s3.get_object(Bucket=bucket, Key=item["Key"])["Body"].read())
+                documents[document["trace_id"]].append(document)
+    return dict(documents)
+
+
+def _book_of(document: dict, span: dict, spans_by_id: dict) -> str:
+    """The line item a span belongs to: its own, its ancestors', its invocation's, or the order as a whole."""
+    while span is not None:
+        if span["attributes"].get("line_item_id"):
+            return str(span["attributes"]["line_item_id"])
+        span = spans_by_id.get(span.get("parent_id"))
+    return str(document["line_item_id"]) if document.get("line_item_id") else ORDER_LEVEL
+
+
+def rows(documents: list) -> list:
+    """
+    One row per span, with its book, stage, depth and offset from the start of the
+    trace. Invocations are in start order, each span followed by its children.
+    """
+    result = []
+    for document in sorted(documents, key=lambda document: min((span["start"] for span in document["spans"]), default=0)):
+        spans_by_id = {span["span_id"]: span for span in document["spans"]}
+        children = defaultdict(list)
+        for span in document["spans"]:
+            children[span.get("parent_id") if span.get("parent_id") in spans_by_id else None].append(span)
+
+        def visit(parent_id, depth):
+            for span in sorted(children[parent_id], key=lambda span: span["start"]):
+                result.append({"book": _book_of(document, span, spans_by_id), "stage": document["stage"], "request_id": document["request_id"],
+                               "cold_start": document.get("cold_start"), "depth": depth, **span})
+                visit(span["span_id"], depth + 1)
+
+        visit(None, 0)
+    if result:
+        origin = min(row["start"] for row in result)
+        for row in result:
+            row["offset_ms"] = round((row["start"] - origin) * 1000, 3)
+    return result
+
+
+def chrome_trace(trace_id: str, trace_rows: list) -> dict:
+    """The rows as Chrome trace events: a process per book, a thread per stage invocation."""
+    books = sorted({row["book"] for row in trace_rows}, key=lambda book: (book != ORDER_LEVEL, book))
+    invocations = {}
+    events = []
+    for pid, book in enumerate(books, start=1):
+        events.append({"ph": "M", "name": "process_name", "pid": pid, "args": {"name": "order" if book == ORDER_LEVEL else f"book {book}"}})
+        events.append({"ph": "M", "name": "process_sort_index", "pid": pid, "args": {"sort_index": pid}})
+    for row in trace_rows:
+        pid = books.index(row["book"]) + 1
+        key = (pid, row["request_id"])
+        if key not in invocations:
+            invocations[key] = len(invocations) + 1
+            label = f"{row['stage']}{' (cold)' if row['cold_start'] else ''}"
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": invocations[key], "args": {"name": label}})
+        args = dict(row["attributes"])
+        if row.get("error"):
+            args["error"] = row["error"]
+        events.append({"ph": "X", "name": row["name"], "cat": row["stage"], "pid": pid, "tid": invocations[key],
+                       "ts": round(row["start"] * 1_000_000), "dur": round(row["duration_ms"] * 1000), "args": args})
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"trace_id": trace_id}}
+
+
+def print_waterfall(trace_id: str, trace_rows: list, width: int = 40):
+    if not trace_rows:
+        return
+    end = max(row["offset_ms"] + row["duration_ms"] for row in trace_rows) or 1
+    print(f"\nTrace {trace_id}: {end / 1000:.2f}s")
+    for book in sorted({row["book"] for row in trace_rows}, key=lambda book: (book != ORDER_LEVEL, book)):
+        print(f"\n  {'order' if book == ORDER_LEVEL else f'book {book}'}")
+        for row in (row for row in trace_rows if row["book"] == book):
+            start = int(row["offset_ms"] / end * width)
+            length = max(1, int(row["duration_ms"] / end * width))
+            bar = " " * start + "#" * min(length, width - start)
+            size = row["attributes"].get("response_bytes") or row["attributes"].get("request_bytes") or row["attributes"].get("pdf_bytes")
+            label = ("  " * row["depth"] + row["name"])[:34]
+            print(f"    {label:<34} {row['offset_ms'] / 1000:>8.2f}s {row['duration_ms'] / 1000:>7.2f}s "
+                  f"{(f'{size / 1024:.0f}KB' if size else ''):>7} |{bar:<{width}}|{' ERROR' if row.get('error') else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="a TRACE_DIR the handlers wrote to")
+    source.add_argument("--bucket", help="the TRACE_BUCKET the handlers wrote to")
+    parser.add_argument("--trace-id", help="required with --bucket")
+    parser.add_argument("--prefix", default="traces")
+    parser.add_argument("--out", help="write the Chrome trace here (default: <trace id>.trace.json per trace)")
+    args = parser.parse_args()
+    if args.bucket and not args.trace_id:
+        parser.error("--bucket needs --trace-id")
+
+    traces = load_documents(args.trace_id, args.dir, args.bucket, args.prefix)
+    if not traces:
+        print("No trace documents found.")
+        return
+    for trace_id, documents in sorted(traces.items()):
+        trace_rows = rows(documents)
+        print_waterfall(trace_id, trace_rows)
+        out = args.out if args.out and len(traces) == 1 else f"{trace_id}.trace.json"
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(chrome_trace(trace_id, trace_rows), f)
+        print(f"\n  Chrome trace written to {out}")
+
+
+if __name__ == "__main__":
+    main()
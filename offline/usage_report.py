@@ -0,0 +1,65 @@
+# offline/usage_report.py
+"""
+Per-tier OpenAI usage from the ledger the Lambdas wrote (see usage_ledger in the
+shared layer): per stage, the calls, tokens and images a book of each tier takes,
+and what they cost at the ledger's PRICES.
+
+    python -m offline.usage_report --bucket my-artifacts-bucket
+    python -m offline.usage_report --bucket my-artifacts-bucket --order-id shpfy_1234
+    python -m offline.usage_report --dir /tmp/usage          # what run_orders --usage-dir wrote
+    python -m offline.usage_report --dir /tmp/usage --out usage.json
+
+Compare two runs' reports to measure a prompt change.
+"""
+import argparse
+import json
+import os
+
+import offline.local_lambda  # noqa: F401  (puts the shared layer on sys.path)
+import usage_ledger
+
+
+def load_entries(order_id: str = None, directory: str = None, bucket: str = None, prefix: str = "usage") -> list:
+    """Every ledger entry, optionally of one order."""
+    entries = []
+    if directory:
+        root = os.path.join(directory, prefix)
+        for current, _, files in os.walk(os.path.join(root, order_id) if order_id else root):
+            for name in sorted(files):
+                if name.endswith(".json"):
+                    with open(os.path.join(current, name), "r", encoding="utf-8") as f:
+                        entries.extend(json.load(f)["entries"])
+    else:
+        import boto3
+        s3 = boto3.client("s3")
+        pages = s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=f"{prefix}/{order_id}/" if order_id else f"{prefix}/")
+        for page in pages:
+            for item in page.get("Contents", []):
+                entries.extend(json.loads(s3.get_object(Bucket=bucket, Key=item["Key"])["Body"].read())["entries"])
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="a USAGE_DIR the handlers wrote to")
+    source.add_argument("--bucket", help="the USAGE_BUCKET the handlers wrote to")
+    parser.add_argument("--order-id")
+    parser.add_argument("--prefix", default="usage")
+    parser.add_argument("--out", help="also write the aggregates here as JSON")
+    args = parser.parse_args()
+
+    entries = load_entries(args.order_id, args.dir, args.bucket, args.prefix)
+    if not entries:
+        print("No usage ledger entries found.")
+        return
+    tiers = usage_ledger.summarize(entries)
+    usage_ledger.print_summary(tiers)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(tiers, f, indent=2)
+        print(f"\nAggregates written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,21 @@ import json
 import os
 from openai import OpenAI
 from urllib.parse import urlparse
+import book_tracing
+import usage_ledger
+import book_metrics
+import book_profiling
+import book_logging
+import resilience
 
 s3_client = boto3.client('s3')
 secrets_manager_client = boto3.client('secretsmanager')
+book_tracing.instrument(s3_client, secrets_manager_client)
+book_metrics.instrument(s3_client, secrets_manager_client)
 API_KEYS_SECRET_ARN = os.environ.get('API_KEYS_SECRET_ARN')
 ARTIFACTS_BUCKET = os.environ.get('ARTIFACTS_BUCKET')
-openai_client = OpenAI(api_key="dummy")
+# Retries are resilience's job, so they share its budget and circuit breaker.
+openai_client = OpenAI(api_key="dummy", max_retries=0)
 
 def parse_s3_path(s3_path):
     parsed = urlparse(s3_path, allow_fragments=False)
@@ -62,8 +71,12 @@ User's Astrological Data:
 # --- END OF THE FIX ---
 
 
+@book_tracing.traced_handler('architect_book')
+@usage_ledger.ledgered_handler('architect_book')
+@book_metrics.metrics_handler('architect_book')
+@book_profiling.profiled_handler('architect_book')
 def lambda_handler(event, context):
-    print(f"ArchitectBook received event: {json.dumps(event)}")
+    book_logging.log_event("ArchitectBook received event", event)
 
     # Your existing payload handling logic (Unchanged)
     if 'Payload' in event:
@@ -79,6 +92,8 @@ def lambda_handler(event, context):
         raise ValueError("Missing required fields after processing payload.")
 
     num_chapters = 4
+    tier = payload.get('tier')
+    book_metrics.set_tier(tier)
 
     try:
         secret_payload = secrets_manager_client.get_secret_value(SecretId=API_KEYS_SECRET_ARN)
@@ -93,12 +108,18 @@ def lambda_handler(event, context):
 
         prompt = build_book_structure_prompt(astrology_data, num_chapters)
         
-        response = openai_client.chat.completions.create(
-            model="gpt-4-turbo-preview", # Using a more recent model
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"},
-            temperature=0.3
-        )
+        with book_tracing.span('openai.chat', model="gpt-4-turbo-preview", prompt_chars=len(prompt)) as span, \
+                usage_ledger.attribute(tier=tier), \
+                usage_ledger.call('structure', "gpt-4-turbo-preview", prompt_chars=len(prompt)) as usage:
+            response = resilience.upstream('openai.chat').call(
+                openai_client.chat.completions.create,
+                model="gpt-4-turbo-preview", # Using a more recent model
+                messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"},
+                temperature=0.3
+            )
+            span.update(usage_ledger.tokens(response))
+            usage.update(usage_ledger.tokens(response))
 
         book_structure_str = response.choices[0].message.content
         book_structure = json.loads(book_structure_str)
@@ -4,14 +4,29 @@ import boto3
 import json
 import os
 import requests
+import book_tracing
+import book_metrics
+import book_profiling
+import book_logging
+import resilience
 
 s3_client = boto3.client('s3')
 secrets_manager_client = boto3.client('secretsmanager')
+book_tracing.instrument(s3_client, secrets_manager_client)
+book_metrics.instrument(s3_client, secrets_manager_client)
 API_KEYS_SECRET_ARN = os.environ['API_KEYS_SECRET_ARN']
 ARTIFACTS_BUCKET = os.environ['ARTIFACTS_BUCKET']
+# Overridable so the offline harness (offline/fake_services.py) can stand in for AstrologyAPI.
+ASTROLOGY_API_URL = os.environ.get('ASTROLOGY_API_URL', 'https://json.astrologyapi.com/v1')
 
+# Reused across warm invocations so AstrologyAPI calls skip the TCP/TLS handshake.
+http_session = requests.Session()
+
+@book_tracing.traced_handler('fetch_astrology')
+@book_metrics.metrics_handler('fetch_astrology')
+@book_profiling.profiled_handler('fetch_astrology')
 def lambda_handler(event, context):
-    print(f"Received event: {json.dumps(event)}")
+    book_logging.log_event("FetchAstrology received event", event)
     
     order_id = event.get('order_id')
     line_item_id = event.get('line_item_id')
@@ -30,13 +45,19 @@ def lambda_handler(event, context):
             raise ValueError("Astrology API credentials not found in Secrets Manager")
 
         print(f"Calling AstrologyAPI for order {order_id}, line item {line_item_id}...")
-        response = requests.post(
-            "https://json.astrologyapi.com/v1/western_horoscope",
-            auth=(astrology_api_user_id, astrology_api_key),
-            json=birth_data,
-            timeout=15 
-        )
-        response.raise_for_status()
+        def fetch_horoscope():
+            with book_tracing.span('astrologyapi.western_horoscope') as span, book_metrics.timer('astrology_api_latency'):
+                response = http_session.post(
+                    f"{ASTROLOGY_API_URL}/western_horoscope",
+                    auth=(astrology_api_user_id, astrology_api_key),
+                    json=birth_data,
+                    timeout=15 
+                )
+                span.update(status=response.status_code, response_bytes=len(response.content))
+                response.raise_for_status()
+            return response
+
+        response = resilience.upstream('astrologyapi').call(fetch_horoscope)
         astrology_data = response.json()
         print("Successfully received data from AstrologyAPI.")
 
@@ -3,27 +3,83 @@
 import boto3
 import os
 import json
-from book_pdf_exporter import save_book_as_pdf
+import multiprocessing
+import multiprocessing.connection
+import time
+from book_pdf_exporter import save_book_as_pdf, warm_up
+from s3_stream import open_upload
+from render_guard import guarded_render, MEMORY_LIMIT_BYTES, RENDER_MEMORY_FRACTION
+from workspace import (
+    Workspace, InsufficientScratchSpace, ESTIMATED_IMAGE_BYTES, ESTIMATED_PDF_OVERHEAD_BYTES,
+    sweep as sweep_workspaces, usage as workspace_usage
+)
 from urllib.parse import urlparse
 import requests
+import book_tracing
+import book_metrics
+import book_profiling
+import book_logging
 
-s3_client = boto3.client('s3')
+s3_client = book_metrics.instrument(book_tracing.instrument(boto3.client('s3')))
 ARTIFACTS_BUCKET = os.environ.get('ARTIFACTS_BUCKET')
 
+# Reused across chapters and warm invocations so image downloads skip the TCP/TLS handshake.
+http_session = requests.Session()
+
+# "stream" sends the PDF to S3 in parts while WeasyPrint writes it; "file" renders to /tmp, then uploads.
+PDF_OUTPUT_MODE = os.environ.get('PDF_OUTPUT_MODE', 'stream')
+
+# Renders must finish this long before the invocation times out, leaving time to report back.
+RENDER_DEADLINE_MARGIN_SECONDS = float(os.environ.get('RENDER_DEADLINE_MARGIN_SECONDS', '30'))
+
+# Set per invocation and inherited by forked book processes: when renders must be done by
+# (a time.monotonic() value) and how many renders share the function's memory.
+invocation_deadline = None
+render_memory_share = 1
+
+# The most memory one book's render takes.
+RENDER_MEMORY_MB_PER_BOOK = float(os.environ.get('RENDER_MEMORY_MB_PER_BOOK', '1024'))
+
+# Books of one order rendered at once. Defaults to one per vCPU the function was given,
+# but no more than fit in the renders' share of memory.
+PDF_BATCH_WORKERS = int(os.environ.get('PDF_BATCH_WORKERS') or max(1, min(
+    os.cpu_count() or 1, int(MEMORY_LIMIT_BYTES * RENDER_MEMORY_FRACTION // (RENDER_MEMORY_MB_PER_BOOK * 1024 ** 2))
+)))
+
 def parse_s3_path(s3_path):
     parsed = urlparse(s3_path, allow_fragments=False)
     return parsed.netloc, parsed.path.lstrip('/')
 
+@book_tracing.traced_handler('generate_pdf')
+@book_metrics.metrics_handler('generate_pdf')
+@book_profiling.profiled_handler('generate_pdf')
 def lambda_handler(event, context):
-    print(f"Received raw event from Step Functions: {json.dumps(event, indent=2)}")
+    global invocation_deadline, render_memory_share
+    book_logging.log_event("GeneratePDF received event", event)
+
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000 if context else 900
+    invocation_deadline = time.monotonic() + remaining_seconds - RENDER_DEADLINE_MARGIN_SECONDS
+    render_memory_share = 1
 
     if 'Payload' in event and isinstance(event['Payload'], dict):
         payload = event['Payload']
     else:
         payload = event
-    
-    print(f"Using final processed payload: {json.dumps(payload, indent=2)}")
 
+    # Anything still in /tmp from an earlier invocation on this container is no longer needed.
+    sweep_workspaces()
+    print(f"--- Ephemeral storage before: {json.dumps(workspace_usage())} ---")
+    try:
+        # A chunk of an order's books in one invocation (see GeneratePDFChunks in the state machine).
+        if 'books' in payload:
+            return generate_pdf_batch(payload['books'])
+
+        return generate_book_pdf(payload)
+    finally:
+        print(f"--- Ephemeral storage after: {json.dumps(workspace_usage())} ---")
+
+def generate_book_pdf(payload):
+    """Downloads one book's chapters and images, renders it and uploads the PDF to S3."""
     order_id = payload.get('order_id')
     line_item_id = payload.get('line_item_id')
     chapters_data = payload.get('chapters_data')
@@ -33,83 +89,231 @@ def lambda_handler(event, context):
     if not all([order_id, line_item_id, chapters_data, full_book_structure, astrology_json_s3_path]):
         raise ValueError("Missing critical data in the payload for PDF generation.")
 
-    local_tmp_dir = f"/tmp/{order_id}/{line_item_id}"
-    os.makedirs(local_tmp_dir, exist_ok=True)
+    # Scratch space for this book only; removed as soon as the PDF is uploaded, even on failure.
+    with Workspace(f"{order_id}-{line_item_id}") as workspace, book_tracing.span('book', line_item_id=line_item_id):
+        try:
+            return _generate_book_pdf(payload, workspace)
+        except Exception as e:
+            print(f"ERROR: PDF generation failed for order {order_id}: {e}")
+            raise e
 
-    try:
-        astro_bucket, astro_key = parse_s3_path(astrology_json_s3_path)
-        astro_object = s3_client.get_object(Bucket=astro_bucket, Key=astro_key)
-        astrology_json = json.loads(astro_object['Body'].read().decode('utf-8'))
-        
-        book_data = {
-            "swapi_call_text": "Symbolic data based on birth details.",
-            "swapi_json_output": json.dumps(astrology_json, indent=4),
-            "preface_text": full_book_structure.get("preface"),
-            "prologue_text": full_book_structure.get("prologue"),
-            "epilogue_text": full_book_structure.get("epilogue"),
-            "chapters": []
-        }
-
-        print(f"--- Downloading assets for order: {order_id}, line item: {line_item_id} ---")
-        
-        # --- THIS IS THE RESTORED FOR LOOP ---
-        for idx, chapter in enumerate(chapters_data, start=1):
-            text_s3_path = chapter.get('chapter_text_s3_path')
-            if not text_s3_path:
-                print(f"Warning: chapter_text_s3_path missing for chapter index {idx}, skipping.")
-                continue
-
-            bucket, key = parse_s3_path(text_s3_path)
-            s3_object = s3_client.get_object(Bucket=bucket, Key=key)
-            chapter_json_content = json.loads(s3_object['Body'].read().decode('utf-8'))
-            full_chapter_text = chapter_json_content.get('chapter_text', '')
-
-            image_url = chapter.get('image_url')
-            local_image_path = None
-            if image_url:
-                try:
-                    image_filename = f"chapter_{idx}_image.png"
-                    local_image_path = os.path.join(local_tmp_dir, image_filename)
-                    response = requests.get(image_url, stream=True)
+def _generate_book_pdf(payload, workspace):
+    order_id = payload['order_id']
+    line_item_id = payload['line_item_id']
+    chapters_data = payload['chapters_data']
+    full_book_structure = payload['full_book_structure']
+    # Books of one batch can differ in tier, so each of their metrics carries its own.
+    tier = payload.get('tier')
+
+    # Fail before downloading anything if the images (and a local PDF) clearly will not fit.
+    image_count = sum(1 for chapter in chapters_data if chapter.get('image_url'))
+    if PDF_OUTPUT_MODE == "stream":
+        workspace.reserve(image_count * ESTIMATED_IMAGE_BYTES, "this book's images")
+    else:
+        workspace.reserve(image_count * ESTIMATED_IMAGE_BYTES * 2 + ESTIMATED_PDF_OVERHEAD_BYTES, "this book's images and PDF")
+
+    astro_bucket, astro_key = parse_s3_path(payload['astrology_json_s3_path'])
+    astro_object = s3_client.get_object(Bucket=astro_bucket, Key=astro_key)
+    astrology_json = json.load(astro_object['Body'])
+
+    book_data = {
+        "swapi_call_text": "Symbolic data based on birth details.",
+        "swapi_json_output": json.dumps(astrology_json, indent=4),
+        "preface_text": full_book_structure.get("preface"),
+        "prologue_text": full_book_structure.get("prologue"),
+        "epilogue_text": full_book_structure.get("epilogue"),
+        "chapters": []
+    }
+
+    print(f"--- Downloading assets for order: {order_id}, line item: {line_item_id} ---")
+
+    # --- THIS IS THE RESTORED FOR LOOP ---
+    image_bytes = 0
+    for idx, chapter in enumerate(chapters_data, start=1):
+        text_s3_path = chapter.get('chapter_text_s3_path')
+        if not text_s3_path:
+            print(f"Warning: chapter_text_s3_path missing for chapter index {idx}, skipping.")
+            continue
+
+        bucket, key = parse_s3_path(text_s3_path)
+        s3_object = s3_client.get_object(Bucket=bucket, Key=key)
+        chapter_json_content = json.load(s3_object['Body'])
+        full_chapter_text = chapter_json_content.get('chapter_text', '')
+
+        image_url = chapter.get('image_url')
+        local_image_path = None
+        if image_url:
+            try:
+                local_image_path = workspace.file(f"chapter_{idx}_image.png")
+                with book_tracing.span('openai.image_download', chapter_index=idx) as span, book_metrics.timer('image_download_latency', tier):
+                    response = http_session.get(image_url, stream=True, timeout=60)
                     response.raise_for_status()
+                    workspace.reserve(int(response.headers.get('Content-Length') or ESTIMATED_IMAGE_BYTES), f"the image for chapter {idx}")
                     with open(local_image_path, "wb") as f:
-                        for chunk in response.iter_content(chunk_size=8192):
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
                             f.write(chunk)
-                    print(f"Successfully downloaded image for chapter {idx}")
-                except Exception as e:
-                    print(f"Warning: failed to download image for chapter {idx}. Error: {e}")
-                    local_image_path = None
-
-            book_data["chapters"].append({
-                "heading": chapter.get("theme_title", f"Chapter {idx}"),
-                "content": full_chapter_text,
-                "image_path": local_image_path
-            })
-        # --- END OF RESTORED FOR LOOP ---
-
-        book_title = full_book_structure.get("title", "The Architecture of You")
-        local_pdf_filename = f"{line_item_id}.pdf"
-        
-        output_pdf_path = save_book_as_pdf(
-            title=book_title, 
-            book_data=book_data,
+                    span["response_bytes"] = os.path.getsize(local_image_path)
+                image_bytes += os.path.getsize(local_image_path)
+                print(f"Successfully downloaded image for chapter {idx}")
+            except InsufficientScratchSpace:
+                raise
+            except Exception as e:
+                print(f"Warning: failed to download image for chapter {idx}. Error: {e}")
+                local_image_path = None
+
+        book_data["chapters"].append({
+            "heading": chapter.get("theme_title", f"Chapter {idx}"),
+            "content": full_chapter_text,
+            "image_path": local_image_path
+        })
+    # --- END OF RESTORED FOR LOOP ---
+
+    book_title = full_book_structure.get("title", "The Architecture of You")
+    local_pdf_filename = f"{line_item_id}.pdf"
+
+    final_pdf_s3_key = f"final-pdfs/{order_id}/{line_item_id}.pdf"
+    final_s3_path = f"s3://{ARTIFACTS_BUCKET}/{final_pdf_s3_key}"
+
+    # Runs in a process forked by the render guard, so it may be killed at any point.
+    def render(data, on_event):
+        if PDF_OUTPUT_MODE == "stream":
+            # Parts upload while the PDF is still being written; nothing lands in /tmp.
+            # The forked process opens its own S3 connection pool rather than sharing ours.
+            with open_upload(boto3.client('s3'), ARTIFACTS_BUCKET, final_pdf_s3_key, content_type="application/pdf") as sink:
+                if sink.upload_id:
+                    # If the guard kills this process, the upload is aborted from the other side.
+                    on_event("upload_started", {"bucket": ARTIFACTS_BUCKET, "key": final_pdf_s3_key, "upload_id": sink.upload_id})
+                save_book_as_pdf(
+                    title=book_title,
+                    book_data=data,
+                    filename=local_pdf_filename,
+                    on_event=on_event,
+                    output=sink
+                )
+            return sink.tell()
+        return save_book_as_pdf(
+            title=book_title,
+            book_data=data,
             filename=local_pdf_filename,
-            output_dir=local_tmp_dir
+            output_dir=workspace.path,
+            on_event=on_event
         )
 
-        print(f"--- PDF generated locally at: {output_pdf_path} ---")
+    if PDF_OUTPUT_MODE != "stream":
+        # The PDF embeds every image, so it needs at least their size again.
+        workspace.reserve(image_bytes + ESTIMATED_PDF_OVERHEAD_BYTES, "the rendered PDF")
 
-        final_pdf_s3_key = f"final-pdfs/{order_id}/{line_item_id}.pdf"
-        s3_client.upload_file(
-            output_pdf_path, ARTIFACTS_BUCKET, final_pdf_s3_key,
-            ExtraArgs={"ContentType": "application/pdf"}
+    # In stream mode this span also covers the multipart upload, which runs in the render process.
+    with book_tracing.span('render', output_mode=PDF_OUTPUT_MODE, chapters=len(book_data["chapters"])) as span, book_metrics.timer('render_latency', tier):
+        result, render_report = guarded_render(
+            render, book_data, workspace.path,
+            deadline=invocation_deadline,
+            memory_budget_bytes=int(MEMORY_LIMIT_BYTES * RENDER_MEMORY_FRACTION / render_memory_share),
+            abort_upload=abort_upload
         )
-        final_s3_path = f"s3://{ARTIFACTS_BUCKET}/{final_pdf_s3_key}"
+        span.update(degradations=len(render_report["degradations"]))
+        if PDF_OUTPUT_MODE == "stream":
+            span["pdf_bytes"] = result
+    if render_report["degradations"]:
+        print(f"WARNING: book {line_item_id} was rendered with degradations: {render_report['degradations']}")
+    payload["render_guard"] = render_report
+    book_metrics.put('pdf_pages', render_report["attempts"][-1].get("pages"), 'Count', tier)
+    book_metrics.put('pdf_bytes', result if PDF_OUTPUT_MODE == "stream" else os.path.getsize(result), 'Bytes', tier)
+
+    if PDF_OUTPUT_MODE == "stream":
+        print(f"--- Streamed final PDF to {final_s3_path} ({result} bytes) ---")
+    else:
+        print(f"--- PDF generated locally at: {result} ---")
+        # upload_file sends parts from its own threads, which the client's call spans do not see.
+        with book_tracing.span('s3.upload_file', bucket=ARTIFACTS_BUCKET, key=final_pdf_s3_key, request_bytes=os.path.getsize(result)):
+            s3_client.upload_file(
+                result, ARTIFACTS_BUCKET, final_pdf_s3_key,
+                ExtraArgs={"ContentType": "application/pdf"}
+            )
         print(f"--- Successfully uploaded final PDF to {final_s3_path} ---")
 
-        payload["final_pdf_s3_path"] = final_s3_path
-        return payload
+    payload["final_pdf_s3_path"] = final_s3_path
+    return payload
+
+def abort_upload(upload):
+    """Aborts a multipart upload left open by a render process the render guard killed."""
+    try:
+        s3_client.abort_multipart_upload(Bucket=upload['bucket'], Key=upload['key'], UploadId=upload['upload_id'])
+        print(f"--- Aborted the multipart upload of s3://{upload['bucket']}/{upload['key']} ---")
+    except Exception as e:
+        print(f"Warning: could not abort multipart upload of s3://{upload['bucket']}/{upload['key']}: {e}")
 
+def _render_in_child(conn, payload):
+    # Forked children must not share the parent's sockets, so each opens its own pools.
+    global s3_client, http_session
+    s3_client = book_metrics.instrument(book_tracing.instrument(boto3.client('s3')))
+    http_session = requests.Session()
+    # Spans and metrics recorded here go back to the parent with the result; the parent's own were copied in by the fork.
+    book_tracing.reset_spans()
+    book_metrics.reset()
+    try:
+        conn.send(("ok", generate_book_pdf(payload), book_tracing.spans(), book_metrics.pending()))
     except Exception as e:
-        print(f"ERROR: PDF generation failed for order {order_id}: {e}")
-        raise e
\ No newline at end of file
+        conn.send(("error", f"{type(e).__name__}: {e}", book_tracing.spans(), book_metrics.pending()))
+    finally:
+        conn.close()
+
+def generate_pdf_batch(books):
+    """
+    Renders a chunk of an order's books in this one invocation, PDF_BATCH_WORKERS at
+    a time. The state machine sizes the chunks so that their renders fit the
+    invocation's deadline, and PDF_BATCH_WORKERS keeps each render's share of memory
+    to at least RENDER_MEMORY_MB_PER_BOOK.
+
+    WeasyPrint, the stylesheet and the fonts are loaded once here, then each book
+    runs in a forked child that inherits them. Lambda has no /dev/shm, so the
+    children report back over plain pipes rather than a multiprocessing.Pool.
+
+    Returns one `{"Payload": ...}` per book, in order, the same shape the
+    per-book Map produced. If any book fails, the others still finish and
+    upload before the batch raises.
+    """
+    payloads = [book['Payload'] if isinstance(book.get('Payload'), dict) else book for book in books]
+    if not payloads:
+        raise ValueError("No books in the batch for PDF generation.")
+
+    global render_memory_share
+    warm_up()
+    workers = max(1, min(PDF_BATCH_WORKERS, len(payloads)))
+    render_memory_share = workers
+    print(f"--- Rendering {len(payloads)} book(s) with {workers} worker process(es) ---")
+
+    ctx = multiprocessing.get_context('fork')
+    pending = list(enumerate(payloads))
+    running = {}
+    results = [None] * len(payloads)
+    errors = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            index, payload = pending.pop(0)
+            reader, writer = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=_render_in_child, args=(writer, payload))
+            process.start()
+            writer.close()
+            running[reader] = (index, process)
+
+        for reader in multiprocessing.connection.wait(list(running)):
+            index, process = running.pop(reader)
+            try:
+                status, value, child_spans, child_metrics = reader.recv()
+                book_tracing.adopt(child_spans)
+                book_metrics.adopt(child_metrics)
+            except EOFError:
+                process.join()
+                status, value = "error", f"Render process exited with code {process.exitcode}"
+            reader.close()
+            process.join()
+            if status == "ok":
+                results[index] = {"Payload": value}
+            else:
+                errors[payloads[index].get('line_item_id', index)] = value
+                print(f"ERROR: PDF generation failed for line item {payloads[index].get('line_item_id')}: {value}")
+
+    if errors:
+        raise RuntimeError(f"PDF generation failed for {len(errors)} of {len(payloads)} book(s): {json.dumps(errors)}")
+    return results
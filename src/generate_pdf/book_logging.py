@@ -0,0 +1,124 @@
+# FILE: src/generate_pdf/book_logging.py
+"""
+Compact, redacted log records for the order pipeline's Lambdas, shipped in the
+shared layer (generate_pdf and start_execution, which are packaged on their own,
+carry copies).
+
+`log` prints one single-line JSON record. Its fields go through `compact`: long
+strings are cut to LOG_MAX_STRING_CHARS, long lists to LOG_MAX_ITEMS, deep
+nesting to LOG_MAX_DEPTH, and customer details (emails, names, addresses, phone
+numbers, whole address objects, birth coordinates, and the Address / Delivery
+Date & Time line item properties) are redacted. `log_event` is for the handlers' incoming events: it always logs a
+summary (ids and top-level keys) and only for a sample of orders
+(LOG_PAYLOAD_SAMPLE_RATE; all of them with LOG_LEVEL=DEBUG) the compacted
+payload. The sample is taken per order, so a sampled order has its payload
+logged by every stage.
+"""
+import json
+import os
+import random
+import re
+import sys
+import zlib
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_STRING_CHARS = int(os.environ.get('LOG_MAX_STRING_CHARS', '200'))
+LOG_MAX_ITEMS = int(os.environ.get('LOG_MAX_ITEMS', '10'))
+LOG_MAX_DEPTH = int(os.environ.get('LOG_MAX_DEPTH', '6'))
+# Fraction of orders whose full (compacted) payloads are logged at each stage.
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+REDACTED = '[redacted]'
+# Keys whose values are personal data, wherever they appear (Shopify customer and address objects).
+REDACT_KEYS = {
+    'email', 'customer_email', 'contact_email', 'phone', 'first_name', 'last_name', 'name_on_card',
+    'address1', 'address2', 'city', 'zip', 'company', 'latitude', 'longitude', 'lat', 'lon', 'browser_ip',
+} | {key.strip() for key in os.environ.get('LOG_REDACT_KEYS', '').split(',') if key.strip()}
+# Shopify address objects (shipping_address, billing_address, default_address, addresses) carry
+# the customer's name under `name`, which line item properties use too; they are redacted whole.
+ADDRESS_KEY_PATTERN = re.compile(r'(^|_)address(es)?$')
+# Shopify line item properties ({"name": ..., "value": ...}) whose values are personal data.
+REDACT_PROPERTIES = {'Address', 'Delivery Date & Time'}
+EMAIL_PATTERN = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+
+
+def _truncate(text):
+    text = EMAIL_PATTERN.sub('[email]', text)
+    if len(text) <= LOG_MAX_STRING_CHARS:
+        return text
+    return f"{text[:LOG_MAX_STRING_CHARS]}...(+{len(text) - LOG_MAX_STRING_CHARS} chars)"
+
+
+def _redacted_key(key):
+    return key in REDACT_KEYS or (isinstance(key, str) and ADDRESS_KEY_PATTERN.search(key) is not None)
+
+
+def compact(value, depth=0):
+    """`value`, JSON-safe, with strings, lists and nesting cut down and personal data redacted."""
+    if isinstance(value, str):
+        return _truncate(value)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if depth >= LOG_MAX_DEPTH:
+        return f"...({type(value).__name__})"
+    if isinstance(value, dict):
+        if value.get('name') in REDACT_PROPERTIES and 'value' in value:
+            return {'name': value['name'], 'value': REDACTED}
+        return {str(key): REDACTED if _redacted_key(key) else compact(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        result = [compact(item, depth + 1) for item in items[:LOG_MAX_ITEMS]]
+        if len(items) > LOG_MAX_ITEMS:
+            result.append(f"...(+{len(items) - LOG_MAX_ITEMS} items)")
+        return result
+    if isinstance(value, (bytes, bytearray)):
+        return f"({len(value)} bytes)"
+    return _truncate(str(value))
+
+
+def enabled(level):
+    return LEVELS.get(level, 20) >= LEVELS.get(LOG_LEVEL, 20)
+
+
+def log(message, level='INFO', **fields):
+    """Prints `message` and `fields` as one compact JSON line."""
+    if not enabled(level):
+        return
+    record = {"level": level, "message": message, "time": datetime.now(timezone.utc).isoformat(timespec='milliseconds')}
+    record.update(compact(fields))
+    print(json.dumps(record, default=str, separators=(',', ':')), file=sys.stdout)
+
+
+def sampled(key=None):
+    """Whether the verbose payloads of the order `key` are logged. The same order is sampled the same way everywhere."""
+    if enabled('DEBUG'):
+        return True
+    if LOG_PAYLOAD_SAMPLE_RATE <= 0:
+        return False
+    if key is None:
+        return random.random() < LOG_PAYLOAD_SAMPLE_RATE
+    return zlib.crc32(str(key).encode('utf-8')) % 10000 < LOG_PAYLOAD_SAMPLE_RATE * 10000
+
+
+def summary(event):
+    """What is worth logging about every event: its ids and the shape of the rest."""
+    if not isinstance(event, dict):
+        return {"type": type(event).__name__}
+    payload = event.get('Payload') if isinstance(event.get('Payload'), dict) else event
+    result = {key: payload[key] for key in ('order_id', 'line_item_id', 'trace_id') if payload.get(key) is not None}
+    result["keys"] = sorted(payload)[:LOG_MAX_ITEMS * 3]
+    for key in ('books', 'chapters_data', 'line_items', 'Records', 'written_books'):
+        if isinstance(payload.get(key), list):
+            result[f"{key}_count"] = len(payload[key])
+    return result
+
+
+def log_event(message, event, **fields):
+    """Logs an incoming event: a summary always, the compacted payload for sampled orders."""
+    info = summary(event)
+    if sampled(info.get('order_id')):
+        log(message, event=event, **info, **fields)
+    else:
+        log(message, **info, **fields)
@@ -1,42 +1,27 @@
 # app/book_pdf_exporter.py
 from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
 from jinja2 import Template
+from functools import lru_cache
 import os
 from datetime import datetime
 import pathlib
+import time
+from typing import BinaryIO, Callable, Optional
 
-def save_book_as_pdf(title: str, book_data: dict, filename: str, output_dir: str = "/tmp") -> str:
-    """
-    Generates the final, professionally formatted PDF using a two-pass render
-    to guarantee correct page numbers in the Table of Contents.
-    """
-    # output_dir = "generated_books"
-    # os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, filename)
-
-    # --- Prepare all data for the template ---
-    all_sections_for_toc = []
-    if book_data.get('preface_text'):
-        all_sections_for_toc.append({"title": "Preface", "href": "#preface"})
-    if book_data.get('prologue_text'):
-        prologue_title = book_data.get('prologue_title', "Prologue")
-        all_sections_for_toc.append({"title": prologue_title, "href": "#prologue"})
-    for i, ch in enumerate(book_data.get("chapters", [])):
-        all_sections_for_toc.append({"title": ch["heading"], "href": f"#chapter-{i+1}"})
-    if book_data.get('epilogue_text'):
-        epilogue_title = book_data.get('epilogue_title', "Epilogue")
-        all_sections_for_toc.append({"title": epilogue_title, "href": "#epilogue"})
+import hyphenation_memo
 
-    # This HTML template is correct and preserves the layout.
-    html_template = Template("""
+# This HTML template is correct and preserves the layout.
+# It is compiled once per process and shared by every render.
+BOOK_TEMPLATE = Template("""
     <!DOCTYPE html>
-    <html>
+    <html lang="{{ book_language }}">
     <head>
         <meta charset="UTF-8"><title>{{ book_title }}</title>
     </head>
     <body>
-        # <div class="page swapi-call-page debug-page"><h1>Data Source</h1><pre class="swapi-text">{{ swapi_call_text }}</pre></div>
-        # <div class="page swapi-json-page debug-page"><pre>{{ swapi_json_output }}</pre></div>
+        {% if swapi_call_text %}# <div class="page swapi-call-page debug-page"><h1>Data Source</h1><pre class="swapi-text">{{ swapi_call_text }}</pre></div>{% endif %}
+        {% if swapi_json_output %}# <div class="page swapi-json-page debug-page"><pre>{{ swapi_json_output }}</pre></div>{% endif %}
         <div class="page blank-page"></div><div class="page blank-page"></div>
         {% if image_path %}<div class="page image-page"><div class="image-container"><img src="{{ image_path }}" alt="AI Generated Book Image"></div></div>{% endif %}
         <div class="page title-page"><div class="title-main-block"><div class="title-decoration">✧</div><h1 class="book-title">{{ book_title }}</h1><div class="title-decoration">✦</div><h2 class="subtitle">A PERSONAL INTERPRETATION</h2></div></div>
@@ -53,8 +38,8 @@ def save_book_as_pdf(title: str, book_data: dict, filename: str, output_dir: str
                 </div>
             {% endfor %}
         </div></div>
-        <div class="page blank-page"></div>
-        
+        <div class="page blank-page" id="contents-end"></div>
+        {% if not front_matter_only %}
         <div class="main-content-body">
             {% if preface_text %}<div class="page content-page" id="preface"><h2>Preface</h2><div class="content-block">{% for p in preface_text.split('\n\n') %}<p>{{ p }}</p>{% endfor %}</div></div><div class="page blank-page"></div>{% endif %}
             {% if prologue_text %}<div class="page content-page" id="prologue"><h2>{{ prologue_title | default('Prologue') }}</h2><div class="content-block">{% for p in prologue_text.split('\n\n') %}<p>{{ p }}</p>{% endfor %}</div></div><div class="page blank-page"></div>{% endif %}
@@ -76,15 +61,29 @@ def save_book_as_pdf(title: str, book_data: dict, filename: str, output_dir: str
             {% endfor %} 
             {% if epilogue_text %}<div class="page blank-page"></div><div class="page content-page" id="epilogue"><h2>{{ epilogue_title | default('Epilogue') }}</h2><div class="content-block">{% for p in epilogue_text.split('\n\n') %}<p>{{ p }}</p>{% endfor %}</div></div>{% endif %}
         </div>
+        {% endif %}
     </body>
     </html>
     """)
-    
-    fonts_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'fonts'))
+
+
+# The fonts ship in the image next to this module.
+FONTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'fonts'))
+# The book's language; `hyphens: auto` only hyphenates text whose language is known.
+BOOK_LANGUAGE = os.environ.get('BOOK_LANGUAGE', 'en')
+
+
+@lru_cache(maxsize=1)
+def get_stylesheet():
+    """
+    Builds the book stylesheet and loads the LibreBaskerville faces once per process.
+    Long-lived render workers call this up front so the first book does not pay for it.
+    """
+    fonts_dir = FONTS_DIR
     baskerville_regular_uri = pathlib.Path(os.path.abspath(os.path.join(fonts_dir, 'LibreBaskerville-Regular.ttf'))).as_uri()
     baskerville_italic_uri = pathlib.Path(os.path.abspath(os.path.join(fonts_dir, 'LibreBaskerville-Italic.ttf'))).as_uri()
     baskerville_bold_uri = pathlib.Path(os.path.abspath(os.path.join(fonts_dir, 'LibreBaskerville-Bold.ttf'))).as_uri()
-    font_config = f"""@font-face{{font-family:'Baskerville';src:url('{baskerville_regular_uri}');}}@font-face{{font-family:'Baskerville';font-style:italic;src:url('{baskerville_italic_uri}');}}@font-face{{font-family:'Baskerville';font-weight:bold;src:url('{baskerville_bold_uri}');}}"""
+    font_faces = f"""@font-face{{font-family:'Baskerville';src:url('{baskerville_regular_uri}');}}@font-face{{font-family:'Baskerville';font-style:italic;src:url('{baskerville_italic_uri}');}}@font-face{{font-family:'Baskerville';font-weight:bold;src:url('{baskerville_bold_uri}');}}"""
 
     # <<< CSS IS MODIFIED HERE TO MAKE THE TOC MORE COMPACT >>>
     main_css_string = """
@@ -99,12 +98,12 @@ def save_book_as_pdf(title: str, book_data: dict, filename: str, output_dir: str
     body > div:last-of-type { page-break-after: auto; }
     h1, h2, h3 { font-weight: bold; margin: 0; text-align: center; }
     .main-content-body > .page { page: numbered; }
-    
+
     /* --- Table of Contents Styling --- */
     .toc-page { padding: 2em 0; }
     .toc-page h1 { font-size: 24pt; margin-bottom: 1.2em; }
     .toc-list { width: 85%; margin: 0 auto; }
-    
+
     .toc-entry { 
         display: grid; 
         grid-template-columns: auto 1fr auto; 
@@ -114,7 +113,7 @@ def save_book_as_pdf(title: str, book_data: dict, filename: str, output_dir: str
         line-height: 1.25;      /* TIGHTENED line height */
         margin-bottom: 0.7em;   /* REDUCED bottom margin */
     }
-    
+
     .entry-title { grid-column: 1; text-align: left; }
     .leader { grid-column: 2; border-bottom: 1px dotted rgba(0,0,0,0.5); margin-bottom: 4px; }
     .page-number { grid-column: 3; text-align: right; }
@@ -140,14 +139,74 @@ def save_book_as_pdf(title: str, book_data: dict, filename: str, output_dir: str
     .content-block p:first-child { text-indent: 0; }
     .content-block p:first-child::first-letter { font-size: 3.5em;font-weight: bold;}
     """
-    css = CSS(string=font_config + main_css_string)
+    font_config = FontConfiguration()
+    return CSS(string=font_faces + main_css_string, font_config=font_config), font_config
+
+
+def warm_up():
+    """
+    Loads the stylesheet and fonts and lays out a one-page document, so Pango,
+    fontconfig and the font cache are initialised before the first real book.
+    """
+    css, font_config = get_stylesheet()
+    HTML(string="<p>Warm-up</p>").render(stylesheets=[css], font_config=font_config)
+    hyphenation_memo.preload(BOOK_LANGUAGE)
+    hyphenation_memo.load()
+
+
+def front_matter_page_count(doc) -> int:
+    """Pages up to and including the blank page after the Table of Contents, or -1 if it is missing."""
+    for p, page in enumerate(doc.pages):
+        if "contents-end" in page.anchors:
+            return p + 1
+    return -1
+
+
+def save_book_as_pdf(title: str, book_data: dict, filename: str, output_dir: str = "/tmp", on_event: Optional[Callable[[str, dict], None]] = None, output: Optional[BinaryIO] = None) -> str:
+    """
+    Generates the final, professionally formatted PDF using a two-pass render
+    to guarantee correct page numbers in the Table of Contents.
+
+    `on_event(name, data)`, if given, is told when each render pass starts and
+    finishes and when the PDF has been written.
+
+    If `output` is given, the PDF is streamed into that binary file object
+    instead of being written to `output_dir`, and its `name` is returned.
+    """
+    def emit(event: str, **data):
+        if on_event:
+            on_event(event, data)
+
+    # output_dir = "generated_books"
+    # os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, filename)
+
+    # --- Prepare all data for the template ---
+    all_sections_for_toc = []
+    if book_data.get('preface_text'):
+        all_sections_for_toc.append({"title": "Preface", "href": "#preface"})
+    if book_data.get('prologue_text'):
+        prologue_title = book_data.get('prologue_title', "Prologue")
+        all_sections_for_toc.append({"title": prologue_title, "href": "#prologue"})
+    for i, ch in enumerate(book_data.get("chapters", [])):
+        all_sections_for_toc.append({"title": ch["heading"], "href": f"#chapter-{i+1}"})
+    if book_data.get('epilogue_text'):
+        epilogue_title = book_data.get('epilogue_title', "Epilogue")
+        all_sections_for_toc.append({"title": epilogue_title, "href": "#epilogue"})
+
     base_url = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
+    # Words hyphenated by earlier renders in this container are not looked up again.
+    hyphenation_memo.load()
+
     # --- PASS 1: Render a draft to find the real page number of each anchor ---
     print("--- Starting Pass 1: Finding page numbers... ---")
-    draft_context = {"page_map": None, "toc_entries": all_sections_for_toc, **book_data, "book_title": title, "print_date": datetime.now().strftime("%B %d, %Y")}
-    draft_html = html_template.render(draft_context)
-    doc = HTML(string=draft_html, base_url=base_url).render(stylesheets=[css])
+    emit("render_pass_started", render_pass=1)
+    pass_started_at = time.monotonic()
+    draft_context = {"page_map": None, "toc_entries": all_sections_for_toc, **book_data, "book_title": title, "book_language": BOOK_LANGUAGE, "print_date": datetime.now().strftime("%B %d, %Y")}
+    draft_html = BOOK_TEMPLATE.render(draft_context)
+    css, font_config = get_stylesheet()
+    doc = HTML(string=draft_html, base_url=base_url).render(stylesheets=[css], font_config=font_config)
     
     first_content_page_index = -1
     target_anchors = {entry['href'][1:] for entry in all_sections_for_toc}
@@ -170,11 +229,33 @@ def save_book_as_pdf(title: str, book_data: dict, filename: str, output_dir: str
                     page_map[href] = real_page_number
     
     print(f"--- Pass 1 Complete. Found page numbers: {page_map} ---")
+    emit("render_pass_done", render_pass=1, pages=len(doc.pages), seconds=round(time.monotonic() - pass_started_at, 2))
 
     # --- PASS 2: Render the final PDF, injecting the correct page numbers into the TOC ---
+    # Only the front matter changes, and the body always starts on a fresh page, so
+    # the front matter is laid out again on its own and the body pages of pass 1 are
+    # reused as they are instead of shaping and hyphenating the whole book twice.
     print("--- Starting Pass 2: Rendering final PDF... ---")
-    final_context = {"page_map": page_map, "toc_entries": all_sections_for_toc, **book_data, "book_title": title, "print_date": datetime.now().strftime("%B %d, %Y")}
-    final_html = html_template.render(final_context)
-    HTML(string=final_html, base_url=base_url).write_pdf(output_path, stylesheets=[css])
+    emit("render_pass_started", render_pass=2)
+    pass_started_at = time.monotonic()
+    final_context = {"page_map": page_map, "toc_entries": all_sections_for_toc, **book_data, "book_title": title, "book_language": BOOK_LANGUAGE, "print_date": datetime.now().strftime("%B %d, %Y")}
+    front_html = BOOK_TEMPLATE.render({**final_context, "front_matter_only": True})
+    front = HTML(string=front_html, base_url=base_url).render(stylesheets=[css], font_config=font_config)
+    front_pages = front_matter_page_count(doc)
+    if front_pages > 0 and len(front.pages) == front_pages:
+        final_doc = doc.copy(front.pages + doc.pages[front_pages:])
+    else:
+        print(f"WARNING: front matter took {len(front.pages)} pages instead of {front_pages}; rendering the whole book again.")
+        final_html = BOOK_TEMPLATE.render(final_context)
+        final_doc = HTML(string=final_html, base_url=base_url).render(stylesheets=[css], font_config=font_config)
+    if output is not None:
+        final_doc.write_pdf(output)
+        output_path, output_bytes = getattr(output, "name", output_path), output.tell()
+    else:
+        final_doc.write_pdf(output_path)
+        output_bytes = os.path.getsize(output_path)
+    hyphenation_memo.save()
+    emit("render_pass_done", render_pass=2, seconds=round(time.monotonic() - pass_started_at, 2))
+    emit("pdf_ready", path=output_path, bytes=output_bytes)
     
     return output_path
\ No newline at end of file
@@ -0,0 +1,172 @@
+# FILE: src/generate_pdf/book_profiling.py
+"""
+On-demand profiling for the order pipeline's Lambdas, shipped in the shared layer
+(generate_pdf, which is a container image, carries its own copy).
+
+`profiled_handler` profiles an invocation when it is asked to:
+
+- PROFILE_HANDLERS lists the stages to profile (comma-separated, or `all`), or
+- the event (or its `Payload`) has `"profile": true`, for a single direct invoke
+  such as `aws lambda invoke --payload '{..., "profile": true}'`.
+
+A profiled invocation runs under cProfile and tracemalloc. Afterwards the pstats
+file and a JSON summary (top functions by cumulative time, top allocation sites,
+peak RSS of the function and of any processes it forked) are written to
+s3://PROFILE_BUCKET/profiles/<stage>/, or under PROFILE_DIR when that is set,
+and the summary is printed. Open the .prof with `python -m pstats` or snakeviz.
+
+When neither asks for it the wrapper only checks the two flags. cProfile sees the
+invocation's own thread; generate_pdf's forked renders show up in its children's RSS.
+"""
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import resource
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+
+PROFILE_HANDLERS = {stage.strip() for stage in os.environ.get('PROFILE_HANDLERS', '').split(',') if stage.strip()}
+PROFILE_BUCKET = os.environ.get('PROFILE_BUCKET')
+PROFILE_PREFIX = os.environ.get('PROFILE_PREFIX', 'profiles')
+# Written here instead of S3 when set.
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_TOP_FUNCTIONS = int(os.environ.get('PROFILE_TOP_FUNCTIONS', '25'))
+PROFILE_TOP_ALLOCATIONS = int(os.environ.get('PROFILE_TOP_ALLOCATIONS', '15'))
+# Deeper tracebacks attribute allocations better but slow tracemalloc down.
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', '5'))
+
+_upload_client = None
+
+
+def requested(stage, event):
+    if 'all' in PROFILE_HANDLERS or stage in PROFILE_HANDLERS:
+        return True
+    if not isinstance(event, dict):
+        return False
+    payload = event.get('Payload')
+    return event.get('profile') is True or (isinstance(payload, dict) and payload.get('profile') is True)
+
+
+def _peak_rss_mb(who):
+    # ru_maxrss is in KiB on Linux.
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def _top_functions(profiler):
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, function), (calls, primitive_calls, total, cumulative, _) in stats.stats.items():
+        rows.append({
+            "function": f"{os.path.basename(filename)}:{line}({function})",
+            "calls": calls, "primitive_calls": primitive_calls,
+            "total_seconds": round(total, 4), "cumulative_seconds": round(cumulative, 4),
+        })
+    rows.sort(key=lambda row: -row["cumulative_seconds"])
+    return rows[:PROFILE_TOP_FUNCTIONS]
+
+
+def _top_allocations(snapshot):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    return [{"site": str(stat.traceback[0]), "kib": round(stat.size / 1024, 1), "blocks": stat.count}
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]]
+
+
+def _write(stage, request_id, started_at, profile_bytes, summary):
+    global _upload_client
+    base = f"{PROFILE_PREFIX}/{stage}/{started_at}-{request_id}"
+    body = json.dumps(summary, indent=2, default=str)
+    if PROFILE_DIR:
+        path = os.path.join(PROFILE_DIR, base)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.prof", 'wb') as f:
+            f.write(profile_bytes)
+        with open(f"{path}.json", 'w', encoding='utf-8') as f:
+            f.write(body)
+        return f"{path}.prof"
+    if not PROFILE_BUCKET:
+        return None
+    if _upload_client is None:
+        import boto3
+        _upload_client = boto3.client('s3')
+    _upload_client.put_object(Bucket=PROFILE_BUCKET, Key=f"{base}.prof", Body=profile_bytes, ContentType='application/octet-stream')
+    _upload_client.put_object(Bucket=PROFILE_BUCKET, Key=f"{base}.json", Body=body, ContentType='application/json')
+    return f"s3://{PROFILE_BUCKET}/{base}.prof"
+
+
+def _profile_bytes(profiler):
+    # pstats can only dump to a path; Lambda's /tmp is the place for it.
+    path = os.path.join('/tmp', f"profile-{uuid.uuid4().hex}.prof")
+    try:
+        profiler.dump_stats(path)
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def profiled_handler(stage):
+    """Decorates a lambda_handler so an invocation can be profiled on request."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not requested(stage, event):
+                return handler(event, context)
+
+            request_id = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+            started_at = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+            # Another profiler (or a long-running tracemalloc) may already be on; leave it as we found it.
+            started_tracemalloc = not tracemalloc.is_tracing()
+            if started_tracemalloc:
+                tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            tracemalloc.reset_peak()
+            profiler = cProfile.Profile()
+            started = time.perf_counter()
+            error = None
+            profiler.enable()
+            try:
+                return handler(event, context)
+            except BaseException as e:
+                error = f"{type(e).__name__}: {e}"[:500]
+                raise
+            finally:
+                profiler.disable()
+                elapsed = time.perf_counter() - started
+                try:
+                    _, traced_peak = tracemalloc.get_traced_memory()
+                    snapshot = tracemalloc.take_snapshot()
+                    if started_tracemalloc:
+                        tracemalloc.stop()
+                    summary = {
+                        "stage": stage,
+                        "request_id": request_id,
+                        "started_at": started_at,
+                        "seconds": round(elapsed, 3),
+                        "error": error,
+                        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+                        "children_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+                        "traced_peak_mb": round(traced_peak / 1024 ** 2, 1),
+                        "top_functions": _top_functions(profiler),
+                        "top_allocations": _top_allocations(snapshot),
+                    }
+                    location = _write(stage, request_id, started_at, _profile_bytes(profiler), summary)
+                    stream = io.StringIO()
+                    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(15)
+                    print(f"Profile of {stage} ({summary['seconds']}s, peak RSS {summary['peak_rss_mb']} MiB, "
+                          f"children {summary['children_peak_rss_mb']} MiB, traced peak {summary['traced_peak_mb']} MiB)"
+                          f"{f' written to {location}' if location else ''}")
+                    print(stream.getvalue())
+                    for allocation in summary["top_allocations"][:5]:
+                        print(f"  {allocation['kib']:>10} KiB  {allocation['blocks']:>8} blocks  {allocation['site']}")
+                except Exception as e:
+                    print(f"WARNING: could not write the profile of {stage}: {e}")
+        return wrapper
+    return decorate
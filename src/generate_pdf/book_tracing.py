@@ -0,0 +1,244 @@
+# FILE: src/generate_pdf/book_tracing.py
+"""
+Lightweight tracing for the order pipeline's Lambdas, shipped in the shared layer
+(generate_pdf, which is a container image, carries its own copy).
+
+order_ingestion starts a trace and puts its id in the Step Functions input as
+`trace_id`; every stage after it reads the id from its event. `traced_handler`
+wraps a lambda_handler in a span for the whole invocation, `span` times any
+block inside it, and `instrument` adds a span to every call a boto3 client makes.
+When the invocation ends its spans are written as one JSON document to
+s3://TRACE_BUCKET/traces/<trace_id>/, or under TRACE_DIR when that is set.
+offline/trace_waterfall.py turns a trace's documents into a per-book waterfall.
+
+Tracing never fails an invocation: if the spans cannot be written, that is printed
+and the handler's result stands.
+"""
+import functools
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'true').lower() == 'true'
+TRACE_BUCKET = os.environ.get('TRACE_BUCKET')
+TRACE_PREFIX = os.environ.get('TRACE_PREFIX', 'traces')
+# Written here instead of S3 when set (the offline harness sets it).
+TRACE_DIR = os.environ.get('TRACE_DIR')
+
+# The invocation being traced and the innermost open span. Context variables, so
+# concurrent invocations in one process (threads, asyncio tasks) keep theirs apart.
+_invocation = ContextVar('book_tracing_invocation', default=None)
+_parent_span = ContextVar('book_tracing_parent_span', default=None)
+
+_cold_start = True
+_upload_client = None
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def trace_id_of(event):
+    """The trace id carried by a Step Functions or SQS payload, or one derived from its order id."""
+    if not isinstance(event, dict):
+        return new_trace_id()
+    candidates = [event, event.get('Payload')]
+    candidates += [book.get('Payload', book) for book in event.get('books', []) if isinstance(book, dict)]
+    for candidate in candidates:
+        if isinstance(candidate, dict) and candidate.get('trace_id'):
+            return candidate['trace_id']
+    for candidate in candidates:
+        if isinstance(candidate, dict) and candidate.get('order_id'):
+            # Executions started before trace ids existed still group by order.
+            return f"order-{candidate['order_id']}"
+    return new_trace_id()
+
+
+def current_trace_id():
+    invocation = _invocation.get()
+    return invocation['trace_id'] if invocation else None
+
+
+def _size(body):
+    if body is None:
+        return None
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        # botocore hands S3 bodies over as seekable streams.
+        position = body.tell()
+        size = body.seek(0, os.SEEK_END)
+        body.seek(position)
+        return size
+    except Exception:
+        return None
+
+
+def _open_span(name, attributes):
+    return {
+        "name": name,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": _parent_span.get(),
+        "start": time.time(),
+        "attributes": {key: value for key, value in attributes.items() if value is not None},
+        "_started": time.perf_counter(),
+    }
+
+
+def _close_span(invocation, record, error=None):
+    record["duration_ms"] = round((time.perf_counter() - record.pop("_started")) * 1000, 3)
+    if error is not None:
+        record["error"] = f"{type(error).__name__}: {error}"[:500]
+    invocation["spans"].append(record)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the enclosed block as a span of the current invocation. Yields the span's
+    attributes, so sizes and counts known only afterwards can be added to them.
+    Outside a traced invocation it does nothing.
+    """
+    invocation = _invocation.get()
+    if invocation is None:
+        yield {}
+        return
+    record = _open_span(name, attributes)
+    token = _parent_span.set(record["span_id"])
+    try:
+        yield record["attributes"]
+    except BaseException as e:
+        _close_span(invocation, record, e)
+        raise
+    else:
+        _close_span(invocation, record)
+    finally:
+        _parent_span.reset(token)
+
+
+def _before_parameter_build(params, context, **kwargs):
+    # The API parameters; by before-call they have been serialised into an HTTP request.
+    context['book_tracing_target'] = {"bucket": params.get('Bucket'), "key": params.get('Key')}
+
+
+def _before_call(model, params, context, **kwargs):
+    if _invocation.get() is None:
+        return
+    name = f"{model.service_model.service_name}.{model.name}"
+    context['book_tracing_span'] = _open_span(name, {
+        **context.get('book_tracing_target', {}), "request_bytes": _size(params.get('body')) or None,
+    })
+
+
+def _after_call(http_response, model, context, **kwargs):
+    record = context.pop('book_tracing_span', None)
+    invocation = _invocation.get()
+    if record is None or invocation is None:
+        return
+    record["attributes"]["status"] = http_response.status_code
+    length = http_response.headers.get('content-length')
+    if length is not None:
+        record["attributes"]["response_bytes"] = int(length)
+    _close_span(invocation, record)
+
+
+def _after_call_error(exception, context, **kwargs):
+    record = context.pop('book_tracing_span', None)
+    invocation = _invocation.get()
+    if record is not None and invocation is not None:
+        _close_span(invocation, record, exception)
+
+
+def instrument(*clients):
+    """Records a span for every API call each boto3 client makes (a resource's is `resource.meta.client`)."""
+    for client in clients:
+        events = client.meta.events
+        events.register('before-parameter-build', _before_parameter_build, unique_id='book_tracing.before_parameter_build')
+        events.register('before-call', _before_call, unique_id='book_tracing.before_call')
+        events.register('after-call', _after_call, unique_id='book_tracing.after_call')
+        events.register('after-call-error', _after_call_error, unique_id='book_tracing.after_call_error')
+    return clients[0] if len(clients) == 1 else clients
+
+
+def spans():
+    """The spans recorded so far in this invocation."""
+    invocation = _invocation.get()
+    return list(invocation["spans"]) if invocation else []
+
+
+def reset_spans():
+    """Forgets the spans recorded so far. A forked child calls this so it reports only its own."""
+    invocation = _invocation.get()
+    if invocation:
+        invocation["spans"] = []
+
+
+def adopt(child_spans):
+    """Adds spans a forked child recorded and sent back."""
+    invocation = _invocation.get()
+    if invocation and child_spans:
+        invocation["spans"].extend(child_spans)
+
+
+def _write(document):
+    global _upload_client
+    key = f"{TRACE_PREFIX}/{document['trace_id']}/{document['started_at']}-{document['stage']}-{document['request_id']}.json"
+    body = json.dumps(document, default=str)
+    if TRACE_DIR:
+        path = os.path.join(TRACE_DIR, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(body)
+        return path
+    if not TRACE_BUCKET:
+        return None
+    if _upload_client is None:
+        import boto3
+        # Not instrumented, so writing the trace does not add a span to it.
+        _upload_client = boto3.client('s3')
+    _upload_client.put_object(Bucket=TRACE_BUCKET, Key=key, Body=body, ContentType='application/json')
+    return f"s3://{TRACE_BUCKET}/{key}"
+
+
+def traced_handler(stage):
+    """Decorates a lambda_handler so each invocation is a traced span named after its stage."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _cold_start
+            if not TRACING_ENABLED:
+                return handler(event, context)
+            payload = event.get('Payload', event) if isinstance(event, dict) else {}
+            payload = payload if isinstance(payload, dict) else {}
+            invocation = {
+                "trace_id": trace_id_of(event),
+                "stage": stage,
+                "function": getattr(context, 'function_name', stage),
+                "request_id": getattr(context, 'aws_request_id', None) or uuid.uuid4().hex,
+                "order_id": payload.get('order_id'),
+                "line_item_id": payload.get('line_item_id'),
+                "cold_start": _cold_start,
+                "started_at": datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ'),
+                "spans": [],
+            }
+            _cold_start = False
+            token = _invocation.set(invocation)
+            try:
+                with span(stage, order_id=invocation["order_id"], line_item_id=invocation["line_item_id"]):
+                    return handler(event, context)
+            finally:
+                _invocation.reset(token)
+                try:
+                    location = _write(invocation)
+                    if location:
+                        print(f"Trace {invocation['trace_id']}: {len(invocation['spans'])} span(s) from {stage} written to {location}")
+                except Exception as e:
+                    print(f"WARNING: could not write trace {invocation['trace_id']} for {stage}: {e}")
+        return wrapper
+    return decorate
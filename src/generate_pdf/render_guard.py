@@ -0,0 +1,210 @@
+# FILE: src/generate_pdf/render_guard.py
+
+import copy
+import multiprocessing
+import os
+import time
+import traceback
+
+# Memory the function was configured with; Lambda sets this variable for us.
+MEMORY_LIMIT_BYTES = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '3008')) * 1024 ** 2
+# Fraction of that the renders may use before the guard steps in, leaving room for the handler itself.
+RENDER_MEMORY_FRACTION = float(os.environ.get('RENDER_MEMORY_FRACTION', '0.85'))
+# How often the render process's RSS and elapsed time are checked.
+RENDER_SAMPLE_SECONDS = float(os.environ.get('RENDER_SAMPLE_SECONDS', '0.5'))
+# Pass 2 lays out only the front matter again but serialises every page, and it
+# holds the pass 1 layout while it does.
+PASS2_TIME_FACTOR = float(os.environ.get('RENDER_PASS2_TIME_FACTOR', '0.6'))
+PASS2_MEMORY_FACTOR = float(os.environ.get('RENDER_PASS2_MEMORY_FACTOR', '1.15'))
+# Longest edge of images after downsampling; about 160 dpi across the 140 mm page.
+DOWNSAMPLE_MAX_PIXELS = int(os.environ.get('RENDER_DOWNSAMPLE_MAX_PIXELS', '900'))
+
+# Applied cumulatively, in this order, each time a render is predicted to run out of memory or time.
+DEGRADATION_STEPS = ["downsample_images", "drop_debug_pages", "text_only"]
+
+
+class RenderBudgetExceeded(RuntimeError):
+    pass
+
+
+def _process_rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def downsample_image(path, out_dir):
+    """Writes a smaller JPEG copy of an image for print and returns its path."""
+    from PIL import Image
+
+    out_path = os.path.join(out_dir, f"small_{os.path.splitext(os.path.basename(path))[0]}.jpg")
+    with Image.open(path) as image:
+        image.thumbnail((DOWNSAMPLE_MAX_PIXELS, DOWNSAMPLE_MAX_PIXELS))
+        image.convert("RGB").save(out_path, "JPEG", quality=82, optimize=True)
+    return out_path
+
+
+def degrade_book(book_data, steps, workdir):
+    """A copy of `book_data` with the given degradation steps applied."""
+    book_data = copy.deepcopy(book_data)
+    if "drop_debug_pages" in steps:
+        book_data["swapi_call_text"] = None
+        book_data["swapi_json_output"] = None
+    for chapter in book_data.get("chapters", []):
+        if not chapter.get("image_path"):
+            continue
+        if "text_only" in steps:
+            chapter["image_path"] = None
+        elif "downsample_images" in steps:
+            try:
+                chapter["image_path"] = downsample_image(chapter["image_path"], workdir)
+            except Exception as e:
+                print(f"Warning: could not downsample {chapter['image_path']}, dropping it. Error: {e}")
+                chapter["image_path"] = None
+    return book_data
+
+
+def _render_child(conn, render, book_data):
+    def on_event(event, data):
+        conn.send(("event", event, data))
+
+    try:
+        conn.send(("done", render(book_data, on_event)))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def _attempt(render, book_data, deadline, memory_budget_bytes, abort_upload=None):
+    """
+    Runs one render in a forked process and watches it. Returns the attempt's
+    stats, with "result" set on success or "breach" set if the render was
+    stopped because it was about to run out of memory or time, or died
+    ("breach_kind" says which). A render that is stopped cannot clean up after itself, so each
+    upload it reported starting ("upload_started") is passed to `abort_upload`.
+    """
+    ctx = multiprocessing.get_context('fork')
+    reader, writer = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_render_child, args=(writer, render, book_data))
+    started_at = time.monotonic()
+    process.start()
+    writer.close()
+
+    stats = {"peak_rss_mb": 0, "pass1_seconds": None, "pass1_peak_rss_mb": None}
+    pass_started_at = started_at
+    render_pass = 1
+    peak_rss = 0
+    uploads = []
+    # Whether the render process got to finish, and so to complete or abort its own uploads.
+    finished = False
+    try:
+        while True:
+            if reader.poll(RENDER_SAMPLE_SECONDS):
+                try:
+                    message = reader.recv()
+                except EOFError:
+                    process.join()
+                    stats["breach"] = f"render process died (exit code {process.exitcode})"
+                    stats["breach_kind"] = "died"
+                    return stats
+                if message[0] == "done":
+                    finished = True
+                    stats["result"] = message[1]
+                    return stats
+                if message[0] == "error":
+                    finished = True
+                    print(message[2])
+                    raise RuntimeError(message[1])
+                event, data = message[1], message[2]
+                if event == "upload_started":
+                    uploads.append(data)
+                    continue
+                if event == "render_pass_done" and data.get("render_pass") == 1:
+                    stats["pass1_seconds"] = round(time.monotonic() - pass_started_at, 2)
+                    stats["pass1_peak_rss_mb"] = peak_rss // 1024 ** 2
+                    stats["pages"] = data.get("pages")
+                    render_pass = 2
+                    pass_started_at = time.monotonic()
+                    # Pass 2 serialises the layout pass 1 built, so pass 1 predicts whether it can finish.
+                    if pass_started_at + stats["pass1_seconds"] * PASS2_TIME_FACTOR > deadline:
+                        stats["breach"] = f"pass 2 would need ~{stats['pass1_seconds'] * PASS2_TIME_FACTOR:.0f}s, {deadline - pass_started_at:.0f}s left"
+                        stats["breach_kind"] = "time"
+                    elif peak_rss * PASS2_MEMORY_FACTOR > memory_budget_bytes:
+                        stats["breach"] = f"pass 2 would need ~{peak_rss * PASS2_MEMORY_FACTOR // 1024 ** 2:.0f} MiB, budget {memory_budget_bytes // 1024 ** 2} MiB"
+                        stats["breach_kind"] = "memory"
+                    if stats.get("breach"):
+                        return stats
+                continue
+
+            now = time.monotonic()
+            rss = _process_rss_bytes(process.pid)
+            peak_rss = max(peak_rss, rss)
+            stats["peak_rss_mb"] = peak_rss // 1024 ** 2
+            if rss > memory_budget_bytes:
+                stats["breach"] = f"pass {render_pass} RSS {rss // 1024 ** 2} MiB over budget {memory_budget_bytes // 1024 ** 2} MiB"
+                stats["breach_kind"] = "memory"
+            elif render_pass == 1 and now + (now - pass_started_at) * PASS2_TIME_FACTOR > deadline:
+                stats["breach"] = f"pass 1 still running after {now - pass_started_at:.0f}s; pass 2 could not finish in time"
+                stats["breach_kind"] = "time"
+            elif now > deadline:
+                stats["breach"] = f"pass {render_pass} ran past the deadline"
+                stats["breach_kind"] = "time"
+            if stats.get("breach"):
+                return stats
+    finally:
+        stats["seconds"] = round(time.monotonic() - started_at, 2)
+        if process.is_alive():
+            process.kill()
+        process.join()
+        reader.close()
+        if not finished and abort_upload:
+            for upload in uploads:
+                abort_upload(upload)
+
+
+def guarded_render(render, book_data, workdir, deadline, memory_budget_bytes=None, abort_upload=None):
+    """
+    Renders a book while watching its memory and elapsed time.
+
+    `render(book_data, on_event)` must do the whole two-pass render and return
+    something picklable. It runs in a forked process so it can be stopped the
+    moment the watchdog predicts it would breach `memory_budget_bytes` or
+    `deadline` (a time.monotonic() value). It is then retried with the next
+    degradation step applied on top of the previous ones: downsampled images,
+    no debug pages, and finally a text-only proof. After running out of time it
+    is only retried if the time left is at least what the first attempt took.
+    `render` reports each multipart upload it starts with an "upload_started"
+    event; `abort_upload` is called with that event's data for every upload a
+    stopped render left open.
+
+    Returns `(result, report)`, where the report records the steps applied and
+    every attempt. Raises RenderBudgetExceeded if even the text-only proof fails.
+    """
+    if memory_budget_bytes is None:
+        memory_budget_bytes = int(MEMORY_LIMIT_BYTES * RENDER_MEMORY_FRACTION)
+    report = {"degradations": [], "attempts": []}
+    for level in range(len(DEGRADATION_STEPS) + 1):
+        steps = DEGRADATION_STEPS[:level]
+        attempt_data = degrade_book(book_data, steps, workdir) if steps else book_data
+        stats = _attempt(render, attempt_data, deadline, memory_budget_bytes, abort_upload)
+        result = stats.pop("result", None)
+        report["attempts"].append({"degradations": steps, **stats})
+        if "breach" not in stats:
+            report["degradations"] = steps
+            return result, report
+        if level < len(DEGRADATION_STEPS):
+            remaining_seconds = deadline - time.monotonic()
+            first_seconds = report["attempts"][0]["seconds"]
+            if stats.get("breach_kind") == "time" and remaining_seconds < first_seconds:
+                raise RenderBudgetExceeded(
+                    f"Render ran out of time ({stats['breach']}), and the {remaining_seconds:.0f}s left "
+                    f"is less than the {first_seconds:.0f}s the first attempt took"
+                )
+            print(f"WARNING: render stopped ({stats['breach']}); retrying with {DEGRADATION_STEPS[level]}.")
+    raise RenderBudgetExceeded(f"Render could not fit its budget even as a text-only proof: {report['attempts'][-1]['breach']}")
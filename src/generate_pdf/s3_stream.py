@@ -0,0 +1,176 @@
+# FILE: src/generate_pdf/s3_stream.py
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# S3 requires every part but the last to be at least 5 MiB.
+S3_PART_BYTES = max(5 * 1024 ** 2, int(os.environ.get('S3_PART_BYTES', str(8 * 1024 ** 2))))
+# Parts uploading at once; writes block once this many are in flight, bounding memory.
+S3_MAX_INFLIGHT_PARTS = int(os.environ.get('S3_MAX_INFLIGHT_PARTS', '4'))
+# When set, "uploads" are written under this directory instead of to S3 (local runs and tests).
+PDF_SINK_LOCAL_DIR = os.environ.get('PDF_SINK_LOCAL_DIR')
+
+
+class S3MultipartWriter:
+    """
+    A write-only binary file object that streams into an S3 multipart upload.
+
+    Bytes are buffered until a full part is available, which is then uploaded
+    on a background thread while the caller keeps writing. `close()` sends the
+    last part and completes the upload; leaving a `with` block on an exception
+    aborts it, so no half-written object or orphaned parts are left behind.
+    """
+
+    def __init__(self, s3_client, bucket, key, content_type="application/octet-stream"):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.name = f"s3://{bucket}/{key}"
+        self.closed = False
+        self._buffer = bytearray()
+        self._position = 0
+        self._parts = []
+        self._pool = ThreadPoolExecutor(max_workers=S3_MAX_INFLIGHT_PARTS)
+        self._inflight = []
+        upload = s3_client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)
+        # Public so that whoever may have to kill the writing process can abort the upload instead.
+        self.upload_id = upload['UploadId']
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= S3_PART_BYTES:
+            part = bytes(self._buffer[:S3_PART_BYTES])
+            del self._buffer[:S3_PART_BYTES]
+            self._send(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _send(self, body):
+        # Wait for the oldest part when the window is full, surfacing any upload error early.
+        if len(self._inflight) >= S3_MAX_INFLIGHT_PARTS:
+            self._parts.append(self._inflight.pop(0).result())
+        part_number = len(self._parts) + len(self._inflight) + 1
+        self._inflight.append(self._pool.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body):
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body
+        )
+        return {"PartNumber": part_number, "ETag": response['ETag']}
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # The last part may be short, and an empty PDF still needs one part.
+            if self._buffer or not (self._parts or self._inflight):
+                self._send(bytes(self._buffer))
+                self._buffer.clear()
+            self._parts.extend(future.result() for future in self._inflight)
+            self._inflight = []
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": self._parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.closed = True
+            self._pool.shutdown(wait=True)
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        for future in self._inflight:
+            future.cancel()
+        self._pool.shutdown(wait=True)
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Warning: could not abort multipart upload of {self.name}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class LocalFileWriter:
+    """
+    Stand-in for S3MultipartWriter that writes `<root>/<bucket>/<key>`.
+    The file only appears under its final name once the write completes.
+    """
+
+    # There is no multipart upload to abort on its behalf.
+    upload_id = None
+
+    def __init__(self, root, bucket, key):
+        self.path = os.path.join(root, bucket, key)
+        self.name = self.path
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._partial_path = f"{self.path}.partial"
+        self._file = open(self._partial_path, "wb")
+        self._position = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._position += len(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+        os.replace(self._partial_path, self.path)
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+        os.remove(self._partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def open_upload(s3_client, bucket, key, content_type="application/octet-stream"):
+    """A streaming sink for `s3://bucket/key`, or a local file when PDF_SINK_LOCAL_DIR is set."""
+    if PDF_SINK_LOCAL_DIR:
+        return LocalFileWriter(PDF_SINK_LOCAL_DIR, bucket, key)
+    return S3MultipartWriter(s3_client, bucket, key, content_type=content_type)
@@ -0,0 +1,133 @@
+# FILE: src/generate_pdf/workspace.py
+
+import os
+import shutil
+import tempfile
+
+# Every book gets its own directory under here; anything else found here is left over
+# from an earlier invocation on this container and is swept away.
+WORKSPACE_ROOT = os.environ.get('WORKSPACE_ROOT', '/tmp/workspaces')
+# Headroom kept free on /tmp after a download or render, so fonts caches and logs still fit.
+WORKSPACE_MIN_FREE_BYTES = int(os.environ.get('WORKSPACE_MIN_FREE_BYTES', str(64 * 1024 ** 2)))
+# Rough sizes used to preflight a book before anything is downloaded.
+ESTIMATED_IMAGE_BYTES = int(os.environ.get('ESTIMATED_IMAGE_BYTES', str(4 * 1024 ** 2)))
+ESTIMATED_PDF_OVERHEAD_BYTES = int(os.environ.get('ESTIMATED_PDF_OVERHEAD_BYTES', str(8 * 1024 ** 2)))
+
+# Workspaces opened by this process that are still in use.
+_active = set()
+
+
+class InsufficientScratchSpace(RuntimeError):
+    pass
+
+
+def _tree_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+def usage(root=WORKSPACE_ROOT):
+    """Ephemeral storage totals plus what the workspaces themselves hold."""
+    os.makedirs(root, exist_ok=True)
+    disk = shutil.disk_usage(root)
+    entries = [os.path.join(root, name) for name in os.listdir(root)]
+    return {
+        "total_bytes": disk.total,
+        "used_bytes": disk.used,
+        "free_bytes": disk.free,
+        "workspaces": len(entries),
+        "workspace_bytes": sum(_tree_bytes(path) for path in entries),
+    }
+
+
+def _owned_by_live_process(name):
+    # Workspace names end in "-<pid>-<random>"; batch renders run books in sibling processes.
+    try:
+        pid = int(name.rsplit('-', 2)[-2])
+    except (IndexError, ValueError):
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sweep(root=WORKSPACE_ROOT):
+    """
+    Deletes workspaces nobody is using: books from earlier warm invocations
+    that timed out or crashed before cleaning up after themselves.
+    Returns the number of bytes freed.
+    """
+    os.makedirs(root, exist_ok=True)
+    freed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if path in _active or _owned_by_live_process(name):
+            continue
+        freed += _tree_bytes(path)
+        shutil.rmtree(path, ignore_errors=True)
+    if freed:
+        print(f"--- Swept {freed} bytes of stale workspaces from {root} ---")
+    return freed
+
+
+class Workspace:
+    """
+    A scratch directory for one book, removed when the `with` block exits.
+
+    Call `reserve` before writing anything large: it checks there will still be
+    WORKSPACE_MIN_FREE_BYTES left afterwards, sweeping stale workspaces first if
+    there would not, and raises InsufficientScratchSpace rather than letting a
+    render die halfway through with ENOSPC.
+    """
+
+    def __init__(self, label, root=WORKSPACE_ROOT):
+        self.root = root
+        self.label = label
+        self.path = None
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=f"{self.label}-{os.getpid()}-", dir=self.root)
+        _active.add(self.path)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+        return False
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def reserve(self, needed_bytes, what):
+        free = shutil.disk_usage(self.root).free
+        if free - needed_bytes >= WORKSPACE_MIN_FREE_BYTES:
+            return
+        free += sweep(self.root)
+        if free - needed_bytes < WORKSPACE_MIN_FREE_BYTES:
+            raise InsufficientScratchSpace(
+                f"Not enough space in {self.root} for {what}: need {needed_bytes} bytes "
+                f"plus {WORKSPACE_MIN_FREE_BYTES} headroom, {free} free."
+            )
+
+    def size_bytes(self):
+        return _tree_bytes(self.path) if self.path else 0
+
+    def cleanup(self):
+        if self.path is None:
+            return
+        print(f"--- Releasing workspace {self.path} ({self.size_bytes()} bytes) ---")
+        shutil.rmtree(self.path, ignore_errors=True)
+        _active.discard(self.path)
+        self.path = None
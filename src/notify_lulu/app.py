@@ -4,12 +4,22 @@ import boto3
 import json
 import os
 import requests
+import book_tracing
+import book_metrics
+import book_profiling
+import book_logging
+import resilience
 
 s3_client = boto3.client('s3')
 secrets_manager = boto3.client('secretsmanager')
+book_tracing.instrument(s3_client, secrets_manager)
+book_metrics.instrument(s3_client, secrets_manager)
 API_KEYS_SECRET_ARN = os.environ.get('API_KEYS_SECRET_ARN')
 LULU_SANDBOX_MODE = os.environ.get('LULU_SANDBOX_MODE', 'true').lower() == 'true'
 
+# Reused across warm invocations so Lulu auth and print-job calls share keep-alive connections.
+http_session = requests.Session()
+
 # --- THIS IS THE FINAL FIX ---
 # We now use the proven correct URL structure.
 if LULU_SANDBOX_MODE:
@@ -21,6 +31,10 @@ else:
     LULU_AUTH_URL = "https://api.lulu.com/auth/realms/glasstree/protocol/openid-connect/token"
     print("RUNNING IN LULU PRODUCTION MODE")
 
+# Overridable so the offline harness (offline/fake_services.py) can stand in for Lulu.
+LULU_API_URL = os.environ.get('LULU_API_URL', LULU_API_URL)
+LULU_AUTH_URL = os.environ.get('LULU_AUTH_URL', LULU_AUTH_URL)
+
 def get_lulu_token(client_key, client_secret):
     """Authenticates with Lulu using Basic Auth, matching the successful Postman request."""
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
@@ -28,8 +42,14 @@ def get_lulu_token(client_key, client_secret):
     
     print(f"Requesting Lulu API access token from {LULU_AUTH_URL}...")
     # This combination of `auth` and `data` perfectly mimics the successful Postman test.
-    response = requests.post(LULU_AUTH_URL, headers=headers, auth=(client_key, client_secret), data=payload)
-    response.raise_for_status()
+    def authenticate():
+        with book_tracing.span('lulu.auth') as span:
+            response = http_session.post(LULU_AUTH_URL, headers=headers, auth=(client_key, client_secret), data=payload)
+            span.update(status=response.status_code, response_bytes=len(response.content))
+            response.raise_for_status()
+        return response
+
+    response = resilience.upstream('lulu').call(authenticate)
     
     access_token = response.json()['access_token']
     print("Successfully received Lulu access token.")
@@ -42,8 +62,11 @@ def create_presigned_url(s3_uri, expiration=3600):
     url = s3_client.generate_presigned_url('get_object', Params={'Bucket': bucket_name, 'Key': key}, ExpiresIn=expiration)
     return url
 
+@book_tracing.traced_handler('notify_lulu')
+@book_metrics.metrics_handler('notify_lulu')
+@book_profiling.profiled_handler('notify_lulu')
 def lambda_handler(event, context):
-    print(f"Received event to notify Lulu: {json.dumps(event, indent=2)}")
+    book_logging.log_event("Received event to notify Lulu", event)
     
     # Your payload unwrapping logic is correct
     if 'Payload' in event and isinstance(event['Payload'], dict):
@@ -104,8 +127,15 @@ def lambda_handler(event, context):
         print_job_url = f"{LULU_API_URL}/print-jobs/"
         headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
         
-        response = requests.post(print_job_url, headers=headers, json=lulu_payload)
-        response.raise_for_status()
+        def create_print_job():
+            with book_tracing.span('lulu.print_jobs', line_items=len(line_items)) as span:
+                response = http_session.post(print_job_url, headers=headers, json=lulu_payload)
+                span.update(status=response.status_code, response_bytes=len(response.content))
+                response.raise_for_status()
+            return response
+
+        # Creating a print job is not idempotent: only retried when Lulu says it did not act on it.
+        response = resilience.upstream('lulu').call(create_print_job, idempotent=False)
         
         lulu_response = response.json()
         print("Successfully created Lulu print job! Lulu Job ID: {lulu_response.get('id')}")
@@ -116,6 +146,7 @@ def lambda_handler(event, context):
 
     except Exception as e:
         print(f"ERROR: Failed to create Lulu print job for order {order_id}. Error: {e}")
-        if 'response' in locals() and hasattr(response, 'text'):
-            print(f"Lulu API Response Body: {response.text}")
+        failed_response = getattr(e.__cause__ or e, 'response', None)
+        if hasattr(failed_response, 'text'):
+            print(f"Lulu API Response Body: {failed_response.text}")
         raise e
\ No newline at end of file
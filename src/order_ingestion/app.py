@@ -9,13 +9,20 @@ import hashlib
 import base64
 from datetime import datetime, timezone
 from openai import OpenAI
+import book_tracing
+import usage_ledger
+import book_metrics
+import book_profiling
+import resilience
 
 # --- Client Initialization ---
 sqs = boto3.client('sqs')
 dynamodb = boto3.resource('dynamodb')
 s3 = boto3.client('s3')
 secrets_manager = boto3.client('secretsmanager')
-openai_client = OpenAI(api_key="dummy") # Key will be set in handler
+openai_client = OpenAI(api_key="dummy", max_retries=0) # Key will be set in handler; retries are resilience's job
+book_tracing.instrument(sqs, dynamodb.meta.client, s3, secrets_manager)
+book_metrics.instrument(sqs, dynamodb.meta.client, s3, secrets_manager)
  
 # --- Load Configuration ---
 ORDERS_TABLE_NAME = os.environ.get('ORDERS_TABLE_NAME')
@@ -26,6 +33,21 @@ API_KEYS_SECRET_ARN = os.environ.get('API_KEYS_SECRET_ARN')
 # --- Global variable for secrets ---
 SHOPIFY_WEBHOOK_SECRET = None
 
+# The book lengths we sell; a line item without a "Word Count" property is the shortest.
+BOOK_WORD_COUNTS = (15000, 30000, 50000)
+
+def book_tier(word_count_str):
+    """A line item's "Word Count" ("30000", "30,000 words", "30k") as its tier: "15k", "30k" or "50k"."""
+    if not word_count_str:
+        return f"{BOOK_WORD_COUNTS[0] // 1000}k"
+    text = str(word_count_str).strip().lower()
+    digits = ''.join(ch for ch in text if ch.isdigit())
+    words = int(digits or 0) * (1000 if text.endswith('k') else 1)
+    if words not in BOOK_WORD_COUNTS:
+        print(f"WARNING: Unknown word count '{word_count_str}'; treating it as {BOOK_WORD_COUNTS[0]}.")
+        words = BOOK_WORD_COUNTS[0]
+    return f"{words // 1000}k"
+
 # --- AI Helper Functions (These do not need to change) ---
 def build_data_extraction_prompt(date_time_str: str, location_str: str) -> str:
     """Builds a prompt for the LLM to parse natural language and geocode."""
@@ -52,12 +74,17 @@ def parse_birth_data_with_ai(date_time_str, location_str):
     print(f"Parsing with AI: date_time='{date_time_str}', location='{location_str}'")
     prompt = build_data_extraction_prompt(date_time_str, location_str)
     
-    response = openai_client.chat.completions.create(
-        model="gpt-4-1106-preview",
-        messages=[{"role": "user", "content": prompt}],
-        response_format={"type": "json_object"},
-        temperature=0.0
-    )
+    with book_tracing.span('openai.chat', model="gpt-4-1106-preview", purpose="birth_data", prompt_chars=len(prompt)) as span, \
+            usage_ledger.call('parse', "gpt-4-1106-preview", prompt_chars=len(prompt)) as usage:
+        response = resilience.upstream('openai.chat').call(
+            openai_client.chat.completions.create,
+            model="gpt-4-1106-preview",
+            messages=[{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"},
+            temperature=0.0
+        )
+        span.update(usage_ledger.tokens(response))
+        usage.update(usage_ledger.tokens(response))
     
     structured_data = json.loads(response.choices[0].message.content)
     print(f"Successfully parsed data with AI: {structured_data}")
@@ -71,6 +98,10 @@ def verify_shopify_webhook(data, hmac_header):
     return hmac.compare_digest(computed_hmac, hmac_header.encode('utf-8'))
 
 # --- Main Lambda Handler ---
+@book_tracing.traced_handler('order_ingestion')
+@usage_ledger.ledgered_handler('order_ingestion')
+@book_metrics.metrics_handler('order_ingestion')
+@book_profiling.profiled_handler('order_ingestion')
 def lambda_handler(event, context):
     """
     Handles Shopify webhooks, iterates through ALL line items to find books,
@@ -111,6 +142,7 @@ def lambda_handler(event, context):
             cover_title = unstructured_props.get("Custom Text")
             location_str = unstructured_props.get("Address")
             date_time_str = unstructured_props.get("Delivery Date & Time")
+            tier = book_tier(unstructured_props.get("Word Count"))
 
             # If a line item is missing any of these key properties, we assume it's not a book and skip it.
             if not all([cover_title, location_str, date_time_str]):
@@ -118,13 +150,16 @@ def lambda_handler(event, context):
                 continue
 
             # 3. Use AI to parse the data for this specific book
-            structured_birth_data = parse_birth_data_with_ai(date_time_str, location_str)
+            with usage_ledger.attribute(order_id=order_id, line_item_id=line_item_id, tier=tier):
+                structured_birth_data = parse_birth_data_with_ai(date_time_str, location_str)
             
             # 4. Construct a dictionary for this one book
             book_details = {
                 "line_item_id": line_item_id,
                 "cover_title": cover_title,
-                "birth_data": structured_birth_data
+                "birth_data": structured_birth_data,
+                # The order's word count; every stage's metrics and usage are broken down by it.
+                "tier": tier
             }
             books_for_workflow.append(book_details)
             print(f"Successfully processed and added book for line item {line_item_id}.")
@@ -148,7 +183,9 @@ def lambda_handler(event, context):
             "shopify_payload_s3_path": f"s3://{RAW_PAYLOADS_BUCKET}/{s3_key}",
             "customer_details": payload.get('customer', {}),
             "shipping_address": payload.get('shipping_address', {}),
-            "books": books_for_workflow  # <-- The crucial change
+            "books": books_for_workflow,  # <-- The crucial change
+            # Every later stage reads this from its Step Functions payload and records its spans under it.
+            "trace_id": book_tracing.current_trace_id()
         }
         
         ### END OF PHASE 2 REFACTOR ###
@@ -160,7 +197,8 @@ def lambda_handler(event, context):
             'order_id': order_id, 'created_at': timestamp_iso,
             'status': 'received', 'book_count': len(books_for_workflow),
             'customer_email': payload.get('customer', {}).get('email'),
-            'shopify_payload_s3': clean_payload['shopify_payload_s3_path']
+            'shopify_payload_s3': clean_payload['shopify_payload_s3_path'],
+            'trace_id': clean_payload['trace_id']
         })
 
         sqs.send_message(
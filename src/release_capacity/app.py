@@ -0,0 +1,17 @@
+# FILE: src/release_capacity/app.py
+import capacity_ledger
+
+
+def lambda_handler(event, context):
+    """
+    Ends the order's capacity lease once its books are written, or once the
+    order has failed, so the next order may take their place. Never fails the
+    execution: a lease that cannot be released expires on its own.
+    """
+    order_id = event.get('order_id')
+    try:
+        capacity_ledger.release(order_id)
+        print(f"Released capacity for order {order_id}.")
+    except Exception as e:
+        print(f"WARNING: could not release capacity for order {order_id}; its lease will expire instead: {e}")
+    return {'order_id': order_id}
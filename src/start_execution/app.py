@@ -2,18 +2,30 @@
 import boto3
 import json
 import os
+import book_logging
+import capacity_ledger
 
 # Initialize the Step Functions client
 sfn_client = boto3.client('stepfunctions')
+sqs_client = boto3.client('sqs')
 
 # Get the ARN of the state machine from an environment variable
 STATE_MACHINE_ARN = os.environ['STATE_MACHINE_ARN']
+BOOK_ORDERS_QUEUE_URL = os.environ.get('BOOK_ORDERS_QUEUE_URL')
+# SQS's limit on a message's visibility timeout.
+MAX_VISIBILITY_TIMEOUT_SECONDS = 43200
+# Books per GeneratePDF invocation, sized by Terraform to the function's timeout and memory.
+PDF_BOOKS_PER_INVOCATION = int(os.environ.get('PDF_BOOKS_PER_INVOCATION', '4'))
 
 def lambda_handler(event, context):
     """
-    Triggered by SQS. Loops through messages and starts a Step Function execution for each.
+    Triggered by SQS. Loops through messages and starts a Step Function execution for each,
+    as fast as the OpenAI quota allows (see capacity_ledger). An order it cannot start yet
+    stays on the queue, hidden until there should be room for it, and is reported back as
+    a batch item failure, as is a message that could not be handled.
     """
     print(f"Received {len(event.get('Records', []))} records from SQS.")
+    batch_item_failures = []
 
     for record in event.get('Records', []):
         try:
@@ -25,19 +37,37 @@ def lambda_handler(event, context):
                 print("ERROR: SQS message is missing 'order_id'. Skipping.")
                 continue
 
+            admitted, wait_seconds, lease_created = capacity_ledger.acquire(order_id, max(1, len(message_body.get('books', []))))
+            if not admitted:
+                # Waiting on the queue costs nothing; a book started now would crawl under rate limiting.
+                wait_seconds = min(max(1, wait_seconds), MAX_VISIBILITY_TIMEOUT_SECONDS)
+                print(f"No capacity for order {order_id} yet; leaving it on the queue for {wait_seconds}s.")
+                sqs_client.change_message_visibility(QueueUrl=BOOK_ORDERS_QUEUE_URL, ReceiptHandle=record['receiptHandle'], VisibilityTimeout=wait_seconds)
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+                continue
+
             print(f"Starting Step Function execution for order_id: {order_id}")
 
             # Start the state machine execution
-            sfn_client.start_execution(
-                stateMachineArn=STATE_MACHINE_ARN,
-                name=order_id,  # Using order_id as the name prevents duplicate executions for the same order
-                input=json.dumps(message_body)
-            )
+            try:
+                sfn_client.start_execution(
+                    stateMachineArn=STATE_MACHINE_ARN,
+                    name=order_id,  # Using order_id as the name prevents duplicate executions for the same order
+                    input=json.dumps({**message_body, 'pdf_books_per_invocation': PDF_BOOKS_PER_INVOCATION})
+                )
+            except sfn_client.exceptions.ExecutionAlreadyExists:
+                # A redelivered message for an order that is already running, or has finished (execution
+                # names stay taken). If its lease was already released, the one just taken is not needed.
+                print(f"Execution for order_id {order_id} already exists.")
+                if lease_created:
+                    capacity_ledger.release(order_id, refund=True)
 
         except Exception as e:
-            print(f"ERROR: Failed to start execution for record: {record}. Error: {e}")
+            # The body carries the customer's address and email; only its ids are logged.
+            book_logging.log("Failed to start execution", level='ERROR', message_id=record.get('messageId'),
+                             receive_count=record.get('attributes', {}).get('ApproximateReceiveCount'), error=f"{type(e).__name__}: {e}")
             # The message will become visible in the queue again for a retry.
             # If it fails repeatedly, the DLQ will catch it.
-            raise e # Re-raise the exception to signal failure to the SQS service
+            batch_item_failures.append({'itemIdentifier': record.get('messageId')})
 
-    return {'statusCode': 200, 'body': 'Successfully started executions.'}
\ No newline at end of file
+    return {'batchItemFailures': batch_item_failures}
\ No newline at end of file
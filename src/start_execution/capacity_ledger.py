@@ -0,0 +1,210 @@
+# FILE: src/start_execution/capacity_ledger.py
+"""
+Admission control for new orders, sized to the OpenAI tokens-per-minute quota,
+shipped in the shared layer (start_execution, which is packaged on its own,
+carries a copy).
+
+The ledger is a single DynamoDB item in CAPACITY_TABLE_NAME. It holds two things:
+
+- a token bucket of book starts. It refills at the rate the quota sustains,
+  OPENAI_TOKENS_PER_MINUTE x CAPACITY_QUOTA_FRACTION / OPENAI_TOKENS_PER_BOOK
+  books a minute, and holds at most CAPACITY_BURST_BOOKS.
+- a lease for every order in flight, so no more than MAX_IN_FLIGHT_BOOKS books
+  are being written at once.
+
+start_execution calls `acquire` before it starts an execution. When there is no
+room, it leaves the message on the queue for the time `acquire` suggests instead
+of starting a book that would crawl under rate limiting. The state machine
+calls `release` (through the release_capacity Lambda) once the order's books
+are written or have failed. A lease that is never released expires after
+BOOK_LEASE_SECONDS, which Terraform sets to the longest the state machine can
+take to get there.
+
+Headroom follows the upstream. `report_throttled` (resilience calls it when
+OpenAI answers 429) halves the refill rate. The rate then climbs back by
+CAPACITY_RECOVERY_PER_MINUTE of the full rate for every minute without a 429.
+
+Updates are optimistic: the item carries a version, and a write only lands if
+the version is unchanged. Without CAPACITY_TABLE_NAME every call is admitted.
+"""
+import math
+import os
+import time
+from decimal import Decimal
+
+CAPACITY_TABLE_NAME = os.environ.get('CAPACITY_TABLE_NAME')
+CAPACITY_LEDGER = os.environ.get('CAPACITY_LEDGER', 'openai')
+OPENAI_TOKENS_PER_MINUTE = float(os.environ.get('OPENAI_TOKENS_PER_MINUTE', '300000'))
+# What one book spends: the structure, then per chapter a chapter and a summary.
+OPENAI_TOKENS_PER_BOOK = float(os.environ.get('OPENAI_TOKENS_PER_BOOK', '40000'))
+# The share of the quota new books may plan on; the rest absorbs retries and the app.
+CAPACITY_QUOTA_FRACTION = float(os.environ.get('CAPACITY_QUOTA_FRACTION', '0.8'))
+BOOKS_PER_MINUTE = OPENAI_TOKENS_PER_MINUTE * CAPACITY_QUOTA_FRACTION / OPENAI_TOKENS_PER_BOOK
+CAPACITY_BURST_BOOKS = float(os.environ.get('CAPACITY_BURST_BOOKS', str(max(1.0, BOOKS_PER_MINUTE))))
+MAX_IN_FLIGHT_BOOKS = int(os.environ.get('MAX_IN_FLIGHT_BOOKS', '20'))
+# Terraform derives it from the state machine (see step_functions.tf); this fallback is for local runs.
+BOOK_LEASE_SECONDS = float(os.environ.get('BOOK_LEASE_SECONDS', '1800'))
+CAPACITY_MIN_RATE_FRACTION = float(os.environ.get('CAPACITY_MIN_RATE_FRACTION', '0.1'))
+CAPACITY_RECOVERY_PER_MINUTE = float(os.environ.get('CAPACITY_RECOVERY_PER_MINUTE', '0.1'))
+# A container reports a 429 at most this often, so a burst of them is one signal, not a write storm.
+THROTTLE_REPORT_INTERVAL_SECONDS = float(os.environ.get('THROTTLE_REPORT_INTERVAL_SECONDS', '10'))
+# How long to wait before asking again when only the in-flight cap is in the way.
+IN_FLIGHT_RECHECK_SECONDS = float(os.environ.get('IN_FLIGHT_RECHECK_SECONDS', '60'))
+# Multiplies the lease and the suggested waits; the offline harness shrinks them along with its fakes' latencies.
+CAPACITY_TIME_SCALE = float(os.environ.get('RESILIENCE_TIME_SCALE', '1.0'))
+MAX_UPDATE_ATTEMPTS = 10
+
+_table = None
+_last_throttle_report = 0.0
+
+
+class CapacityLedgerConflict(Exception):
+    """Another writer kept winning the ledger item."""
+
+
+def _ledger_table():
+    global _table
+    if _table is None:
+        import boto3
+        _table = boto3.resource('dynamodb').Table(CAPACITY_TABLE_NAME)
+    return _table
+
+
+def _load():
+    item = _ledger_table().get_item(Key={'ledger': CAPACITY_LEDGER}, ConsistentRead=True).get('Item')
+    if item is None:
+        return {'ledger': CAPACITY_LEDGER, 'version': 0, 'tokens': CAPACITY_BURST_BOOKS, 'rate_fraction': 1.0,
+                'refilled_at': time.time(), 'leases': {}}
+    return {
+        'ledger': CAPACITY_LEDGER, 'version': int(item['version']), 'tokens': float(item['tokens']),
+        'rate_fraction': float(item['rate_fraction']), 'refilled_at': float(item['refilled_at']),
+        'leases': {order_id: {'books': int(lease['books']), 'expires_at': float(lease['expires_at'])}
+                   for order_id, lease in item.get('leases', {}).items()},
+    }
+
+
+def _save(state, previous_version):
+    """Writes `state` unless someone else wrote since `previous_version`; returns whether it landed."""
+    from botocore.exceptions import ClientError
+    item = {
+        'ledger': CAPACITY_LEDGER, 'version': previous_version + 1,
+        'tokens': Decimal(str(round(state['tokens'], 6))), 'rate_fraction': Decimal(str(round(state['rate_fraction'], 6))),
+        'refilled_at': Decimal(str(round(state['refilled_at'], 3))),
+        'leases': {order_id: {'books': lease['books'], 'expires_at': Decimal(str(round(lease['expires_at'], 3)))}
+                   for order_id, lease in state['leases'].items()},
+    }
+    try:
+        _ledger_table().put_item(
+            Item=item,
+            ConditionExpression='attribute_not_exists(ledger) OR version = :version',
+            ExpressionAttributeValues={':version': previous_version},
+        )
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def _refill(state, now):
+    """Adds the book starts earned since the last update, lets the rate recover, and drops expired leases."""
+    elapsed = max(0.0, now - state['refilled_at'])
+    state['rate_fraction'] = min(1.0, state['rate_fraction'] + CAPACITY_RECOVERY_PER_MINUTE * elapsed / 60)
+    state['tokens'] = min(CAPACITY_BURST_BOOKS, state['tokens'] + elapsed * rate(state))
+    state['refilled_at'] = now
+    state['leases'] = {order_id: lease for order_id, lease in state['leases'].items() if lease['expires_at'] > now}
+
+
+def rate(state):
+    """Book starts per second the ledger currently allows."""
+    return BOOKS_PER_MINUTE * state['rate_fraction'] / 60 / CAPACITY_TIME_SCALE
+
+
+def in_flight(state):
+    return sum(lease['books'] for lease in state['leases'].values())
+
+
+def _update(change):
+    """Runs `change(state, now)` on the current ledger and saves it, retrying on conflicts; returns what `change` did."""
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        state = _load()
+        version = state['version']
+        now = time.time()
+        _refill(state, now)
+        result, changed = change(state, now)
+        if not changed or _save(state, version):
+            return result
+    raise CapacityLedgerConflict(f"Could not update the {CAPACITY_LEDGER} capacity ledger after {MAX_UPDATE_ATTEMPTS} attempts")
+
+
+def acquire(order_id, books):
+    """
+    Asks to start an order of `books` books. Returns (admitted, wait_seconds, created):
+    (True, 0, True) when it may start and a lease was taken for it, or (False, seconds,
+    False) with how long to wait before asking again. Asking again for an order that
+    already holds a lease (a redelivered message) is admitted without a new lease,
+    (True, 0, False). A caller that finds the order was already started after all
+    should `release(order_id, refund=True)` a lease it created.
+    """
+    if not CAPACITY_TABLE_NAME:
+        return True, 0, False
+
+    def change(state, now):
+        if order_id in state['leases']:
+            return (True, 0, False), False
+        # An order bigger than the bucket or the cap would never fit; it waits for a full bucket and an idle pipeline instead.
+        needed = min(float(books), CAPACITY_BURST_BOOKS)
+        if state['leases'] and in_flight(state) + books > MAX_IN_FLIGHT_BOOKS:
+            return (False, IN_FLIGHT_RECHECK_SECONDS * CAPACITY_TIME_SCALE, False), False
+        if state['tokens'] < needed:
+            return (False, (needed - state['tokens']) / rate(state), False), False
+        state['tokens'] -= needed
+        state['leases'][order_id] = {'books': books, 'expires_at': now + BOOK_LEASE_SECONDS * CAPACITY_TIME_SCALE}
+        return (True, 0, True), True
+
+    admitted, wait_seconds, created = _update(change)
+    return admitted, math.ceil(wait_seconds), created
+
+
+def release(order_id, refund=False):
+    """
+    Ends the order's lease, so its books no longer count as in flight. With
+    `refund`, the book starts the lease took go back into the bucket too: for a
+    lease taken by mistake, for an order that never started because of it.
+    """
+    if not CAPACITY_TABLE_NAME:
+        return
+
+    def change(state, now):
+        lease = state['leases'].pop(order_id, None)
+        if lease is not None and refund:
+            state['tokens'] = min(CAPACITY_BURST_BOOKS, state['tokens'] + min(float(lease['books']), CAPACITY_BURST_BOOKS))
+        return None, lease is not None
+
+    _update(change)
+
+
+def report_throttled():
+    """Halves the rate new books start at, after the upstream answered 429. Never raises."""
+    global _last_throttle_report
+    if not CAPACITY_TABLE_NAME or time.monotonic() - _last_throttle_report < THROTTLE_REPORT_INTERVAL_SECONDS:
+        return
+    _last_throttle_report = time.monotonic()
+
+    def change(state, now):
+        state['rate_fraction'] = max(CAPACITY_MIN_RATE_FRACTION, state['rate_fraction'] / 2)
+        return None, True
+
+    try:
+        _update(change)
+    except Exception as e:
+        print(f"WARNING: could not report throttling to the {CAPACITY_LEDGER} capacity ledger: {e}")
+
+
+def snapshot():
+    """The ledger as it stands: tokens, rate, and books in flight."""
+    state = _load()
+    _refill(state, time.time())
+    return {'tokens': round(state['tokens'], 2), 'rate_fraction': round(state['rate_fraction'], 3),
+            'books_per_minute': round(rate(state) * 60 * CAPACITY_TIME_SCALE, 2), 'in_flight_books': in_flight(state),
+            'orders_in_flight': len(state['leases'])}
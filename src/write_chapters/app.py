@@ -5,18 +5,40 @@ import boto3
 import json
 import os
 import asyncio
+import httpx
 from openai import AsyncOpenAI
 from urllib.parse import urlparse
+import book_tracing
+import usage_ledger
+import book_metrics
+import book_profiling
+import book_logging
+import resilience
 
 # (All code above this point is unchanged)
 # ...
 s3_client = boto3.client('s3')
 secrets_manager_client = boto3.client('secretsmanager')
-openai_client = AsyncOpenAI(api_key="dummy")
+book_tracing.instrument(s3_client, secrets_manager_client)
+book_metrics.instrument(s3_client, secrets_manager_client)
+# One keep-alive pool for every chapter call. It is bound to the event loop it first runs on,
+# so the handler reuses a single loop across warm invocations instead of calling asyncio.run.
+# Retries are resilience's job, so they share its budget and circuit breaker.
+openai_client = AsyncOpenAI(
+    api_key="dummy",
+    max_retries=0,
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=50, keepalive_expiry=30),
+        timeout=httpx.Timeout(600.0, connect=10.0),
+    ),
+)
+event_loop = asyncio.new_event_loop()
 API_KEYS_SECRET_ARN = os.environ.get('API_KEYS_SECRET_ARN')
 ARTIFACTS_BUCKET = os.environ.get('ARTIFACTS_BUCKET')
 MODEL_TEXT = "gpt-4-1106-preview"
 MODEL_IMAGE = "dall-e-3"
+# Re-issue a chapter request that runs past the usual tail latency, so one straggler does not hold up the book.
+HEDGE_CHAPTERS = os.environ.get('HEDGE_CHAPTERS', 'false').lower() == 'true'
 
 def parse_s3_path(s3_path):
     parsed = urlparse(s3_path, allow_fragments=False)
@@ -39,20 +61,45 @@ def build_summarization_prompt(text):
     return f"Summarize the following text for an image generation prompt, focusing on the core feeling, symbols, and abstract concepts. Be concise and evocative. The summary should be in a single paragraph. Text: {text}"
 
 async def write_and_illustrate_chapter(chapter_details, natal_chart, word_target, order_id, line_item_id, chapter_index):
+    # Each chapter runs as its own asyncio task, so its spans nest under its own chapter span
+    # and its OpenAI calls are attributed to its own chapter.
+    with book_tracing.span('chapter', chapter_index=chapter_index), usage_ledger.attribute(chapter=chapter_index):
+        return await _write_and_illustrate_chapter(chapter_details, natal_chart, word_target, order_id, line_item_id, chapter_index)
+
+async def _write_and_illustrate_chapter(chapter_details, natal_chart, word_target, order_id, line_item_id, chapter_index):
     chapter_title = chapter_details['title']
     print(f"--- Starting Chapter {chapter_index} for line item {line_item_id}: {chapter_title} ---")
     # ... (rest of this function is unchanged)
     chapter_prompt = build_dynamic_chapter_prompt(chapter_details, natal_chart, word_target)
-    text_response = await openai_client.chat.completions.create(model=MODEL_TEXT, messages=[{"role": "user", "content": chapter_prompt}], temperature=0.3)
+    with book_tracing.span('openai.chat', model=MODEL_TEXT, purpose="chapter", prompt_chars=len(chapter_prompt)) as span, \
+            usage_ledger.call('chapter', MODEL_TEXT, prompt_chars=len(chapter_prompt)) as usage:
+        request = dict(model=MODEL_TEXT, messages=[{"role": "user", "content": chapter_prompt}], temperature=0.3)
+        if HEDGE_CHAPTERS:
+            # The loser's tokens are spent too; the ledger marks the call so its cost can be estimated.
+            text_response = await resilience.hedge('openai.chat.chapter').call(
+                resilience.upstream('openai.chat').call_async, openai_client.chat.completions.create,
+                on_hedge=lambda: usage.update(hedged=True), **request)
+        else:
+            text_response = await resilience.upstream('openai.chat').call_async(openai_client.chat.completions.create, **request)
+        span.update(usage_ledger.tokens(text_response))
+        usage.update(usage_ledger.tokens(text_response))
     chapter_text = text_response.choices[0].message.content.strip()
+    book_metrics.put('chapter_words', len(chapter_text.split()), 'Count')
     summary_prompt = build_summarization_prompt(chapter_text)
-    summary_response = await openai_client.chat.completions.create(model=MODEL_TEXT, messages=[{"role": "user", "content": summary_prompt}], temperature=0.2, max_tokens=150)
+    with book_tracing.span('openai.chat', model=MODEL_TEXT, purpose="summary", prompt_chars=len(summary_prompt)) as span, \
+            usage_ledger.call('summary', MODEL_TEXT, prompt_chars=len(summary_prompt)) as usage:
+        summary_response = await resilience.upstream('openai.chat').call_async(openai_client.chat.completions.create, model=MODEL_TEXT, messages=[{"role": "user", "content": summary_prompt}], temperature=0.2, max_tokens=150)
+        span.update(usage_ledger.tokens(summary_response))
+        usage.update(usage_ledger.tokens(summary_response))
     chapter_summary = summary_response.choices[0].message.content.strip()
     safe_summary = chapter_summary.replace("\n", " ")[:350]
     image_prompt = f"Digital art, ethereal and abstract, visually representing the core emotional and symbolic essence of this concept: '{safe_summary}'. Use a rich, deep color palette. Avoid text and human figures."
     image_url = None
     try:
-        image_response = await openai_client.images.generate(model=MODEL_IMAGE, prompt=image_prompt, size="1024x1024", quality="standard", n=1)
+        with book_tracing.span('openai.images', model=MODEL_IMAGE, size="1024x1024"), book_metrics.timer('image_generation_latency'), \
+                usage_ledger.call('image', MODEL_IMAGE, size="1024x1024", prompt_chars=len(image_prompt)) as usage:
+            image_response = await resilience.upstream('openai.images').call_async(openai_client.images.generate, model=MODEL_IMAGE, prompt=image_prompt, size="1024x1024", quality="standard", n=1)
+            usage["images"] = len(image_response.data)
         image_url = image_response.data[0].url
     except Exception as e:
         print(f"Image generation failed or was skipped for chapter {chapter_index}: {e}")
@@ -61,11 +108,15 @@ async def write_and_illustrate_chapter(chapter_details, natal_chart, word_target
     s3_path = f"s3://{ARTIFACTS_BUCKET}/{chapter_s3_key}"
     return {"chapter_index": chapter_index, "chapter_title": chapter_title, "chapter_text_s3_path": s3_path, "image_url": image_url}
 
+@book_tracing.traced_handler('write_chapters')
+@usage_ledger.ledgered_handler('write_chapters')
+@book_metrics.metrics_handler('write_chapters')
+@book_profiling.profiled_handler('write_chapters')
 def lambda_handler(event, context):
-    return asyncio.run(async_lambda_handler(event, context))
+    return event_loop.run_until_complete(async_lambda_handler(event, context))
 
 async def async_lambda_handler(event, context):
-    print(f"WriteChapters received event: {json.dumps(event, indent=2)}")
+    book_logging.log_event("WriteChapters received event", event)
 
     if 'Payload' in event:
         print("Detected nested 'Payload'. Unwrapping...")
@@ -79,7 +130,7 @@ async def async_lambda_handler(event, context):
     book_structure_s3_path = payload.get('book_structure_s3_path')
 
     if not all([order_id, line_item_id, astrology_s3_path, book_structure_s3_path]):
-        raise ValueError(f"Missing required S3 paths or IDs after processing payload. Full incoming event: {json.dumps(event)}")
+        raise ValueError(f"Missing required S3 paths or IDs after processing payload. Incoming event: {json.dumps(book_logging.summary(event))}")
 
     try:
         # --- START OF THE FIX ---
@@ -96,10 +147,12 @@ async def async_lambda_handler(event, context):
         book_structure = json.loads(s3_client.get_object(Bucket=bucket_structure, Key=key_structure)['Body'].read().decode('utf-8'))
 
         chapters = book_structure.get("chapters", [])
-        chapters_output = await asyncio.gather(*[
-            write_and_illustrate_chapter(ch, natal_chart, 800, order_id, line_item_id, idx + 1)
-            for idx, ch in enumerate(chapters)
-        ])
+        book_metrics.set_tier(payload.get('tier'))
+        with usage_ledger.attribute(tier=payload.get('tier')):
+            chapters_output = await asyncio.gather(*[
+                write_and_illustrate_chapter(ch, natal_chart, 800, order_id, line_item_id, idx + 1)
+                for idx, ch in enumerate(chapters)
+            ])
         
         # --- THIS SECTION WAS MISSING AND IS NOW RESTORED. IT PASSES THE FULL BOOK STRUCTURE TO THE PDF GENERATOR ---
         final_output = payload
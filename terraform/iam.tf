@@ -43,6 +43,24 @@ resource "aws_iam_role_policy" "order_ingestion_permissions" {
         Effect   = "Allow",
         Resource = "${aws_s3_bucket.artifacts_bucket.arn}/raw-payloads/*"
       },
+      {
+        # To write this invocation's spans (see book_tracing in the shared layer)
+        Action   = "s3:PutObject",
+        Effect   = "Allow",
+        Resource = "${aws_s3_bucket.artifacts_bucket.arn}/traces/*"
+      },
+      {
+        # To write this invocation's OpenAI usage (see usage_ledger in the shared layer)
+        Action   = "s3:PutObject",
+        Effect   = "Allow",
+        Resource = "${aws_s3_bucket.artifacts_bucket.arn}/usage/*"
+      },
+      {
+        # To write a requested profile of this invocation (see book_profiling in the shared layer)
+        Action   = "s3:PutObject",
+        Effect   = "Allow",
+        Resource = "${aws_s3_bucket.artifacts_bucket.arn}/profiles/*"
+      },
       {
         # To fetch the Shopify signing secret
         Action   = "secretsmanager:GetSecretValue",
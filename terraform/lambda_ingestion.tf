@@ -32,6 +32,10 @@ resource "aws_lambda_function" "order_ingestion" {
       BOOK_ORDERS_QUEUE_URL = aws_sqs_queue.book_orders.id
       RAW_PAYLOADS_BUCKET   = aws_s3_bucket.artifacts_bucket.id
       API_KEYS_SECRET_ARN   = aws_secretsmanager_secret.api_keys_v2.arn
+      TRACE_BUCKET          = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_BUCKET        = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_HANDLERS      = var.profile_handlers
+      USAGE_BUCKET          = aws_s3_bucket.artifacts_bucket.id
     }
   }
 }
\ No newline at end of file
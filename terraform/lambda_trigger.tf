@@ -29,7 +29,8 @@ resource "aws_iam_role_policy" "start_execution_permissions" {
     Statement = [
       {
         # Permissions to read messages from our BookOrders queue
-        Action   = ["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes"],
+        # ChangeMessageVisibility: an order the quota has no room for yet is left on the queue for a while
+        Action   = ["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes", "sqs:ChangeMessageVisibility"],
         Effect   = "Allow",
         Resource = aws_sqs_queue.book_orders.arn
       },
@@ -38,6 +39,12 @@ resource "aws_iam_role_policy" "start_execution_permissions" {
         Action   = "states:StartExecution",
         Effect   = "Allow",
         Resource = aws_sfn_state_machine.astrology_book_factory.arn
+      },
+      {
+        # Admission control (see capacity_ledger)
+        Action   = ["dynamodb:GetItem", "dynamodb:PutItem"],
+        Effect   = "Allow",
+        Resource = aws_dynamodb_table.capacity_table.arn
       }
     ]
   })
@@ -62,7 +69,13 @@ resource "aws_lambda_function" "start_execution" {
 
   environment {
     variables = {
-      STATE_MACHINE_ARN = aws_sfn_state_machine.astrology_book_factory.arn
+      STATE_MACHINE_ARN        = aws_sfn_state_machine.astrology_book_factory.arn
+      BOOK_ORDERS_QUEUE_URL    = aws_sqs_queue.book_orders.id
+      CAPACITY_TABLE_NAME      = aws_dynamodb_table.capacity_table.name
+      OPENAI_TOKENS_PER_MINUTE = var.openai_tokens_per_minute
+      MAX_IN_FLIGHT_BOOKS      = var.max_in_flight_books
+      BOOK_LEASE_SECONDS       = local.book_lease_seconds
+      PDF_BOOKS_PER_INVOCATION = local.pdf_books_per_invocation
     }
   }
 }
@@ -73,4 +86,12 @@ resource "aws_lambda_event_source_mapping" "sqs_trigger" {
   event_source_arn = aws_sqs_queue.book_orders.arn
   function_name    = aws_lambda_function.start_execution.arn
   batch_size       = 5 # Process up to 5 messages at a time
+
+  # Orders that cannot start yet are reported back one by one, not by failing the whole batch.
+  function_response_types = ["ReportBatchItemFailures"]
+
+  # Few concurrent writers, as every one of them updates the same capacity ledger item.
+  scaling_config {
+    maximum_concurrency = 2
+  }
 }
\ No newline at end of file
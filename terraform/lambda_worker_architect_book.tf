@@ -19,7 +19,9 @@ resource "aws_iam_role_policy" "architect_book_permissions" {
     Version = "2012-10-17",
     Statement = [
       { Action = "secretsmanager:GetSecretValue", Effect = "Allow", Resource = aws_secretsmanager_secret.api_keys_v2.arn },
-      { Action = ["s3:GetObject", "s3:PutObject"], Effect = "Allow", Resource = "${aws_s3_bucket.artifacts_bucket.arn}/*" }
+      { Action = ["s3:GetObject", "s3:PutObject"], Effect = "Allow", Resource = "${aws_s3_bucket.artifacts_bucket.arn}/*" },
+      # To slow new orders down when OpenAI throttles (see capacity_ledger in the shared layer)
+      { Action = ["dynamodb:GetItem", "dynamodb:PutItem"], Effect = "Allow", Resource = aws_dynamodb_table.capacity_table.arn }
     ]
   })
 }
@@ -49,8 +51,15 @@ resource "aws_lambda_function" "architect_book" {
 
   environment {
     variables = {
-      API_KEYS_SECRET_ARN = aws_secretsmanager_secret.api_keys_v2.arn
-      ARTIFACTS_BUCKET    = aws_s3_bucket.artifacts_bucket.id
+      API_KEYS_SECRET_ARN      = aws_secretsmanager_secret.api_keys_v2.arn
+      ARTIFACTS_BUCKET         = aws_s3_bucket.artifacts_bucket.id
+      TRACE_BUCKET             = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_BUCKET           = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_HANDLERS         = var.profile_handlers
+      CAPACITY_TABLE_NAME      = aws_dynamodb_table.capacity_table.name
+      OPENAI_TOKENS_PER_MINUTE = var.openai_tokens_per_minute
+      MAX_IN_FLIGHT_BOOKS      = var.max_in_flight_books
+      USAGE_BUCKET             = aws_s3_bucket.artifacts_bucket.id
     }
   }
 }
@@ -52,6 +52,9 @@ resource "aws_lambda_function" "fetch_astrology" {
     variables = {
       API_KEYS_SECRET_ARN = aws_secretsmanager_secret.api_keys_v2.arn
       ARTIFACTS_BUCKET    = aws_s3_bucket.artifacts_bucket.id
+      TRACE_BUCKET        = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_BUCKET      = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_HANDLERS    = var.profile_handlers
     }
   }
 }
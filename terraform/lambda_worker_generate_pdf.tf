@@ -23,7 +23,8 @@ resource "aws_iam_role_policy" "generate_pdf_permissions" {
   policy = jsonencode({
     Version = "2012-10-17",
     Statement = [{
-      Action   = ["s3:GetObject", "s3:PutObject", "s3:ListBucket"],
+      # PutObject also covers the parts of a multipart upload; aborting one is a separate action.
+      Action   = ["s3:GetObject", "s3:PutObject", "s3:AbortMultipartUpload", "s3:ListBucket"],
       Effect   = "Allow",
       Resource = ["${aws_s3_bucket.artifacts_bucket.arn}", "${aws_s3_bucket.artifacts_bucket.arn}/*"]
     }]
@@ -45,7 +46,28 @@ resource "aws_lambda_function" "generate_pdf" {
 
   environment {
     variables = {
-      ARTIFACTS_BUCKET = aws_s3_bucket.artifacts_bucket.id
+      ARTIFACTS_BUCKET          = aws_s3_bucket.artifacts_bucket.id
+      TRACE_BUCKET              = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_BUCKET            = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_HANDLERS          = var.profile_handlers
+      RENDER_MEMORY_MB_PER_BOOK = var.pdf_render_memory_mb_per_book
     }
   }
+}
+
+# How an order's books are split between GeneratePDF invocations (GeneratePDFChunks
+# in the state machine), so that every chunk fits one invocation's time and memory.
+locals {
+  # Renders side by side, as generate_pdf works them out: one per vCPU (Lambda gives
+  # one per 1769 MB), and no more than fit in the share of memory render_guard lets
+  # renders use.
+  pdf_batch_workers = max(1, min(
+    ceil(aws_lambda_function.generate_pdf.memory_size / 1769),
+    floor(aws_lambda_function.generate_pdf.memory_size * 0.85 / var.pdf_render_memory_mb_per_book),
+  ))
+  # Rounds of renders that finish before the renders' deadline (the timeout less
+  # RENDER_DEADLINE_MARGIN_SECONDS).
+  pdf_render_rounds = floor((aws_lambda_function.generate_pdf.timeout - 30) / var.pdf_render_seconds_per_book)
+  # When not even one round fits, every book gets an invocation of its own.
+  pdf_books_per_invocation = max(1, local.pdf_batch_workers * local.pdf_render_rounds)
 }
\ No newline at end of file
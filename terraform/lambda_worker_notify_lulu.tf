@@ -26,6 +26,18 @@ resource "aws_iam_role_policy" "notify_lulu_permissions" {
         Action   = "secretsmanager:GetSecretValue",
         Effect   = "Allow",
         Resource = aws_secretsmanager_secret.api_keys_v2.arn
+      },
+      {
+        # To write this invocation's spans (see book_tracing in the shared layer)
+        Action   = "s3:PutObject",
+        Effect   = "Allow",
+        Resource = "${aws_s3_bucket.artifacts_bucket.arn}/traces/*"
+      },
+      {
+        # To write a requested profile of this invocation (see book_profiling in the shared layer)
+        Action   = "s3:PutObject",
+        Effect   = "Allow",
+        Resource = "${aws_s3_bucket.artifacts_bucket.arn}/profiles/*"
       }
       # Note: We don't need S3 read access if we only pass the S3 URL to Lulu
     ]
@@ -60,6 +72,9 @@ resource "aws_lambda_function" "notify_lulu" {
   environment {
     variables = {
       API_KEYS_SECRET_ARN = aws_secretsmanager_secret.api_keys_v2.arn
+      TRACE_BUCKET        = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_BUCKET      = aws_s3_bucket.artifacts_bucket.id
+      PROFILE_HANDLERS    = var.profile_handlers
     }
   }
 }
\ No newline at end of file
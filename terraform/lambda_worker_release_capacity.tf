@@ -0,0 +1,67 @@
+# FILE: terraform/lambda_worker_release_capacity.tf
+
+# 1. IAM Role for the ReleaseCapacity Lambda
+resource "aws_iam_role" "release_capacity_role" {
+  name = "${var.project_name}-ReleaseCapacityRole"
+  assume_role_policy = jsonencode({
+    Version   = "2012-10-17",
+    Statement = [{ Action = "sts:AssumeRole", Effect = "Allow", Principal = { Service = "lambda.amazonaws.com" } }]
+  })
+}
+
+# 2. Basic policy for CloudWatch Logs
+resource "aws_iam_role_policy_attachment" "release_capacity_logs" {
+  role       = aws_iam_role.release_capacity_role.name
+  policy_arn = "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
+}
+
+# 3. Custom policy with permissions this Lambda needs
+resource "aws_iam_role_policy" "release_capacity_permissions" {
+  name = "ReleaseCapacityPermissions"
+  role = aws_iam_role.release_capacity_role.id
+  policy = jsonencode({
+    Version = "2012-10-17",
+    Statement = [
+      {
+        # To end the order's lease (see capacity_ledger in the shared layer)
+        Action   = ["dynamodb:GetItem", "dynamodb:PutItem"],
+        Effect   = "Allow",
+        Resource = aws_dynamodb_table.capacity_table.arn
+      }
+    ]
+  })
+}
+
+# 4. Create a zip of the function's code
+data "archive_file" "release_capacity_code" {
+  type        = "zip"
+  source_file = "${path.module}/../src/release_capacity/app.py"
+  output_path = "${path.module}/../dist/release_capacity_code.zip"
+}
+
+# 5. Define the Lambda function resource
+resource "aws_lambda_function" "release_capacity" {
+  function_name = "${var.project_name}-ReleaseCapacity"
+  role          = aws_iam_role.release_capacity_role.arn
+
+  package_type = "Zip"
+  handler      = "app.lambda_handler"
+  runtime      = "python3.11"
+  timeout      = 30
+
+  filename         = data.archive_file.release_capacity_code.output_path
+  source_code_hash = data.archive_file.release_capacity_code.output_base64sha256
+
+  # capacity_ledger comes from the shared libraries layer
+  layers = [
+    aws_lambda_layer_version.shared_libraries.arn
+  ]
+
+  environment {
+    variables = {
+      CAPACITY_TABLE_NAME      = aws_dynamodb_table.capacity_table.name
+      OPENAI_TOKENS_PER_MINUTE = var.openai_tokens_per_minute
+      MAX_IN_FLIGHT_BOOKS      = var.max_in_flight_books
+    }
+  }
+}
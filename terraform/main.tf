@@ -22,11 +22,64 @@ variable "unique_suffix" {
   default     = "astrology-initials-123"
 }
 
+variable "profile_handlers" {
+  description = "Stages whose every invocation is profiled to s3://<artifacts>/profiles/, comma-separated (e.g. \"generate_pdf,write_chapters\"), or \"all\". Empty turns profiling off."
+  type        = string
+  default     = ""
+}
+
+variable "openai_tokens_per_minute" {
+  description = "The OpenAI account's tokens-per-minute quota. New orders are started no faster than it can sustain (see capacity_ledger in the shared layer)."
+  type        = number
+  default     = 300000
+}
+
+variable "max_in_flight_books" {
+  description = "The most books being written at once; further orders wait on the queue."
+  type        = number
+  default     = 20
+}
+
+variable "pdf_render_seconds_per_book" {
+  description = "The longest one book takes to typeset, images and all. Sizes the chunks an order's books are rendered in (see lambda_worker_generate_pdf.tf)."
+  type        = number
+  default     = 300
+}
+
+variable "pdf_render_memory_mb_per_book" {
+  description = "The most memory one book's render takes. Sizes how many books GeneratePDF renders side by side."
+  type        = number
+  default     = 1024
+}
+
+variable "hedge_chapter_requests" {
+  description = "Re-issue a chapter's OpenAI request when it runs past the p95 of chapter latency, within a 5% budget (see resilience in the shared layer)."
+  type        = bool
+  default     = false
+}
+
 resource "aws_s3_bucket" "artifacts_bucket" {
   # Renamed for clarity, as it holds more than just books
   bucket = "astrology-artifacts-${var.unique_suffix}"
 }
 
+# A render killed mid-upload may leave its multipart upload open (generate_pdf aborts
+# the ones it knows of); S3 clears whatever is left, so stray parts are not billed forever.
+resource "aws_s3_bucket_lifecycle_configuration" "artifacts_bucket" {
+  bucket = aws_s3_bucket.artifacts_bucket.id
+
+  rule {
+    id     = "abort-incomplete-multipart-uploads"
+    status = "Enabled"
+
+    filter {}
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
+  }
+}
+
 resource "aws_dynamodb_table" "orders_table" {
   name         = "${var.project_name}-Orders"
   billing_mode = "PAY_PER_REQUEST"
@@ -41,6 +94,18 @@ resource "aws_dynamodb_table" "orders_table" {
   }
 }
 
+# Admission control for new orders: one item per upstream quota (see capacity_ledger in the shared layer).
+resource "aws_dynamodb_table" "capacity_table" {
+  name         = "${var.project_name}-Capacity"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "ledger"
+
+  attribute {
+    name = "ledger"
+    type = "S"
+  }
+}
+
 resource "aws_secretsmanager_secret" "api_keys_v2" {
   name        = "${var.project_name}-ApiKeys-V2"
   description = "API Keys for Astrology, OpenAI, Lulu, Shopify"
@@ -9,6 +9,7 @@ resource "aws_sqs_queue" "book_orders" {
 
   redrive_policy = jsonencode({
     deadLetterTargetArn = aws_sqs_queue.book_orders_dlq.arn
-    maxReceiveCount     = 5
+    # Every time start_execution defers an order for lack of capacity counts as a receive.
+    maxReceiveCount     = 100
   })
 }
\ No newline at end of file
@@ -30,11 +30,35 @@ resource "aws_iam_role_policy" "step_functions_permissions" {
         aws_lambda_function.write_chapters.arn,
         aws_lambda_function.generate_pdf.arn,
         aws_lambda_function.notify_lulu.arn, # <-- Added Lulu permission
+        aws_lambda_function.release_capacity.arn,
       ]
     }]
   })
 }
 
+# -----------------------------------------------------------------------------
+# HOW LONG AN ORDER CAN HOLD OPENAI CAPACITY
+# -----------------------------------------------------------------------------
+
+locals {
+  # The UpstreamUnavailable Retry of every book task below. It is written out in
+  # each state, as offline/state_machine.py reads the definition without locals.
+  upstream_retry_max_attempts = 4
+  upstream_retry_wait_seconds = sum([for attempt in range(local.upstream_retry_max_attempts) : min(60 * pow(2, attempt), 600)])
+
+  # The longest an order can take from start_execution admitting it to
+  # ReleaseCapacity: the books run side by side, and each of one book's tasks
+  # times out on every attempt and waits out every retry. Its capacity lease
+  # (see capacity_ledger in the shared layer) only expires after this long.
+  book_lease_seconds = sum([
+    for timeout in [
+      aws_lambda_function.fetch_astrology.timeout,
+      aws_lambda_function.architect_book.timeout,
+      aws_lambda_function.write_chapters.timeout,
+    ] : (1 + local.upstream_retry_max_attempts) * timeout + local.upstream_retry_wait_seconds
+  ])
+}
+
 # -----------------------------------------------------------------------------
 # THE STEP FUNCTIONS STATE MACHINE (FINAL VERSION) 
 # -----------------------------------------------------------------------------
@@ -55,8 +79,12 @@ resource "aws_sfn_state_machine" "astrology_book_factory" {
           "line_item_id.$"     = "$$.Map.Item.Value.line_item_id",
           "cover_title.$"      = "$$.Map.Item.Value.cover_title",
           "birth_data.$"       = "$$.Map.Item.Value.birth_data",
-          "shipping_address.$" = "$.shipping_address"
+          "tier.$"             = "$$.Map.Item.Value.tier",
+          "shipping_address.$" = "$.shipping_address",
+          "trace_id.$"         = "$.trace_id"
         },
+        # Each book task waits out an upstream that is down (resilience.UpstreamUnavailable)
+        # on a long, jittered interval before giving up on the book.
         Iterator = {
           StartAt = "FetchAstrologyData",
           States = {
@@ -65,7 +93,8 @@ resource "aws_sfn_state_machine" "astrology_book_factory" {
               Resource   = "arn:aws:states:::lambda:invoke",
               Parameters = { "FunctionName" = aws_lambda_function.fetch_astrology.arn, "Payload.$" = "$" },
               ResultPath = "$", # This simple path passes the full result to the next step
-              Catch      = [{ "ErrorEquals" : ["States.All"], "ResultPath" : "$.error", "Next" : "BookGenerationFailed" }],
+              Retry      = [{ "ErrorEquals" : ["UpstreamUnavailable"], "IntervalSeconds" : 60, "BackoffRate" : 2, "MaxAttempts" : 4, "MaxDelaySeconds" : 600, "JitterStrategy" : "FULL" }],
+              Catch      = [{ "ErrorEquals" : ["States.ALL"], "ResultPath" : "$.error", "Next" : "BookGenerationFailed" }],
               Next       = "ArchitectBook"
             },
             ArchitectBook = {
@@ -73,7 +102,8 @@ resource "aws_sfn_state_machine" "astrology_book_factory" {
               Resource   = "arn:aws:states:::lambda:invoke",
               Parameters = { "FunctionName" = aws_lambda_function.architect_book.arn, "Payload.$" = "$" },
               ResultPath = "$", # This simple path passes the full result to the next step
-              Catch      = [{ "ErrorEquals" : ["States.All"], "ResultPath" : "$.error", "Next" : "BookGenerationFailed" }],
+              Retry      = [{ "ErrorEquals" : ["UpstreamUnavailable"], "IntervalSeconds" : 60, "BackoffRate" : 2, "MaxAttempts" : 4, "MaxDelaySeconds" : 600, "JitterStrategy" : "FULL" }],
+              Catch      = [{ "ErrorEquals" : ["States.ALL"], "ResultPath" : "$.error", "Next" : "BookGenerationFailed" }],
               Next       = "WriteChapters"
             },
             WriteChapters = {
@@ -81,25 +111,95 @@ resource "aws_sfn_state_machine" "astrology_book_factory" {
               Resource   = "arn:aws:states:::lambda:invoke",
               Parameters = { "FunctionName" = aws_lambda_function.write_chapters.arn, "Payload.$" = "$" },
               ResultPath = "$", # This simple path passes the full result to the next step
-              Catch      = [{ "ErrorEquals" : ["States.All"], "ResultPath" : "$.error", "Next" : "BookGenerationFailed" }],
-              Next       = "GeneratePDF"
-            },
-            GeneratePDF = {
-              Type           = "Task",
-              Resource       = "arn:aws:states:::lambda:invoke",
-              Parameters     = { "FunctionName" = aws_lambda_function.generate_pdf.arn, "Payload.$" = "$" },
-              ResultPath     = "$", # This simple path passes the full result to the next step
-              TimeoutSeconds = 840,
-              Catch          = [{ "ErrorEquals" : ["States.All"], "ResultPath" : "$.error", "Next" : "BookGenerationFailed" }],
-              Next           = "BookGenerationSucceeded"
+              Retry      = [{ "ErrorEquals" : ["UpstreamUnavailable"], "IntervalSeconds" : 60, "BackoffRate" : 2, "MaxAttempts" : 4, "MaxDelaySeconds" : 600, "JitterStrategy" : "FULL" }],
+              Catch      = [{ "ErrorEquals" : ["States.ALL"], "ResultPath" : "$.error", "Next" : "BookGenerationFailed" }],
+              Next       = "BookGenerationSucceeded"
             },
             BookGenerationSucceeded = { "Type" : "Succeed" },
             BookGenerationFailed    = { "Type" : "Fail" }
           }
         },
-        ResultPath = "$.processed_books_results",
-        Catch      = [{ "ErrorEquals" : ["States.All"], "Next" : "OrderFailed" }],
-        Next       = "NotifyLulu"
+        ResultPath = "$.written_books",
+        Catch      = [{ "ErrorEquals" : ["States.ALL"], "ResultPath" : "$.error", "Next" : "ReleaseCapacityAfterFailure" }],
+        Next       = "ReleaseCapacity"
+      },
+
+      # The books are written, so the order is done with OpenAI: the next order
+      # may take its place (see capacity_ledger in the shared layer). Releasing
+      # never holds the order up; a lease left behind expires on its own.
+      ReleaseCapacity = {
+        Type       = "Task",
+        Resource   = "arn:aws:states:::lambda:invoke",
+        Parameters = { "FunctionName" = aws_lambda_function.release_capacity.arn, "Payload" = { "order_id.$" = "$.order_id" } },
+        ResultPath = null,
+        Catch      = [{ "ErrorEquals" : ["States.ALL"], "ResultPath" : "$.release_error", "Next" : "PlanPDFChunks" }],
+        Next       = "PlanPDFChunks"
+      },
+
+      # Same for an order whose books failed: BookGenerationFailed, or any other error,
+      # ends the Map, and its States.ALL catch comes here.
+      ReleaseCapacityAfterFailure = {
+        Type       = "Task",
+        Resource   = "arn:aws:states:::lambda:invoke",
+        Parameters = { "FunctionName" = aws_lambda_function.release_capacity.arn, "Payload" = { "order_id.$" = "$.order_id" } },
+        ResultPath = null,
+        Catch      = [{ "ErrorEquals" : ["States.ALL"], "ResultPath" : "$.release_error", "Next" : "OrderFailed" }],
+        Next       = "OrderFailed"
+      },
+
+      # The order's books are typeset in chunks, each in one container, so the
+      # WeasyPrint image is pulled and warmed once per chunk instead of once per
+      # book. start_execution sets pdf_books_per_invocation so that a chunk's
+      # renders fit one invocation's time and memory (see
+      # lambda_worker_generate_pdf.tf); at 1, every book gets its own invocation.
+      PlanPDFChunks = {
+        Type       = "Pass",
+        Parameters = { "chunks.$" = "States.ArrayPartition($.written_books, $.pdf_books_per_invocation)" },
+        ResultPath = "$.written_books", # In place: the books are the bulk of the 256 KB state limit.
+        Next       = "GeneratePDFChunks"
+      },
+
+      GeneratePDFChunks = {
+        Type      = "Map",
+        ItemsPath = "$.written_books.chunks",
+        Parameters = {
+          "order_id.$" = "$.order_id",
+          "books.$"    = "$$.Map.Item.Value",
+          "trace_id.$" = "$.trace_id"
+        },
+        Iterator = {
+          StartAt = "GeneratePDFBatch",
+          States = {
+            GeneratePDFBatch = {
+              Type     = "Task",
+              Resource = "arn:aws:states:::lambda:invoke",
+              Parameters = {
+                FunctionName = "${aws_lambda_function.generate_pdf.arn}",
+                "Payload.$"  = "$"
+              },
+              ResultSelector = { "books.$" = "$.Payload" },
+              TimeoutSeconds = 890,
+              End            = true
+            }
+          }
+        },
+        ResultPath = "$.written_books", # The rendered books replace the chunks they came from.
+        Catch      = [{ "ErrorEquals" : ["States.ALL"], "Next" : "OrderFailed" }],
+        Next       = "CollectBookResults"
+      },
+
+      # Same per-book `{ Payload = ... }` list the Map used to produce, for NotifyLulu,
+      # in order across the chunks. The state is rebuilt with only what NotifyLulu
+      # reads, so just this one copy of the books is carried on.
+      CollectBookResults = {
+        Type = "Pass",
+        Parameters = {
+          "order_id.$"                = "$.order_id",
+          "shipping_address.$"        = "$.shipping_address",
+          "trace_id.$"                = "$.trace_id",
+          "processed_books_results.$" = "$.written_books[*].books[*]"
+        },
+        Next = "NotifyLulu"
       },
 
       NotifyLulu = {
@@ -110,8 +210,17 @@ resource "aws_sfn_state_machine" "astrology_book_factory" {
           "Payload.$"  = "$"
         },
         ResultPath = "$.lulu_submission_result",
+        # An upstream that is down (resilience.UpstreamUnavailable) parks the order instead of failing it.
+        Retry = [{
+          ErrorEquals     = ["UpstreamUnavailable"],
+          IntervalSeconds = 60,
+          BackoffRate     = 2,
+          MaxAttempts     = 4,
+          MaxDelaySeconds = 600,
+          JitterStrategy  = "FULL"
+        }],
         Catch = [{
-          ErrorEquals = ["States.All"],
+          ErrorEquals = ["States.ALL"],
           Next        = "OrderFailed"
         }],
         Next = "OrderSucceeded"
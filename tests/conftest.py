@@ -0,0 +1,23 @@
+# tests/conftest.py
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# app/ is imported as a package from the repository root, and the shared Lambda
+# layer's modules as they are on Lambda.
+for path in (ROOT, os.path.join(ROOT, "_build_artifacts", "python")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def load_lambda_module(function: str, name: str):
+    """
+    Imports src/<function>/<name>.py. Those directories are not put on sys.path,
+    as each has an app.py that would shadow the app/ package.
+    """
+    spec = importlib.util.spec_from_file_location(f"{function}_{name}", os.path.join(ROOT, "src", function, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
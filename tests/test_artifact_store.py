@@ -0,0 +1,68 @@
+# tests/test_artifact_store.py
+import os
+import time
+
+from app import artifact_store
+from app.artifact_store import ArtifactStore
+from app.job_store import JobStore
+
+
+def write_file(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return path
+
+
+def test_creates_the_database_directory(tmp_path):
+    db_path = tmp_path / "not-yet" / "jobs.sqlite3"
+    ArtifactStore(str(db_path))
+    assert db_path.exists()
+
+
+def test_evicts_least_recently_used_over_budget(tmp_path, monkeypatch):
+    store = ArtifactStore(str(tmp_path / "jobs.sqlite3"), budget_bytes=250)
+    clock = [1000.0]
+    monkeypatch.setattr(artifact_store.time, "time", lambda: clock[0])
+    old = write_file(tmp_path, "old.pdf", 100)
+    store.register(old, "pdf")
+    clock[0] += 1
+    used = write_file(tmp_path, "used.pdf", 100)
+    store.register(used, "pdf")
+    clock[0] += 1
+    store.lookup(old, "pdf")
+    clock[0] += 1
+
+    store.register(write_file(tmp_path, "new.pdf", 100), "pdf")
+
+    assert not os.path.exists(used)
+    assert os.path.exists(old)
+    assert store.usage()["bytes"] == 200
+
+
+def test_evicts_expired_artifacts_under_budget(tmp_path, monkeypatch):
+    store = ArtifactStore(str(tmp_path / "jobs.sqlite3"), budget_bytes=10 ** 6, max_age_seconds=60)
+    clock = [1000.0]
+    monkeypatch.setattr(artifact_store.time, "time", lambda: clock[0])
+    stale = write_file(tmp_path, "stale.png", 10)
+    store.register(stale, "image")
+    clock[0] += 120
+
+    assert store.evict() == [os.path.abspath(stale)]
+    assert not os.path.exists(stale)
+
+
+def test_never_evicts_artifacts_of_active_jobs(tmp_path):
+    db_path = str(tmp_path / "jobs.sqlite3")
+    jobs = JobStore(db_path)
+    store = ArtifactStore(db_path, budget_bytes=50)
+    job = jobs.create_job({"birth_date": "1990-01-01"})
+    kept = write_file(tmp_path, "kept.png", 100)
+    jobs.record_artifact(job["id"], "image_1", kept)
+
+    store.register(kept, "image")
+
+    assert os.path.exists(kept)
+    jobs.claim_next("worker", lease_seconds=60)
+    jobs.finish(job["id"], "worker", "succeeded", result={})
+    assert store.evict() == [os.path.abspath(kept)]
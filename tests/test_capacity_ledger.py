@@ -0,0 +1,152 @@
+# tests/test_capacity_ledger.py
+import copy
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import capacity_ledger
+from conftest import load_lambda_module
+
+
+class FakeTable:
+    """The ledger's DynamoDB table: GetItem and PutItem with the ledger's version condition."""
+
+    def __init__(self):
+        self.items = {}
+        self.writes = 0
+
+    def get_item(self, Key, ConsistentRead=False):
+        item = self.items.get(Key['ledger'])
+        return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression, ExpressionAttributeValues):
+        current = self.items.get(Item['ledger'])
+        if current is not None and current['version'] != ExpressionAttributeValues[':version']:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        self.items[Item['ledger']] = copy.deepcopy(Item)
+        self.writes += 1
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    table = FakeTable()
+    now = [1000.0]
+    monkeypatch.setattr(capacity_ledger, 'CAPACITY_TABLE_NAME', 'test-capacity')
+    monkeypatch.setattr(capacity_ledger, '_table', table)
+    monkeypatch.setattr(capacity_ledger.time, 'time', lambda: now[0])
+    monkeypatch.setattr(capacity_ledger, 'BOOKS_PER_MINUTE', 6.0)
+    monkeypatch.setattr(capacity_ledger, 'CAPACITY_BURST_BOOKS', 2.0)
+    monkeypatch.setattr(capacity_ledger, 'MAX_IN_FLIGHT_BOOKS', 3)
+    monkeypatch.setattr(capacity_ledger, 'CAPACITY_TIME_SCALE', 1.0)
+    table.now = now
+    return table
+
+
+def test_admits_while_the_bucket_has_tokens(ledger):
+    assert capacity_ledger.acquire('a', 1) == (True, 0, True)
+    assert capacity_ledger.acquire('b', 1) == (True, 0, True)
+    admitted, wait_seconds, created = capacity_ledger.acquire('c', 1)
+    assert (admitted, created) == (False, False)
+    # 6 books a minute refill one token every 10 seconds.
+    assert wait_seconds == 10
+
+
+def test_the_bucket_refills_over_time(ledger):
+    capacity_ledger.acquire('a', 2)
+    assert capacity_ledger.acquire('b', 1)[0] is False
+    ledger.now[0] += 10
+    assert capacity_ledger.acquire('b', 1) == (True, 0, True)
+
+
+def test_a_redelivered_order_is_admitted_without_a_new_lease(ledger):
+    capacity_ledger.acquire('a', 1)
+    writes = ledger.writes
+    assert capacity_ledger.acquire('a', 1) == (True, 0, False)
+    assert ledger.writes == writes
+    assert capacity_ledger.snapshot()['in_flight_books'] == 1
+
+
+def test_caps_books_in_flight_until_released(ledger):
+    capacity_ledger.acquire('a', 2)
+    ledger.now[0] += 60
+    admitted, wait_seconds, _ = capacity_ledger.acquire('b', 2)
+    assert admitted is False
+    assert wait_seconds == capacity_ledger.IN_FLIGHT_RECHECK_SECONDS
+    capacity_ledger.release('a')
+    assert capacity_ledger.acquire('b', 2) == (True, 0, True)
+
+
+def test_leases_expire(ledger, monkeypatch):
+    monkeypatch.setattr(capacity_ledger, 'BOOK_LEASE_SECONDS', 100)
+    capacity_ledger.acquire('a', 2)
+    ledger.now[0] += 101
+    assert capacity_ledger.snapshot()['in_flight_books'] == 0
+
+
+def test_release_with_refund_returns_the_tokens(ledger):
+    capacity_ledger.acquire('a', 2)
+    assert capacity_ledger.snapshot()['tokens'] == 0
+    capacity_ledger.release('a', refund=True)
+    snapshot = capacity_ledger.snapshot()
+    assert (snapshot['tokens'], snapshot['in_flight_books']) == (2.0, 0)
+
+
+def test_release_without_refund_keeps_the_tokens_spent(ledger):
+    capacity_ledger.acquire('a', 2)
+    capacity_ledger.release('a')
+    snapshot = capacity_ledger.snapshot()
+    assert (snapshot['tokens'], snapshot['in_flight_books']) == (0, 0)
+
+
+def test_throttling_halves_the_rate(ledger, monkeypatch):
+    monkeypatch.setattr(capacity_ledger, '_last_throttle_report', -1e9)
+    capacity_ledger.report_throttled()
+    assert capacity_ledger.snapshot()['rate_fraction'] == 0.5
+
+
+def test_retries_a_write_that_lost_the_race(ledger):
+    capacity_ledger.acquire('a', 1)
+    original_load = capacity_ledger._load
+    raced = []
+
+    def load_then_race():
+        state = original_load()
+        if not raced:
+            raced.append(True)
+            # Another writer lands between this read and the conditional write.
+            item = ledger.items[capacity_ledger.CAPACITY_LEDGER]
+            item['version'] += 1
+        return state
+
+    capacity_ledger._load = load_then_race
+    try:
+        assert capacity_ledger.acquire('b', 1) == (True, 0, True)
+    finally:
+        capacity_ledger._load = original_load
+    assert raced == [True]
+
+
+def test_start_execution_releases_a_lease_taken_for_an_order_already_started(monkeypatch, ledger):
+    monkeypatch.setenv('STATE_MACHINE_ARN', 'arn:aws:states:us-east-1:000000000000:stateMachine:test')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    start_execution = load_lambda_module('start_execution', 'app')
+    # The handler uses the layer's ledger, which this test's fixture points at the fake table.
+    monkeypatch.setattr(start_execution, 'capacity_ledger', capacity_ledger)
+
+    class ExecutionAlreadyExists(Exception):
+        pass
+
+    class FakeStepFunctions:
+        exceptions = type('Exceptions', (), {'ExecutionAlreadyExists': ExecutionAlreadyExists})
+
+        def start_execution(self, **kwargs):
+            raise ExecutionAlreadyExists()
+
+    monkeypatch.setattr(start_execution, 'sfn_client', FakeStepFunctions())
+    record = {'messageId': 'm1', 'receiptHandle': 'r1', 'body': json.dumps({'order_id': 'done-order', 'books': [{}]})}
+
+    assert start_execution.lambda_handler({'Records': [record]}, None) == {'batchItemFailures': []}
+    snapshot = capacity_ledger.snapshot()
+    assert snapshot['in_flight_books'] == 0
+    assert snapshot['tokens'] == 2.0
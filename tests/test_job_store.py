@@ -0,0 +1,144 @@
+# tests/test_job_store.py
+import pytest
+
+from app import job_store
+from app.job_store import JobStore, QueueFull
+from app.jobs import request_key
+
+REQUEST = {"birth_date": "1990-03-01", "birth_time": "11:46", "birth_location": "Ahmedabad, Gujarat, India", "target_word_count": 15000}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(job_store.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def store(tmp_path, clock):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def create(store, clock, **kwargs):
+    # Jobs are claimed oldest first, so each one is created a moment after the last.
+    clock[0] += 1
+    return store.create_job(REQUEST, **kwargs)
+
+
+def test_coalesces_identical_requests_while_in_flight(store, clock):
+    key = request_key(REQUEST)
+    first = create(store, clock, request_key=key)
+    # Formatting differences do not make a different book.
+    same = request_key({**REQUEST, "birth_time": "11:46 ", "birth_location": "ahmedabad,gujarat,  India"})
+    second = create(store, clock, request_key=same)
+    assert (first["coalesced"], second["coalesced"]) == (False, True)
+    assert second["id"] == first["id"]
+
+    store.claim_next("worker", lease_seconds=60)
+    assert create(store, clock, request_key=key)["id"] == first["id"]
+
+
+def test_a_finished_request_starts_a_new_job(store, clock):
+    key = request_key(REQUEST)
+    first = create(store, clock, request_key=key)
+    store.claim_next("worker", lease_seconds=60)
+    store.finish(first["id"], "worker", "failed", error="boom")
+    again = create(store, clock, request_key=key)
+    assert not again["coalesced"]
+    assert again["id"] != first["id"]
+
+
+def test_other_word_counts_are_other_books(store, clock):
+    first = create(store, clock, request_key=request_key(REQUEST))
+    longer = create(store, clock, request_key=request_key({**REQUEST, "target_word_count": 30000}))
+    assert longer["id"] != first["id"]
+
+
+def test_queue_depth_limit(store, clock):
+    create(store, clock, max_queued=2)
+    create(store, clock, max_queued=2)
+    with pytest.raises(QueueFull) as raised:
+        create(store, clock, max_queued=2, active_capacity=2)
+    # No job has finished yet, so the wait is estimated from the default job time.
+    assert raised.value.queue_position == 3
+    assert raised.value.retry_after == int(job_store.DEFAULT_JOB_SECONDS / 2) + 1
+    assert raised.value.estimated_wait_seconds == int(job_store.DEFAULT_JOB_SECONDS / 2 * 3 + job_store.DEFAULT_JOB_SECONDS)
+
+
+def test_a_coalesced_request_is_admitted_when_the_queue_is_full(store, clock):
+    key = request_key(REQUEST)
+    first = create(store, clock, max_queued=1, request_key=key)
+    assert create(store, clock, max_queued=1, request_key=key)["id"] == first["id"]
+
+
+def test_per_client_queue_limit(store, clock):
+    create(store, clock, client_ip="10.0.0.1", max_queued_per_client=1)
+    with pytest.raises(QueueFull):
+        create(store, clock, client_ip="10.0.0.1", max_queued_per_client=1)
+    create(store, clock, client_ip="10.0.0.2", max_queued_per_client=1)
+
+
+def test_wait_estimate_uses_finished_jobs(store, clock):
+    job = create(store, clock)
+    store.claim_next("worker", lease_seconds=600)
+    clock[0] += 120
+    store.finish(job["id"], "worker", "succeeded", result={})
+    create(store, clock, max_queued=1)
+    with pytest.raises(QueueFull) as raised:
+        create(store, clock, max_queued=1)
+    assert raised.value.retry_after == 121
+
+
+def test_claims_oldest_first(store, clock):
+    first = create(store, clock)
+    second = create(store, clock)
+    assert store.claim_next("a", lease_seconds=60)["id"] == first["id"]
+    claimed = store.claim_next("b", lease_seconds=60)
+    assert claimed["id"] == second["id"]
+    assert (claimed["status"], claimed["owner"], claimed["attempts"]) == ("running", "b", 1)
+    assert store.claim_next("c", lease_seconds=60) is None
+
+
+def test_active_limit(store, clock):
+    create(store, clock)
+    create(store, clock)
+    assert store.claim_next("a", lease_seconds=60, max_active=1) is not None
+    assert store.claim_next("b", lease_seconds=60, max_active=1) is None
+    # A lease that ran out no longer counts as active.
+    clock[0] += 61
+    assert store.claim_next("b", lease_seconds=60, max_active=1) is not None
+
+
+def test_per_client_active_limit_lets_other_clients_ahead(store, clock):
+    busy = create(store, clock, client_ip="10.0.0.1")
+    waiting = create(store, clock, client_ip="10.0.0.1")
+    other = create(store, clock, client_ip="10.0.0.2")
+    assert store.claim_next("a", lease_seconds=60, max_active_per_client=1)["id"] == busy["id"]
+    assert store.claim_next("b", lease_seconds=60, max_active_per_client=1)["id"] == other["id"]
+    assert store.claim_next("c", lease_seconds=60, max_active_per_client=1) is None
+    store.finish(busy["id"], "a", "succeeded")
+    assert store.claim_next("c", lease_seconds=60, max_active_per_client=1)["id"] == waiting["id"]
+
+
+def test_reclaims_a_job_whose_lease_expired(store, clock):
+    job = create(store, clock)
+    store.claim_next("dead", lease_seconds=60)
+    assert store.claim_next("alive", lease_seconds=60) is None
+    clock[0] += 61
+    reclaimed = store.claim_next("alive", lease_seconds=60)
+    assert (reclaimed["id"], reclaimed["owner"], reclaimed["attempts"]) == (job["id"], "alive", 2)
+    # The dead worker has lost the job.
+    assert not store.renew_lease(job["id"], "dead", 60)
+    store.finish(job["id"], "dead", "failed", error="late")
+    assert store.get_job(job["id"])["status"] == "running"
+
+
+def test_release_requeues_without_counting_the_attempt(store, clock):
+    job = create(store, clock)
+    store.claim_next("worker", lease_seconds=60)
+    store.release(job["id"], "someone-else")
+    assert store.get_job(job["id"])["status"] == "running"
+    store.release(job["id"], "worker")
+    released = store.get_job(job["id"])
+    assert (released["status"], released["owner"], released["attempts"]) == ("queued", None, 0)
@@ -0,0 +1,157 @@
+# tests/test_render_guard.py
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from conftest import load_lambda_module
+
+render_guard = load_lambda_module("generate_pdf", "render_guard")
+
+BUDGET_BYTES = 1000
+
+
+@pytest.fixture(autouse=True)
+def fake_rss(tmp_path, monkeypatch):
+    """
+    Renders report their memory use by writing it to a file named after their pid,
+    which the watchdog reads instead of /proc.
+    """
+    monkeypatch.setattr(render_guard, "RENDER_SAMPLE_SECONDS", 0.01)
+    rss_dir = tmp_path / "rss"
+    rss_dir.mkdir()
+
+    def process_rss_bytes(pid):
+        path = rss_dir / str(pid)
+        return int(path.read_text()) if path.exists() else 0
+
+    monkeypatch.setattr(render_guard, "_process_rss_bytes", process_rss_bytes)
+    return rss_dir
+
+
+def use_memory(rss_dir, rss_bytes):
+    """Called in the render process; stays there until the watchdog stops it."""
+    (rss_dir / str(os.getpid())).write_text(str(rss_bytes))
+    time.sleep(30)
+
+
+@pytest.fixture
+def book(tmp_path):
+    image_path = str(tmp_path / "chapter.png")
+    Image.new("RGB", (2000, 1000), "navy").save(image_path)
+    return {"swapi_call_text": "call", "swapi_json_output": "{}", "chapters": [{"title": "One", "image_path": image_path}]}
+
+
+def image_sizes(data):
+    sizes = []
+    for chapter in data["chapters"]:
+        if chapter["image_path"]:
+            with Image.open(chapter["image_path"]) as image:
+                sizes.append(image.size)
+    return sizes
+
+
+def render_in(tmp_path, **kwargs):
+    return render_guard.guarded_render(workdir=str(tmp_path), deadline=time.monotonic() + 30,
+                                       memory_budget_bytes=BUDGET_BYTES, **kwargs)
+
+
+def test_a_render_within_budget_is_not_degraded(tmp_path, book):
+    result, report = render_in(tmp_path, render=lambda data, on_event: image_sizes(data), book_data=book)
+    assert result == [(2000, 1000)]
+    assert report["degradations"] == []
+    assert len(report["attempts"]) == 1
+
+
+def test_downsamples_images_when_memory_runs_out(tmp_path, book, fake_rss):
+    def render(data, on_event):
+        if max(max(size) for size in image_sizes(data)) > render_guard.DOWNSAMPLE_MAX_PIXELS:
+            use_memory(fake_rss, BUDGET_BYTES + 1)
+        return image_sizes(data)
+
+    result, report = render_in(tmp_path, render=render, book_data=book)
+    assert result == [(900, 450)]
+    assert report["degradations"] == ["downsample_images"]
+    assert report["attempts"][0]["breach_kind"] == "memory"
+    # The caller's book is left as it was.
+    assert image_sizes(book) == [(2000, 1000)]
+
+
+def test_falls_back_to_a_text_only_proof(tmp_path, book, fake_rss):
+    def render(data, on_event):
+        if image_sizes(data):
+            use_memory(fake_rss, BUDGET_BYTES + 1)
+        return data["swapi_call_text"]
+
+    result, report = render_in(tmp_path, render=render, book_data=book)
+    assert result is None
+    assert report["degradations"] == ["downsample_images", "drop_debug_pages", "text_only"]
+    assert [attempt.get("breach_kind") for attempt in report["attempts"]] == ["memory", "memory", "memory", None]
+
+
+def test_pass_one_predicts_that_pass_two_will_not_fit(tmp_path, book, fake_rss):
+    def render(data, on_event):
+        if image_sizes(data):
+            (fake_rss / str(os.getpid())).write_text(str(int(BUDGET_BYTES * 0.9)))
+            time.sleep(0.1)
+            on_event("render_pass_done", {"render_pass": 1, "pages": 12})
+            time.sleep(30)
+        return "proof"
+
+    result, report = render_in(tmp_path, render=render, book_data=book)
+    assert result == "proof"
+    first = report["attempts"][0]
+    assert first["breach"].startswith("pass 2 would need")
+    assert first["pages"] == 12
+
+
+def test_a_render_that_dies_is_retried_degraded(tmp_path, book):
+    def render(data, on_event):
+        if image_sizes(data):
+            os._exit(1)
+        return "proof"
+
+    result, report = render_in(tmp_path, render=render, book_data=book)
+    assert result == "proof"
+    assert report["attempts"][0]["breach_kind"] == "died"
+
+
+def test_raises_when_even_text_only_does_not_fit(tmp_path, book, fake_rss):
+    with pytest.raises(render_guard.RenderBudgetExceeded, match="text-only"):
+        render_in(tmp_path, render=lambda data, on_event: use_memory(fake_rss, BUDGET_BYTES + 1), book_data=book)
+
+
+def test_out_of_time_aborts_the_uploads_and_is_not_retried_without_time(tmp_path, book):
+    aborted = []
+
+    def render(data, on_event):
+        on_event("upload_started", {"key": "book.pdf", "upload_id": "u1"})
+        time.sleep(30)
+
+    started = time.monotonic()
+    with pytest.raises(render_guard.RenderBudgetExceeded, match="ran out of time"):
+        render_guard.guarded_render(render, book, str(tmp_path), deadline=time.monotonic() + 0.5,
+                                    memory_budget_bytes=BUDGET_BYTES, abort_upload=aborted.append)
+    assert time.monotonic() - started < 5
+    assert aborted == [{"key": "book.pdf", "upload_id": "u1"}]
+
+
+def test_a_finished_render_keeps_its_uploads(tmp_path, book):
+    aborted = []
+
+    def render(data, on_event):
+        on_event("upload_started", {"key": "book.pdf", "upload_id": "u1"})
+        return "uploaded"
+
+    result, _ = render_guard.guarded_render(render, book, str(tmp_path), deadline=time.monotonic() + 30,
+                                            memory_budget_bytes=BUDGET_BYTES, abort_upload=aborted.append)
+    assert (result, aborted) == ("uploaded", [])
+
+
+def test_a_render_error_is_raised_without_degrading(tmp_path, book):
+    def render(data, on_event):
+        raise ValueError("bad template")
+
+    with pytest.raises(RuntimeError, match="ValueError: bad template"):
+        render_in(tmp_path, render=render, book_data=book)
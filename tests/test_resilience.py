@@ -0,0 +1,154 @@
+# tests/test_resilience.py
+import asyncio
+
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, RetryBudget, Upstream, UpstreamUnavailable
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class ConnectError(Exception):
+    """Named like httpx's: the request never reached the upstream."""
+
+
+@pytest.fixture(autouse=True)
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(resilience.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: 0.0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    return now
+
+
+def make_upstream(threshold=2, cool_down=30, max_attempts=3):
+    upstream = Upstream("test")
+    upstream.max_attempts = max_attempts
+    upstream.breaker = CircuitBreaker(failure_threshold=threshold, cool_down_seconds=cool_down)
+    upstream.budget = RetryBudget(ratio=0, minimum=100, window_seconds=60)
+    return upstream
+
+
+def failing(exc):
+    def fn():
+        raise exc
+    return fn
+
+
+def open_breaker(upstream, clock):
+    for _ in range(upstream.breaker.failure_threshold):
+        with pytest.raises(StatusError):
+            upstream.call(failing(StatusError(500)), idempotent=False)
+    assert upstream.breaker.state == 'open'
+    clock[0] += upstream.breaker.cool_down_seconds + 1
+    assert upstream.breaker.state == 'half_open'
+
+
+def test_retries_a_5xx_then_succeeds():
+    upstream = make_upstream()
+    answers = [StatusError(503), "ok"]
+
+    def fn():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert upstream.call(fn) == "ok"
+    assert upstream.breaker.failures == 0
+
+
+def test_opens_after_consecutive_failures_and_fails_fast(clock):
+    upstream = make_upstream(threshold=2)
+    with pytest.raises(UpstreamUnavailable):
+        upstream.call(failing(StatusError(502)))
+    assert upstream.breaker.state == 'open'
+    calls = []
+    with pytest.raises(UpstreamUnavailable, match="circuit breaker is open"):
+        upstream.call(lambda: calls.append(1))
+    assert calls == []
+
+
+def test_unretried_5xx_and_transport_errors_count_as_failures(clock):
+    upstream = make_upstream(threshold=2)
+    with pytest.raises(StatusError):
+        upstream.call(failing(StatusError(500)), idempotent=False)
+    with pytest.raises(UpstreamUnavailable):
+        upstream.call(failing(ConnectError()), idempotent=False)
+    assert upstream.breaker.state == 'open'
+
+
+def test_a_4xx_resets_the_failure_count():
+    upstream = make_upstream(threshold=2)
+    with pytest.raises(StatusError):
+        upstream.call(failing(StatusError(500)), idempotent=False)
+    with pytest.raises(StatusError):
+        upstream.call(failing(StatusError(400)))
+    assert upstream.breaker.failures == 0
+    assert upstream.breaker.state == 'closed'
+
+
+def test_a_successful_probe_closes_the_breaker(clock):
+    upstream = make_upstream()
+    open_breaker(upstream, clock)
+    assert upstream.call(lambda: "ok") == "ok"
+    assert upstream.breaker.state == 'closed'
+
+
+def test_a_failed_probe_reopens_the_breaker(clock):
+    upstream = make_upstream()
+    open_breaker(upstream, clock)
+    with pytest.raises(StatusError):
+        upstream.call(failing(StatusError(500)), idempotent=False)
+    assert upstream.breaker.state == 'open'
+
+
+def test_a_probe_failing_with_an_unclassified_error_releases_the_probe(clock):
+    upstream = make_upstream()
+    open_breaker(upstream, clock)
+    with pytest.raises(ValueError):
+        upstream.call(failing(ValueError("malformed response")))
+    assert upstream.breaker.state == 'half_open'
+    assert upstream.call(lambda: "ok") == "ok"
+    assert upstream.breaker.state == 'closed'
+
+
+def test_a_cancelled_async_probe_releases_the_probe(clock):
+    upstream = make_upstream()
+    open_breaker(upstream, clock)
+
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def run():
+        task = asyncio.ensure_future(upstream.call_async(slow))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert upstream.breaker.state == 'half_open'
+
+
+def test_retry_budget_limits_retries():
+    budget = RetryBudget(ratio=0.5, minimum=1, window_seconds=60)
+    for _ in range(4):
+        budget.record_call()
+    assert [budget.try_spend() for _ in range(4)] == [True, True, True, False]
+
+
+def test_retries_stop_when_the_budget_is_spent():
+    upstream = make_upstream(threshold=100, max_attempts=5)
+    upstream.budget = RetryBudget(ratio=0, minimum=1, window_seconds=60)
+    with pytest.raises(UpstreamUnavailable, match="retry budget exhausted"):
+        upstream.call(failing(StatusError(503)))